@@ -28,47 +28,43 @@ def conv1x1(in_planes, out_planes):
                      padding=0, bias=False)
 
 
-def func_attention(query, context, gamma1):
+def word_softmax(attn, pad_mask=None, dim=-1):
+    """Eq. (8): softmax over the words along dim; pad_mask (broadcast to
+    attn, True for padding words) gives those words no weight."""
+    if pad_mask is not None:
+        attn = attn.masked_fill(pad_mask, torch.finfo(attn.dtype).min)
+    return attn.softmax(dim=dim)
+
+
+def func_attention(query, context, gamma1, mask=None, need_attn=True):
     """
     query: batch x ndf x queryL
     context: batch x ndf x ih x iw (sourceL=ihxiw)
-    mask: batch_size x sourceL
+    mask: batch x queryL, True for padding words, which get no weight in Eq. (8)
+    returns weightedContext (batch x ndf x queryL) and, if need_attn,
+    attn (batch x queryL x ih x iw)
     """
     batch_size, queryL = query.size(0), query.size(2)
     ih, iw = context.size(2), context.size(3)
     sourceL = ih * iw
 
-    # --> batch x sourceL x ndf
-    context = context.view(batch_size, -1, sourceL)
-    contextT = torch.transpose(context, 1, 2).contiguous()
-
-    # Get attention
-    # (batch x sourceL x ndf)(batch x ndf x queryL)
-    # -->batch x sourceL x queryL
-    # print('type(contextT)',contextT)
-    # print('type(query)',query)
-    attn = torch.bmm(contextT, query)  # Eq. (7) in AttnGAN paper
-    # --> batch*sourceL x queryL
-    attn = attn.view(batch_size * sourceL, queryL)
-    attn = nn.Softmax(dim=-1)(attn)  # Eq. (8)
-
-    # --> batch x sourceL x queryL
-    attn = attn.view(batch_size, sourceL, queryL)
-    # --> batch*queryL x sourceL
-    attn = torch.transpose(attn, 1, 2).contiguous()
-    attn = attn.view(batch_size * queryL, sourceL)
+    # --> batch x ndf x sourceL
+    context = context.reshape(batch_size, -1, sourceL)
+
+    # Get attention, kept as batch x queryL x sourceL throughout
+    # so no step needs a transposed copy
+    attn = torch.einsum('bds,bdq->bqs', context, query)  # Eq. (7) in AttnGAN paper
+    attn = word_softmax(attn, None if mask is None else mask.unsqueeze(2), dim=1)  # Eq. (8)
     #  Eq. (9)
-    attn = attn * gamma1
-    attn = nn.Softmax(dim=-1)(attn)
-    attn = attn.view(batch_size, queryL, sourceL)
-    # --> batch x sourceL x queryL
-    attnT = torch.transpose(attn, 1, 2).contiguous()
+    attn = (attn * gamma1).softmax(dim=2)
 
-    # (batch x ndf x sourceL)(batch x sourceL x queryL)
+    # (batch x ndf x sourceL)(batch x queryL x sourceL)
     # --> batch x ndf x queryL
-    weightedContext = torch.bmm(context, attnT)
+    weightedContext = torch.einsum('bds,bqs->bdq', context, attn)
 
-    return weightedContext, attn.view(batch_size, -1, ih, iw)
+    if not need_attn:
+        return weightedContext, None
+    return weightedContext, attn.view(batch_size, queryL, ih, iw)
 
 
 class GlobalAttentionGeneral(nn.Module):
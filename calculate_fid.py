@@ -3,19 +3,19 @@ import os
 
 import torch
 import torchvision
-from torch_fidelity import calculate_metrics
+from torch_fidelity.feature_extractor_inceptionv3 import FeatureExtractorInceptionV3
+from torch_fidelity.metric_fid import fid_statistics_to_metric
 import numpy as np
 from ipdb import set_trace
-import shutil
 from tqdm import tqdm
 import time
 import model
 from tensor_transforms import convert_to_coord_format
-from distributed import get_rank
+from torch import distributed as dist
+from distributed import get_rank, get_world_size
 from torchvision import transforms
 
-def get_Text_From_TediGan_val30000(wordtoix,device):
-    tediGan_text_path = '../valid_text_30000/'
+def get_Text_From_TediGan_val30000(wordtoix,device,tediGan_text_path='../valid_text_30000/'):
     all_text_fileName = os.listdir(tediGan_text_path)
     all_text_fileName.sort()
     text_list = []
@@ -56,47 +56,165 @@ def save_grid_images(images, filename,img_dir):
         range=(-1, 1),
     )
 
+FEATURE_EXTRACTOR = 'inception-v3-compat'
+_extractors = {}
+
+
+def inception_extractor(device):
+    # the extractor torch_fidelity.calculate_metrics(fid=True) runs
+    key = str(device)
+    if key not in _extractors:
+        extractor = FeatureExtractorInceptionV3(FEATURE_EXTRACTOR, ['2048'])
+        _extractors[key] = extractor.to(device).eval()
+    return _extractors[key]
+
+
+def to_uint8(images):
+    # what save_image(normalize=True, range=(-1, 1)) writes to the PNG
+    images = (images.float().clamp(-1, 1) + 1) / 2
+    return images.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+
+
+class StreamingFID(object):
+    """Inception feature mean and covariance, accumulated batch by batch
+    as a float64 sum and sum of outer products."""
+    def __init__(self, device='cuda', extractor=None, dim=2048):
+        self.device = device
+        self.extractor = extractor if extractor is not None else inception_extractor(device)
+        self.count = 0
+        self.sum = torch.zeros(dim, dtype=torch.float64, device=device)
+        self.outer = torch.zeros(dim, dim, dtype=torch.float64, device=device)
+
+    def add_features(self, features):
+        features = features.reshape(features.size(0), -1).double()
+        self.count += features.size(0)
+        self.sum += features.sum(0)
+        self.outer += features.t() @ features
+
+    @torch.no_grad()
+    def update(self, images):
+        """images: uint8 bs x 3 x H x W"""
+        self.add_features(self.extractor(images.to(self.device))[0])
+
+    def all_reduce(self):
+        """Sum count, feature sum and outer-product sum over all ranks in
+        a single collective."""
+        if get_world_size() == 1:
+            return self
+        dim = self.sum.numel()
+        flat = torch.cat([self.sum.new_tensor([self.count]), self.sum, self.outer.flatten()])
+        dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        self.count = int(flat[0].item())
+        self.sum = flat[1:dim + 1]
+        self.outer = flat[dim + 1:].view(dim, dim)
+        return self
+
+    def statistics(self):
+        n = self.count
+        mu = self.sum / n
+        sigma = (self.outer - n * torch.outer(mu, mu)) / (n - 1)
+        return {'mu': mu.cpu().numpy(), 'sigma': sigma.cpu().numpy()}
+
+
+def dataset_statistics(dataset, bs, device='cuda', num_workers=0):
+    # dataset items are uint8 CHW tensors (EvalDataset_Final)
+    fid = StreamingFID(device)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=bs, shuffle=False, num_workers=num_workers
+    )
+    for images in loader:
+        fid.update(images)
+    return fid.statistics()
+
+
+def shard_range(total, rank, world_size):
+    # contiguous slice of [0, total) for rank
+    per_rank = (total + world_size - 1) // world_size
+    return min(total, rank * per_rank), min(total, (rank + 1) * per_rank)
+
+
+@torch.no_grad()
+def generate_statistics(model, states_at, total, bs, device='cuda', extractor=None, on_batch=None,
+                        dim=2048, shard=True):
+    """FID statistics of model(states) over samples [0, total). Each rank
+    generates its shard, states_at(begin, end) returns the G input of
+    those samples; the ranks are combined with one all_reduce. With
+    shard=False the caller generates all of them and no collective runs."""
+    fid = StreamingFID(device, extractor, dim)
+    rank, world_size = (get_rank(), get_world_size()) if shard else (0, 1)
+    start, end = shard_range(total, rank, world_size)
+    for begin in tqdm(range(start, end, bs), disable=get_rank() != 0):
+        stop = min(begin + bs, end)
+        fake_imgs, _, _, _ = model(states_at(begin, stop))
+        fid.update(to_uint8(fake_imgs))
+        if on_batch is not None:
+            on_batch(begin, stop, fake_imgs)
+    if shard:
+        fid.all_reduce()
+    return fid.statistics()
+
+
 @torch.no_grad()
 def calculate_fid_CLIP_with_TediGan_text(model, val_dataset,train_dataset, bs, textEnc, num_batches, latent_size,data_iter,
                     prepare_data,get_text_input,word2id,get_text,
-                  val_loader,save_dir='fid_imgs', device='cuda'):
-    os.makedirs(save_dir, exist_ok=True)
-    cnt = 0
+                  val_loader,save_dir='fid_imgs', device='cuda', dump_samples=0,
+                  train_stats=None, val_stats=None, prompts=None, shard=True):
+    # generated batches go straight into the Inception extractor; only
+    # dump_samples evenly spaced images (and their captions) are written
+    # to save_dir for inspection. train_stats / val_stats are the cached
+    # reference mu / sigma (miscc.fid_reference), computed here if None.
+    # prompts is the compiled prompt table (miscc.clip_cache
+    # ensure_prompt_bundle); batches then come from its embeddings and the
+    # prompt files are neither read nor encoded. Called on every rank, each
+    # generates a contiguous shard of the prompts; with shard=False on one
+    # rank only (miscc.evaluator), which generates them all
+    total = num_batches * bs
+    if prompts is None:
+        caption_list,all_text_fileName,_ = get_Text_From_TediGan_val30000(word2id,device)
+        total = min(total, len(caption_list))
+    else:
+        total = min(total, len(prompts))
+
+    def captions_at(begin, end):
+        if prompts is not None:
+            rows = prompts[begin:end]
+            caps = torch.from_numpy(rows['caps'].astype(np.int64)).to(device)
+            return caps, [key.decode() for key in rows['key']]
+        return torch.stack(caption_list[begin:end]), all_text_fileName[begin:end]
+
+    def states_at(begin, end):
+        if prompts is not None:
+            return torch.from_numpy(prompts[begin:end]['emb'].astype(np.float32)).to(device)
+        # FOR CLIP
+        texts = get_text_input(captions_at(begin, end)[0])
+        return textEnc.encode_text(texts).float().detach()
+
+    dump_every = max(1, total // dump_samples) if dump_samples > 0 else 0
     save_text_path = save_dir + '/text/'
-    os.makedirs(save_text_path, exist_ok=True)
-    caption_list,all_text_fileName,_ = get_Text_From_TediGan_val30000(word2id,device)
-    # torch.tensor(caption_list)
-    # caption_list = caption_list.to(device)
-    for i in tqdm(range(num_batches)):
-        # try:
-        #     data = data_iter.next()
-        # except:
-        #     data_iter = iter(val_loader)
-        #     data = data_iter.next()
-
-        # imgs, caps, cap_lens, _, keys = prepare_data(data)
-        caps = caption_list[i*bs:(i+1)*bs]
+    if dump_every:
+        os.makedirs(save_text_path, exist_ok=True)
+
+    def dump(begin, end, fake_imgs):
+        caps, keys = captions_at(begin, end)
         save_texts = get_text(caps)
-        keys = all_text_fileName[i*bs:(i+1)*bs]
-        # FOR CLIP
-        texts = get_text_input(caps)
-        states = textEnc.encode_text(texts).float()
-        states = states.detach()
-
-        fake_imgs, _, _, _ = model(states)
-        for j in range(bs):
-            cnt += 1
-            img_name = f"{keys[j]}_{str(cnt).zfill(6)}.png"
+        for j in range(end - begin):
+            if (begin + j) % dump_every:
+                continue
+            name = f"{keys[j]}_{str(begin + j + 1).zfill(6)}"
             torchvision.utils.save_image(fake_imgs[j, :, :, :],
-                                        #  os.path.join(save_dir, '00000.png'), range=(-1, 1),
-                                         os.path.join(save_dir, img_name), range=(-1, 1),
+                                         os.path.join(save_dir, name + '.png'), range=(-1, 1),
                                          normalize=True)
-            text_name = f"{keys[j]}_{str(cnt).zfill(6)}.txt"
-            file = open(os.path.join(save_text_path, text_name),'w')
-            file.write(save_texts[j])
-            file.close()
-    metrics_dict1 = calculate_metrics(input1=save_dir, input2=train_dataset, cuda=True, isc=False, fid=True, kid=False, verbose=False)
-    metrics_dict2 = calculate_metrics(input1=save_dir, input2=val_dataset, cuda=True, isc=False, fid=True, kid=False, verbose=False)
-    if os.path.exists(save_dir) is not None:
-        shutil.rmtree(save_dir)
+            with open(os.path.join(save_text_path, name + '.txt'), 'w') as file:
+                file.write(save_texts[j])
+
+    stats = generate_statistics(
+        model, states_at, total, bs, device, on_batch=dump if dump_every else None,
+        shard=shard
+    )
+    if train_stats is None:
+        train_stats = dataset_statistics(train_dataset, bs, device)
+    if val_stats is None:
+        val_stats = dataset_statistics(val_dataset, bs, device)
+    metrics_dict1 = fid_statistics_to_metric(stats, train_stats, False)
+    metrics_dict2 = fid_statistics_to_metric(stats, val_stats, False)
     return metrics_dict1,metrics_dict2
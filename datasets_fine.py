@@ -11,6 +11,7 @@ from miscc.config import cfg
 
 import torch
 import torch.utils.data as data
+from torch.utils.data.dataloader import default_collate
 from torch.autograd import Variable
 import torchvision.transforms as transforms
 
@@ -23,35 +24,52 @@ from PIL import Image
 from ipdb import set_trace
 from numpy import random
 from random import sample
-from bert_serving.client import BertClient
 if sys.version_info[0] == 2:
 	import cPickle as pickle
 else:
 	import pickle
 from ipdb import set_trace
 from distributed import get_rank
+from miscc.image_store import load_image_store
+from miscc.caption_store import CaptionStore
+from miscc.caption_cache import tokenize_captions
+from miscc.caption_cache import caption_cache_key, caption_cache_path
+from miscc.word_embedding import get_word_encoder, encode_words
+from miscc.word_embedding import save_word_emb, load_word_emb
+
+
+# main.py falls back to the CPU when no GPU is visible
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
 def prepare_data(data):
-	imgs, caps, cap_ori,cap_lens, cls_ids, keys = data
+	imgs, caps, cap_ori,cap_lens, cls_ids, keys, extras = data
 	cap_ori = list(cap_ori)
 	sorted_cap_lens, sorted_cap_indices = \
 		torch.sort(cap_lens, 0, True)
 
-	real_imgs = Variable(imgs[sorted_cap_indices]).to('cuda')
+	real_imgs = Variable(imgs[sorted_cap_indices]).to(DEVICE)
 
 	caps = caps[sorted_cap_indices].squeeze()  # sorted
 	cap_ori = [cap_ori[i] for i in sorted_cap_indices.numpy()]
 	cls_ids =None
 	keys = [keys[i] for i in sorted_cap_indices.numpy()]  # sorted
-	caps = Variable(caps).to('cuda')
-	sorted_cap_lens = Variable(sorted_cap_lens).to('cuda')
-
-	return real_imgs, caps,cap_ori, sorted_cap_lens, cls_ids, keys
-
-
-def get_imgs(img_path, bbox=None, transform=None, normalize=None):
-	img = Image.open(img_path).convert('RGB')
+	caps = Variable(caps).to(DEVICE)
+	sorted_cap_lens = Variable(sorted_cap_lens).to(DEVICE)
+	# per-caption CLIP features from the dataset tables, see get_extras
+	extras = {k: v[sorted_cap_indices].to(DEVICE) for k, v in extras.items()}
+
+	return real_imgs, caps,cap_ori, sorted_cap_lens, cls_ids, keys, extras
+
+
+def get_imgs(img_path, bbox=None, transform=None, normalize=None,
+			 draft_size=None):
+	img = Image.open(img_path)
+	if draft_size is not None and bbox is None:
+		# the JPEG decoder scales by 1/2, 1/4 or 1/8 in the DCT domain and
+		# keeps the result >= draft_size, transform does the remaining resize
+		img.draft('RGB', (draft_size, draft_size))
+	img = img.convert('RGB')
 	width, height = img.size
 	if bbox is not None:
 		r = int(np.maximum(bbox[2], bbox[3]) * 0.75)
@@ -103,24 +121,13 @@ class TextDataset(data.Dataset):
 		else:
 			self.bbox = None
 
-		self.data = self.load_data(data_dir) 
-
-		if split == 'train':
-			self.filenames = self.data[split]['filenames']
-			self.keys = self.data[split]['keynames']
+		self.img_store = load_image_store(self.imsize, self.bbox)
+		if cfg.TEXT.CAPTION_STORE != '':
+			self.load_caption_store(split)
 		else:
-			self.filenames, self.keys = [], []
-			for split in self.data.keys():
-				if split != 'train':
-					self.filenames += self.data[split]['filenames']
-					self.keys += self.data[split]['keynames']
-		self.ori_caps = self.get_ori_captions(split)
-		#self.val_ori_caps = self.get_ori_captions('test')
-		# self.use_glove = cfg.TEXT.USE_GLOVE
-		self.captions, self.ixtoword, self.wordtoix, self.n_words, \
-			self.pretrained_emb = self.load_text_data(data_dir, split)
-		self.img_num = len(set(self.filenames))
+			self.load_caption_lists(data_dir, split)
 		self.number_example = len(self.captions) # N img - N*10 text
+		self.clip_tables = {}
 		split_dir = os.path.join(data_dir, split)
 		self.class_id = self.load_class_id(split_dir, self.number_example)
 
@@ -197,24 +204,16 @@ class TextDataset(data.Dataset):
 			# captions = self.data['val']['captions'] + self.data['test']['captions']
 
 		new_captions = []
-		for idx, caption in enumerate(captions):
-			# cap = caption.decode('utf8').replace("\ufffd\ufffd", " ")
-			cap = caption.replace("\ufffd\ufffd", " ")
-			tokenizer = RegexpTokenizer(r'\w+')
-			tokens = tokenizer.tokenize(cap.lower())
-			if len(tokens) == 0:
+		tokenized = tokenize_captions(captions, int(cfg.WORKERS))
+		for idx, tokens in enumerate(tokenized):
+			if tokens is None:
 				key = self.keys[idx]
 				imgname = self.filenames[idx]
 				print('key: {}\n'
 					  'img: {}\n'
-					  'cap: {}'.formate(key, imgname, cap))
+					  'cap: {}'.format(key, imgname, captions[idx]))
 				continue
-			tokens_new = []
-			for t in tokens:
-				t = t.encode('ascii', 'ignore').decode('ascii')
-				if len(t) > 0:
-					tokens_new.append(t)
-			new_captions.append(tokens_new)
+			new_captions.append(tokens)
 		return new_captions
 
 	def build_dictionary(self, train_captions, test_captions):
@@ -234,7 +233,7 @@ class TextDataset(data.Dataset):
 		}
 
 		spacy_tool = None
-		bc = BertClient()
+		encoder = get_word_encoder(cfg.TEXT.EMB_BACKEND, cfg.TEXT.EMB_MODEL)
 
 		for w in vocab:
 			if w not in wordtoix:
@@ -244,7 +243,9 @@ class TextDataset(data.Dataset):
 		ixtoword = {v: k for k, v in wordtoix.items()}
 
 		words = list(wordtoix.keys())
-		pretrained_emb = bc.encode(words)
+		pretrained_emb = encode_words(
+			encoder, words, cfg.TEXT.EMB_BATCH, cfg.TEXT.EMB_THREADS
+		)
 		train_captions_new = []
 		for t in train_captions:
 			rev = []
@@ -285,9 +286,10 @@ class TextDataset(data.Dataset):
 				  .format(len_, num, percent))
 
 	def load_text_data(self, data_dir, split):
-		captions_pkl = cfg.TEXT.CAPTIONS_PKL
-		assert captions_pkl != ''
-		filepath = os.path.join(data_dir, captions_pkl)
+		# keyed by dataset2.json and the tokenizer settings, stale caches
+		# simply are not found and get rebuilt
+		self.caption_key = caption_cache_key(data_dir)
+		filepath = caption_cache_path(data_dir, self.caption_key)
 
 		if not os.path.isfile(filepath):
 			train_captions = self.load_captions3('train')
@@ -298,19 +300,22 @@ class TextDataset(data.Dataset):
 			pretrained_emb = \
 				self.build_dictionary(train_captions, test_captions)
 
-			with open(filepath, 'wb') as f:
-				# pickle.dump([train_captions, test_captions,
-				#              ixtoword, wordtoix], f, protocol=2)
+			# float16 .npy next to the pickle, which only keeps its name
+			emb_path = save_word_emb(filepath, pretrained_emb)
+			pretrained_emb = load_word_emb(data_dir, os.path.basename(emb_path))
+			tmp_path = '%s.%d.tmp' % (filepath, os.getpid())
+			with open(tmp_path, 'wb') as f:
 				pickle.dump([train_captions, test_captions,
-							 ixtoword, wordtoix, pretrained_emb], f)
-				print('Save to: ', filepath)
+							 ixtoword, wordtoix, os.path.basename(emb_path)], f)
+			os.replace(tmp_path, filepath)
+			print('Save to: ', filepath)
 		else:
 			with open(filepath, 'rb') as f:
 				x = pickle.load(f, encoding='iso-8859-1')
 
 				train_captions, test_captions = x[0], x[1]
 				ixtoword, wordtoix = x[2], x[3]
-				pretrained_emb = x[4]
+				pretrained_emb = load_word_emb(data_dir, x[4])
 				del x
 				n_words = len(ixtoword)
 
@@ -360,6 +365,40 @@ class TextDataset(data.Dataset):
 		return keynames
 
 
+	def load_caption_lists(self, data_dir, split):
+		self.data = self.load_data(data_dir) 
+		if split == 'train':
+			self.filenames = self.data[split]['filenames']
+			self.keys = self.data[split]['keynames']
+		else:
+			self.filenames, self.keys = [], []
+			for split in self.data.keys():
+				if split != 'train':
+					self.filenames += self.data[split]['filenames']
+					self.keys += self.data[split]['keynames']
+		self.ori_caps = self.get_ori_captions(split)
+		#self.val_ori_caps = self.get_ori_captions('test')
+		# self.use_glove = cfg.TEXT.USE_GLOVE
+		self.captions, self.ixtoword, self.wordtoix, self.n_words, \
+			self.pretrained_emb = self.load_text_data(data_dir, split)
+		self.img_num = len(set(self.filenames))
+
+
+	def load_caption_store(self, split):
+		store = CaptionStore(cfg.TEXT.CAPTION_STORE, split)
+		self.filenames, self.keys = store.filenames, store.keys
+		self.ori_caps = store.texts
+		self.captions = store.captions
+		self.caption_key = store.caption_key
+		self.ixtoword, self.wordtoix = store.ixtoword, store.wordtoix
+		self.n_words = len(self.ixtoword)
+		self.pretrained_emb = store.pretrained_emb
+		self.img_num = store.num_images
+		if get_rank() == 0:
+			print('Load captions from: %s' % cfg.TEXT.CAPTION_STORE)
+
+
+
 	def load_data(self, data_dir):
 		# dataset: {'train':{'filenames':[], 'captions':[], 'keynames':[]}, 'val':{}, 'test':{}}
 		data_path = os.path.join(data_dir, 'dataset2.json')
@@ -381,6 +420,10 @@ class TextDataset(data.Dataset):
 		x_len = num_words
 		if num_words <= cfg.TEXT.WORDS_NUM:
 			x[:num_words, 0] = sent_caption
+		elif 'sent_emb' in self.clip_tables:
+			# the cached sentence embedding encodes the first WORDS_NUM words
+			x[:, 0] = sent_caption[:cfg.TEXT.WORDS_NUM]
+			x_len = cfg.TEXT.WORDS_NUM
 		else:
 			ix = list(np.arange(num_words))  # 1, 2, 3,..., maxNum
 			np.random.shuffle(ix)
@@ -391,14 +434,28 @@ class TextDataset(data.Dataset):
 		return x, x_len
 
 
+	def attach_clip_table(self, name, table, index=None):
+		# table: [num_captions, ...] array indexed by sent_ix, or with
+		# index given, rows of table gathered by index[sent_ix]
+		self.clip_tables[name] = (table, index)
+
+
+	def get_extras(self, sent_ix):
+		extras = {'sent_ix': sent_ix}
+		for name, (table, index) in self.clip_tables.items():
+			row = sent_ix if index is None else index[sent_ix]
+			extras[name] = torch.from_numpy(np.array(table[row]))
+		return extras
+
+
 	def get_grid_data(self, k):
 		# a list of indices for a sentence
 		indexs = sample(range(self.__len__()), k)
 		imgs, caps, cap_lens = [], [], []
 		cls_ids, keys = [], []
-		cap_ori_list = []
+		cap_ori_list, extras = [], []
 		for idx in indexs:
-			img, cap,cap_ori, cap_len, cls_id, key = self.__getitem__(idx)
+			img, cap,cap_ori, cap_len, cls_id, key, extra = self.__getitem__(idx)
 
 			imgs.append(img)
 			caps.append(torch.from_numpy(cap))
@@ -406,6 +463,7 @@ class TextDataset(data.Dataset):
 			cls_ids.append(cls_id)
 			keys.append(key)
 			cap_ori_list.append(cap_ori)
+			extras.append(extra)
 		
 		imgs = torch.stack(imgs, dim=0)
 		caps = torch.cat(caps, dim=1).transpose(0, 1)
@@ -414,7 +472,8 @@ class TextDataset(data.Dataset):
 		cls_ids = 0
 		keys = tuple(keys)
 		# set_trace()
-		return [imgs, caps,cap_ori_list, cap_lens, cls_ids, keys]
+		extras = default_collate(extras)
+		return [imgs, caps,cap_ori_list, cap_lens, cls_ids, keys, extras]
 	def get_ori_captions(self,split):
 		if split == 'train':
 				captions = self.data['train']['captions']
@@ -439,10 +498,15 @@ class TextDataset(data.Dataset):
 		key = self.keys[index]
 		file = self.filenames[index]
 		cls_id = 0
-		img_name = f'{self.data_dir}/{cfg.IMG_DIR}/{file}.jpg'
-		
-		bbox = self.bbox[file] if self.bbox else None
-		img = get_imgs(img_name, bbox, self.transform, self.norm)
+		if self.img_store is not None:
+			flip = torch.rand(1).item() < 0.5
+			img = self.img_store.get_tensor(file, flip=flip)
+		else:
+			img_name = f'{self.data_dir}/{cfg.IMG_DIR}/{file}.jpg'
+			bbox = self.bbox[file] if self.bbox else None
+			draft_size = self.imsize if cfg.JPEG_DRAFT else None
+			img = get_imgs(img_name, bbox, self.transform, self.norm,
+						   draft_size=draft_size)
 		try:
 			cap, cap_len = self.get_caption(sent_ix)
 			cap_ori = self.ori_caps[sent_ix]
@@ -450,7 +514,7 @@ class TextDataset(data.Dataset):
 			sent_ix = random.randint(0, self.embeddings_num*self.img_num-1)
 			cap, cap_len = self.get_caption(sent_ix)
 			cap_ori = self.ori_caps[sent_ix]
-		return img, cap,cap_ori, cap_len, cls_id, key
+		return img, cap,cap_ori, cap_len, cls_id, key, self.get_extras(sent_ix)
 
 
 	def __len__(self): # length
@@ -482,27 +546,18 @@ class EvalDataset_Final(data.Dataset):
 
 		# self.data = {}
 		self.data_dir = data_dir
+		self.split = split
 		if data_dir.find('birds') != -1:
 			self.bbox = self.load_bbox()
 		else:
 			self.bbox = None
 
-		self.data = self.load_data(data_dir) 
-
-		if split == 'train':
-			self.filenames = self.data[split]['filenames']
-			self.keys = self.data[split]['keynames']
+		# EvalDataset_Final always yields 256x256 uncropped images
+		self.img_store = load_image_store(256)
+		if cfg.TEXT.CAPTION_STORE != '':
+			self.load_caption_store(split)
 		else:
-			self.filenames, self.keys = [], []
-			for split in self.data.keys():
-				if split != 'train':
-					self.filenames += self.data[split]['filenames']
-					self.keys += self.data[split]['keynames']
-
-		# self.use_glove = cfg.TEXT.USE_GLOVE
-		self.captions, self.ixtoword, self.wordtoix, self.n_words, \
-			self.pretrained_emb = self.load_text_data(data_dir, split)
-		self.img_num = len(set(self.filenames))
+			self.load_caption_lists(data_dir, split)
 		self.number_example = len(self.captions) # N img - N*10 text
 		split_dir = os.path.join(data_dir, split)
 		self.class_id = self.load_class_id(split_dir, self.number_example)
@@ -580,24 +635,16 @@ class EvalDataset_Final(data.Dataset):
 					captions += self.data[split]['captions']
 
 		new_captions = []
-		for idx, caption in enumerate(captions):
-			# cap = caption.decode('utf8').replace("\ufffd\ufffd", " ")
-			cap = caption.replace("\ufffd\ufffd", " ")
-			tokenizer = RegexpTokenizer(r'\w+')
-			tokens = tokenizer.tokenize(cap.lower())
-			if len(tokens) == 0:
+		tokenized = tokenize_captions(captions, int(cfg.WORKERS))
+		for idx, tokens in enumerate(tokenized):
+			if tokens is None:
 				key = self.keys[idx]
 				imgname = self.filenames[idx]
 				print('key: {}\n'
 					  'img: {}\n'
-					  'cap: {}'.formate(key, imgname, cap))
+					  'cap: {}'.format(key, imgname, captions[idx]))
 				continue
-			tokens_new = []
-			for t in tokens:
-				t = t.encode('ascii', 'ignore').decode('ascii')
-				if len(t) > 0:
-					tokens_new.append(t)
-			new_captions.append(tokens_new)
+			new_captions.append(tokens)
 		return new_captions
 
 	def build_dictionary(self, train_captions, test_captions):
@@ -619,7 +666,7 @@ class EvalDataset_Final(data.Dataset):
 		spacy_tool = None
 		# pretrained_emb = []
 
-		bc = BertClient()
+		encoder = get_word_encoder(cfg.TEXT.EMB_BACKEND, cfg.TEXT.EMB_MODEL)
 
 		for w in vocab:
 			if w not in wordtoix:
@@ -629,7 +676,9 @@ class EvalDataset_Final(data.Dataset):
 		ixtoword = {v: k for k, v in wordtoix.items()}
 
 		words = list(wordtoix.keys())
-		pretrained_emb = bc.encode(words)
+		pretrained_emb = encode_words(
+			encoder, words, cfg.TEXT.EMB_BATCH, cfg.TEXT.EMB_THREADS
+		)
 		train_captions_new = []
 		for t in train_captions:
 			rev = []
@@ -674,9 +723,10 @@ class EvalDataset_Final(data.Dataset):
 				  .format(len_, num, percent))
 
 	def load_text_data(self, data_dir, split):
-		captions_pkl = cfg.TEXT.CAPTIONS_PKL
-		assert captions_pkl != ''
-		filepath = os.path.join(data_dir, captions_pkl)
+		# keyed by dataset2.json and the tokenizer settings, stale caches
+		# simply are not found and get rebuilt
+		self.caption_key = caption_cache_key(data_dir)
+		filepath = caption_cache_path(data_dir, self.caption_key)
 
 		if not os.path.isfile(filepath):
 			train_captions = self.load_captions3('train')
@@ -687,19 +737,22 @@ class EvalDataset_Final(data.Dataset):
 			pretrained_emb = \
 				self.build_dictionary(train_captions, test_captions)
 
-			with open(filepath, 'wb') as f:
-				# pickle.dump([train_captions, test_captions,
-				#              ixtoword, wordtoix], f, protocol=2)
+			# float16 .npy next to the pickle, which only keeps its name
+			emb_path = save_word_emb(filepath, pretrained_emb)
+			pretrained_emb = load_word_emb(data_dir, os.path.basename(emb_path))
+			tmp_path = '%s.%d.tmp' % (filepath, os.getpid())
+			with open(tmp_path, 'wb') as f:
 				pickle.dump([train_captions, test_captions,
-							 ixtoword, wordtoix, pretrained_emb], f)
-				print('Save to: ', filepath)
+							 ixtoword, wordtoix, os.path.basename(emb_path)], f)
+			os.replace(tmp_path, filepath)
+			print('Save to: ', filepath)
 		else:
 			with open(filepath, 'rb') as f:
 				x = pickle.load(f, encoding='iso-8859-1')
 
 				train_captions, test_captions = x[0], x[1]
 				ixtoword, wordtoix = x[2], x[3]
-				pretrained_emb = x[4]
+				pretrained_emb = load_word_emb(data_dir, x[4])
 				del x
 				n_words = len(ixtoword)
 				if get_rank() == 0:
@@ -748,6 +801,38 @@ class EvalDataset_Final(data.Dataset):
 		return keynames
 
 
+	def load_caption_lists(self, data_dir, split):
+		self.data = self.load_data(data_dir) 
+		if split == 'train':
+			self.filenames = self.data[split]['filenames']
+			self.keys = self.data[split]['keynames']
+		else:
+			self.filenames, self.keys = [], []
+			for split in self.data.keys():
+				if split != 'train':
+					self.filenames += self.data[split]['filenames']
+					self.keys += self.data[split]['keynames']
+
+		# self.use_glove = cfg.TEXT.USE_GLOVE
+		self.captions, self.ixtoword, self.wordtoix, self.n_words, \
+			self.pretrained_emb = self.load_text_data(data_dir, split)
+		self.img_num = len(set(self.filenames))
+
+
+	def load_caption_store(self, split):
+		store = CaptionStore(cfg.TEXT.CAPTION_STORE, split)
+		self.filenames, self.keys = store.filenames, store.keys
+		self.captions = store.captions
+		self.caption_key = store.caption_key
+		self.ixtoword, self.wordtoix = store.ixtoword, store.wordtoix
+		self.n_words = len(self.ixtoword)
+		self.pretrained_emb = store.pretrained_emb
+		self.img_num = store.num_images
+		if get_rank() == 0:
+			print('Load captions from: %s' % cfg.TEXT.CAPTION_STORE)
+
+
+
 	def load_data(self, data_dir):
 		# dataset: {'train':{'filenames':[], 'captions':[], 'keynames':[]}, 'val':{}, 'test':{}}
 		data_path = os.path.join(data_dir, 'dataset2.json')
@@ -808,9 +893,15 @@ class EvalDataset_Final(data.Dataset):
 		new_sent_ix = self.embeddings_num*index + sent_ix
 
 		file = self.filenames[new_sent_ix]
+		if self.img_store is not None:
+			# uint8 CHW, same as the transform below
+			return self.img_store.get_tensor(file, normalize=False)
 
 		img_name = f'{self.data_dir}/{cfg.IMG_DIR}/{file}.jpg'
-		img = Image.open(img_name).convert('RGB')
+		img = Image.open(img_name)
+		if cfg.JPEG_DRAFT:
+			img.draft('RGB', (256, 256))
+		img = img.convert('RGB')
 		transform = self.transform
 
 		if transform is not None:
@@ -0,0 +1,75 @@
+# coding=utf-8
+"""Caption tokenization shared by the datasets and its versioned cache.
+
+The tokenized captions (plus dictionary) are cached next to
+cfg.TEXT.CAPTIONS_PKL under a name that carries a hash of dataset2.json,
+the tokenizer settings and the word-embedding backend, e.g.
+captions_BERT_mmceleba.3f2a9c01d4e5b6a7.pickle, so changing any of them
+rebuilds the cache instead of silently reusing it.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import hashlib
+from multiprocessing import Pool
+
+from miscc.config import cfg
+
+
+# bump TOKENIZER_VERSION whenever tokenize_caption changes behaviour
+TOKENIZER_VERSION = 1
+TOKEN_PATTERN = r'\w+'
+# same flags as nltk's RegexpTokenizer
+_token_re = re.compile(TOKEN_PATTERN, re.UNICODE | re.MULTILINE | re.DOTALL)
+
+
+def tokenize_caption(caption):
+	# picks out sequences of alphanumeric characters as tokens
+	# and drops everything else; None if nothing is left
+	cap = caption.replace("\ufffd\ufffd", " ")
+	tokens = _token_re.findall(cap.lower())
+	if len(tokens) == 0:
+		return None
+	tokens_new = []
+	for t in tokens:
+		t = t.encode('ascii', 'ignore').decode('ascii')
+		if len(t) > 0:
+			tokens_new.append(t)
+	return tokens_new
+
+
+def tokenize_captions(captions, workers=0):
+	if workers <= 1 or len(captions) < 10000:
+		return [tokenize_caption(cap) for cap in captions]
+	with Pool(workers) as pool:
+		return pool.map(tokenize_caption, captions, chunksize=2048)
+
+
+def file_digest(path, chunk_size=1 << 20):
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def tokenizer_settings():
+	return 'v%d|%s|lower|ascii' % (TOKENIZER_VERSION, TOKEN_PATTERN)
+
+
+def caption_cache_key(data_dir):
+	h = hashlib.sha1()
+	h.update(file_digest(os.path.join(data_dir, 'dataset2.json')).encode())
+	h.update(tokenizer_settings().encode())
+	# the word embeddings are cached alongside
+	h.update(('%s|%s' % (cfg.TEXT.EMB_BACKEND, cfg.TEXT.EMB_MODEL)).encode())
+	return h.hexdigest()[:16]
+
+
+def caption_cache_path(data_dir, key):
+	captions_pkl = cfg.TEXT.CAPTIONS_PKL
+	assert captions_pkl != ''
+	base, ext = os.path.splitext(captions_pkl)
+	return os.path.join(data_dir, '%s.%s%s' % (base, key, ext or '.pickle'))
@@ -0,0 +1,240 @@
+# coding=utf-8
+"""Columnar, memory-mapped caption store.
+
+Replaces the list-of-lists caption pickle and the per-caption filename /
+keyname lists of dataset2.json with flat numpy arrays, one directory per
+split ('train', and 'test' for every other split):
+
+	tokens.npy        int32  word indices of all captions, concatenated
+	offsets.npy       int64  caption i is tokens[offsets[i]:offsets[i + 1]]
+	cap2img.npy       int32  caption -> row of the image table
+	filenames.npy     str    deduplicated image table
+	keynames.npy      str
+	text.npy          uint8  utf-8 bytes of the original captions
+	text_offsets.npy  int64
+
+plus vocab.npy (ixtoword in index order), pretrained_emb.npy and
+meta.json (the caption cache key it was converted from) at the root;
+a store whose key differs from the current caption cache key of DATA_DIR
+is reported as stale. Stores converted before meta.json existed are keyed
+by a digest of their vocab and tokens.
+Everything is opened with mmap_mode, so forked DataLoader workers never
+copy it through refcount writes.
+
+	python -m miscc.caption_store --cfg cfg/mmceleba_trainer_fine.yml \
+		--out /PATH/TO/multi_model_celeba/captions_store
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import numpy as np
+if sys.version_info[0] == 2:
+	import cPickle as pickle
+else:
+	import pickle
+
+from miscc.config import cfg, cfg_from_file
+from miscc.caption_cache import caption_cache_key, caption_cache_path, file_digest
+from miscc.word_embedding import load_word_emb
+
+
+class Column(object):
+	"""Read-only sequence view, index -> getter(index)."""
+	def __init__(self, length, getter):
+		self.length = length
+		self.getter = getter
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += self.length
+		if not 0 <= index < self.length:
+			raise IndexError('index %d out of range' % index)
+		return self.getter(index)
+
+	def __iter__(self):
+		for i in range(self.length):
+			yield self.getter(i)
+
+
+class CaptionStore(object):
+	def __init__(self, root, split):
+		self.root = root
+		self.split = 'train' if split == 'train' else 'test'
+		self._arrays = {}
+
+		vocab = np.load(os.path.join(root, 'vocab.npy'))
+		self.ixtoword = {i: str(w) for i, w in enumerate(vocab)}
+		self.wordtoix = {w: i for i, w in self.ixtoword.items()}
+		self.caption_key = self.load_key()
+
+		self.num_captions = len(self.array('cap2img'))
+		self.num_images = len(self.array('filenames'))
+
+		self.captions = Column(self.num_captions, self.caption)
+		self.filenames = Column(self.num_captions, self.filename)
+		self.keys = Column(self.num_captions, self.key)
+		self.texts = Column(self.num_captions, self.caption_text)
+
+	def load_key(self):
+		meta_path = os.path.join(self.root, 'meta.json')
+		if not os.path.isfile(meta_path):
+			print('Warning: %s has no meta.json, its staleness is not checked' % self.root)
+			h = hashlib.sha1()
+			for name in ['vocab.npy', 'train/tokens.npy', 'test/tokens.npy']:
+				h.update(file_digest(os.path.join(self.root, name)).encode())
+			return 'store-' + h.hexdigest()[:16]
+		with open(meta_path, 'r') as f:
+			key = json.load(f).get('caption_key')
+		if os.path.isfile(os.path.join(cfg.DATA_DIR, 'dataset2.json')):
+			current = caption_cache_key(cfg.DATA_DIR)
+			if key != current:
+				print('Warning: %s was converted from captions %s, the current ones are %s; '
+					  'rebuild it with python -m miscc.caption_store' % (self.root, key, current))
+		return key
+
+	def __getstate__(self):
+		# workers started with spawn map the files themselves
+		state = self.__dict__.copy()
+		state['_arrays'] = {}
+		return state
+
+	def array(self, name):
+		if name not in self._arrays:
+			path = os.path.join(self.root, self.split, name + '.npy')
+			self._arrays[name] = np.load(path, mmap_mode='r')
+		return self._arrays[name]
+
+	@property
+	def pretrained_emb(self):
+		path = os.path.join(self.root, 'pretrained_emb.npy')
+		if not os.path.isfile(path):
+			return None
+		return np.load(path, mmap_mode='r')
+
+	def caption(self, index):
+		offsets = self.array('offsets')
+		return self.array('tokens')[offsets[index]:offsets[index + 1]]
+
+	def filename(self, index):
+		return str(self.array('filenames')[self.array('cap2img')[index]])
+
+	def key(self, index):
+		return str(self.array('keynames')[self.array('cap2img')[index]])
+
+	def caption_text(self, index):
+		offsets = self.array('text_offsets')
+		data = self.array('text')[offsets[index]:offsets[index + 1]]
+		return data.tobytes().decode('utf-8')
+
+
+def to_csr(sequences, dtype):
+	lengths = np.fromiter((len(s) for s in sequences), dtype=np.int64,
+						  count=len(sequences))
+	offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+	np.cumsum(lengths, out=offsets[1:])
+	values = np.fromiter(
+		(v for s in sequences for v in s), dtype=dtype, count=int(offsets[-1])
+	)
+	return values, offsets
+
+
+def split_columns(split_data, split):
+	filenames, keynames, captions = [], [], []
+	for name in split_data.keys():
+		if (split == 'train') == (name == 'train'):
+			filenames += split_data[name]['filenames']
+			keynames += split_data[name]['keynames']
+			captions += split_data[name]['captions']
+	return filenames, keynames, captions
+
+
+def write_split(out_dir, split_data, split, word_captions):
+	filenames, keynames, captions = split_columns(split_data, split)
+	assert len(word_captions) == len(filenames), \
+		'%s: %d tokenized captions for %d filenames' \
+		% (split, len(word_captions), len(filenames))
+
+	image_rows, images, keys = {}, [], []
+	cap2img = np.empty(len(filenames), dtype=np.int32)
+	for i, (name, key) in enumerate(zip(filenames, keynames)):
+		if name not in image_rows:
+			image_rows[name] = len(images)
+			images.append(name)
+			keys.append(key)
+		elif keys[image_rows[name]] != key:
+			raise ValueError('image %s has several keynames' % name)
+		cap2img[i] = image_rows[name]
+
+	tokens, offsets = to_csr(word_captions, np.int32)
+	text, text_offsets = to_csr(
+		[cap.encode('utf-8') for cap in captions], np.uint8
+	)
+
+	split_dir = os.path.join(out_dir, split)
+	os.makedirs(split_dir, exist_ok=True)
+	columns = {
+		'tokens': tokens,
+		'offsets': offsets,
+		'cap2img': cap2img,
+		'filenames': np.array(images),
+		'keynames': np.array(keys),
+		'text': text,
+		'text_offsets': text_offsets,
+	}
+	for name, value in columns.items():
+		np.save(os.path.join(split_dir, name + '.npy'), value)
+	print('%s: %d captions, %d images, %d tokens'
+		  % (split, len(cap2img), len(images), len(tokens)))
+
+
+def convert(json_path, captions_pkl, out_dir, caption_key):
+	with open(json_path, 'r') as f:
+		split_data = json.load(f)
+	with open(captions_pkl, 'rb') as f:
+		x = pickle.load(f, encoding='iso-8859-1')
+	train_captions, test_captions, ixtoword = x[0], x[1], x[2]
+	pretrained_emb = load_word_emb(os.path.dirname(captions_pkl), x[4])
+
+	os.makedirs(out_dir, exist_ok=True)
+	vocab = np.array([ixtoword[i] for i in range(len(ixtoword))])
+	np.save(os.path.join(out_dir, 'vocab.npy'), vocab)
+	if pretrained_emb is not None:
+		np.save(os.path.join(out_dir, 'pretrained_emb.npy'),
+				np.asarray(pretrained_emb))
+
+	write_split(out_dir, split_data, 'train', train_captions)
+	write_split(out_dir, split_data, 'test', test_captions)
+	with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+		json.dump({'caption_key': caption_key}, f)
+	print('Save to: ', out_dir)
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='build the columnar caption store')
+	parser.add_argument('--cfg', type=str, dest='cfg_file', required=True)
+	parser.add_argument('--data_dir', type=str, default='')
+	parser.add_argument('--out', type=str, required=True)
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = parse_args()
+	cfg_from_file(args.cfg_file)
+	if args.data_dir != '':
+		cfg.DATA_DIR = args.data_dir
+	caption_key = caption_cache_key(cfg.DATA_DIR)
+	convert(
+		os.path.join(cfg.DATA_DIR, 'dataset2.json'),
+		caption_cache_path(cfg.DATA_DIR, caption_key),
+		args.out,
+		caption_key,
+	)
@@ -0,0 +1,146 @@
+# coding=utf-8
+"""Checkpoints written off the training thread.
+
+save() copies the state dicts to CPU (pinned) memory with non-blocking
+copies queued on the current stream, so training can go on updating the
+weights; a background thread waits for the copies, torch.saves to a
+temporary file and renames it into place. link_best() points ckpt_best.pth
+at a checkpoint already written (hardlink, copy where links are not
+supported) instead of serializing the models a second time. With
+keep_last > 0 only the newest keep_last ckpt_<epoch>.pth files are kept;
+ckpt_best.pth is a separate link and survives its source being removed.
+A checkpoint saved with hold=True (still waiting for its FID, see
+miscc/evaluator.py) is not pruned until release()d.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import queue
+import atexit
+import shutil
+import threading
+
+import torch
+
+
+CKPT_PATTERN = re.compile(r'ckpt_(\d+)\.pth$')
+
+
+def to_host(obj):
+	# CPU copy of every tensor in a (nested) state dict
+	if torch.is_tensor(obj):
+		if obj.is_cuda:
+			host = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+			host.copy_(obj.detach(), non_blocking=True)
+			return host
+		return obj.detach().clone()
+	if isinstance(obj, dict):
+		return type(obj)((k, to_host(v)) for k, v in obj.items())
+	if isinstance(obj, (list, tuple)):
+		return type(obj)(to_host(v) for v in obj)
+	return obj
+
+
+def atomic_replace(write, path):
+	tmp = path + '.tmp'
+	try:
+		write(tmp)
+		os.replace(tmp, path)
+	finally:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+
+
+def link_or_copy(src, dst):
+	try:
+		os.link(src, dst)
+	except OSError:
+		shutil.copyfile(src, dst)
+
+
+class CheckpointWriter(object):
+	def __init__(self, model_dir, keep_last=0, best_name='ckpt_best.pth'):
+		self.model_dir = model_dir
+		self.keep_last = keep_last
+		self.best_path = os.path.join(model_dir, best_name)
+		self.error = None
+		# paths exempt from pruning, only touched by the worker thread
+		self.held = set()
+		self.queue = queue.Queue()
+		self.thread = threading.Thread(target=self.worker, daemon=True)
+		self.thread.start()
+		atexit.register(self.close)
+
+	def check(self):
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise RuntimeError('checkpoint write failed') from error
+
+	def save(self, state, path, hold=False):
+		self.check()
+		state = to_host(state)
+		event = None
+		if torch.cuda.is_available() and torch.cuda.is_initialized():
+			event = torch.cuda.Event()
+			event.record()
+		self.queue.put(('hold' if hold else 'save', path, state, event))
+
+	def link_best(self, path):
+		"""ckpt_best.pth --> path, once path has been written."""
+		self.check()
+		self.queue.put(('best', path, None, None))
+
+	def release(self, path, keep=True):
+		"""Lift hold on path; keep=False deletes it."""
+		self.queue.put(('release', path, keep, None))
+
+	def worker(self):
+		while True:
+			item = self.queue.get()
+			try:
+				if item is None:
+					return
+				kind, path, state, event = item
+				if kind in ('save', 'hold'):
+					if event is not None:
+						event.synchronize()
+					if kind == 'hold':
+						self.held.add(path)
+					atomic_replace(lambda tmp: torch.save(state, tmp), path)
+					self.prune()
+				elif kind == 'release':
+					self.held.discard(path)
+					if not state and os.path.exists(path):
+						os.remove(path)
+					self.prune()
+				else:
+					atomic_replace(lambda tmp: link_or_copy(path, tmp), self.best_path)
+			except Exception as e:
+				print('checkpoint: failed to write %s: %s' % (item[1], e))
+				self.error = e
+			finally:
+				self.queue.task_done()
+
+	def prune(self):
+		if self.keep_last <= 0:
+			return
+		ckpts = []
+		for name in os.listdir(self.model_dir):
+			match = CKPT_PATTERN.match(name)
+			if match and os.path.join(self.model_dir, name) not in self.held:
+				ckpts.append((int(match.group(1)), name))
+		for _, name in sorted(ckpts)[:-self.keep_last]:
+			os.remove(os.path.join(self.model_dir, name))
+
+	def wait(self):
+		"""Block until every queued checkpoint is on disk."""
+		self.queue.join()
+		self.check()
+
+	def close(self):
+		if self.thread is not None and self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join()
+		self.thread = None
@@ -0,0 +1,372 @@
+# coding=utf-8
+"""Offline CLIP tables over the fixed caption corpus.
+
+The captions never change during training, so their CLIP encodings are
+computed once per split and stored as memory-mapped .npy files under
+cfg.TEXT.CLIP_CACHE:
+
+	clip_sent_<split>.npy         [num_captions, 512] fp16 encode_text outputs
+	clip_tokens_<split>.npy       [num_captions, 77] int32 clip.tokenize ids
+	clip_clause_<split>.npy       [num_clauses, 512] fp16 embeddings of the
+	                              unique clauses, row 0 is the empty string
+	clip_clause_ids_<split>.npy   [num_captions, MAX_CLAUSES] int32 rows of
+	                              clip_clause, 0-padded
+	clip_clause_len_<split>.npy   [num_captions] int32 clauses per caption
+
+The FID prompts (one .txt per prompt in cfg.TEXT.EVAL_PROMPTS) are
+compiled the same way into one structured table, sorted by file name:
+
+	clip_prompts_<dir>.npy        [num_prompts] records of key (file name),
+	                              caps / cap_len (word indices), tokens
+	                              (CLIP ids) and emb (fp16 encode_text)
+
+Each table has a <table>.json sidecar recording the CLIP weights and the
+caption cache key it was built from; ensure_* rebuilds it on rank 0 when
+either changes.
+
+Captions are word indices into the dataset dictionary, so CLIP token ids
+are assembled from a per-word BPE table (word_token_table) by a tensor
+gather instead of detokenizing to strings and running the BPE again.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import json
+import hashlib
+
+import numpy as np
+import torch
+import clip
+from clip.simple_tokenizer import SimpleTokenizer
+
+from miscc.config import cfg
+from distributed import get_rank, synchronize
+
+
+MAX_CLAUSES = 20
+CONTEXT_LENGTH = 77
+_bpe = None
+
+
+def bpe_tokenizer():
+	global _bpe
+	if _bpe is None:
+		_bpe = SimpleTokenizer()
+	return _bpe
+
+
+def split_clauses(cap_ori):
+	# the clauses trainer_fine.split_captions matches regions against
+	return re.split('[,.]', cap_ori.replace('and', ''))[:-1][:MAX_CLAUSES]
+
+
+def clip_fingerprint(clip_model):
+	# cheap stand-in for hashing all weights: the text projection differs
+	# between every released CLIP model
+	proj = clip_model.text_projection.detach().float().cpu().numpy()
+	return hashlib.sha1(proj.tobytes()).hexdigest()[:16]
+
+
+def caption_text(caption, ixtoword):
+	# the string get_text_input builds for a caption, END padding removed
+	words = [ixtoword[int(ix)] for ix in caption[:cfg.TEXT.WORDS_NUM]]
+	return ' '.join(words).replace('END', '').strip()
+
+
+def table_path(name, split):
+	split = 'train' if split == 'train' else 'test'
+	return os.path.join(cfg.TEXT.CLIP_CACHE, 'clip_%s_%s.npy' % (name, split))
+
+
+def table_meta(dataset, clip_model, name):
+	return {
+		'table': name,
+		'clip': 'bpe' if clip_model is None else clip_fingerprint(clip_model),
+		'captions': dataset.caption_key,
+		'num_captions': len(dataset.captions),
+		'words_num': cfg.TEXT.WORDS_NUM,
+	}
+
+
+def table_is_fresh(path, meta):
+	if not os.path.isfile(path) or not os.path.isfile(path + '.json'):
+		return False
+	with open(path + '.json', 'r') as f:
+		return json.load(f) == meta
+
+
+def write_table(path, meta, shape, dtype, fill):
+	os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+	tmp_path = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+	out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+	fill(out)
+	out.flush()
+	del out
+	os.replace(tmp_path, path)
+	with open(path + '.json', 'w') as f:
+		json.dump(meta, f)
+	print('Save to: ', path)
+
+
+@torch.no_grad()
+def build_sent_table(dataset, clip_model, path, meta, device, batch_size=1024):
+	num = len(dataset.captions)
+	dim = clip_model.text_projection.shape[1]
+
+	def fill(out):
+		for start in range(0, num, batch_size):
+			end = min(start + batch_size, num)
+			texts = [
+				caption_text(dataset.captions[i], dataset.ixtoword)
+				for i in range(start, end)
+			]
+			tokens = clip.tokenize(texts, truncate=True).to(device)
+			out[start:end] = clip_model.encode_text(tokens).half().cpu().numpy()
+
+	write_table(path, meta, (num, dim), np.float16, fill)
+
+
+def word_token_table(ixtoword):
+	"""CLIP BPE ids of every dictionary word, [n_words, K] 0-padded, and
+	their counts; 'END' padding has none.
+
+	clip.tokenize splits on whitespace before BPE, so the tokens of a
+	caption are the concatenated tokens of its words.
+	"""
+	bpe = bpe_tokenizer()
+	words = [bpe.encode(ixtoword[i]) if ixtoword[i] != 'END' else []
+			 for i in range(len(ixtoword))]
+	lens = torch.tensor([len(w) for w in words], dtype=torch.long)
+	table = torch.zeros(len(words), max(1, int(lens.max())), dtype=torch.int32)
+	for i, w in enumerate(words):
+		table[i, :len(w)] = torch.tensor(w, dtype=torch.int32)
+	return table, lens
+
+
+def gather_clip_tokens(caps, word_tokens, word_lens, context_length=CONTEXT_LENGTH):
+	"""clip.tokenize(captions, truncate=True) for [bs, T] word indices."""
+	bpe = bpe_tokenizer()
+	bs = caps.size(0)
+	tokens = word_tokens[caps].flatten(1)                    # bs x T*K
+	k = torch.arange(word_tokens.size(1), device=caps.device)
+	valid = (k < word_lens[caps].unsqueeze(-1)).flatten(1)   # bs x T*K
+	# slot 0 is <|startoftext|>, the last kept slot is left for <|endoftext|>
+	pos = valid.long().cumsum(1)
+	keep = valid & (pos <= context_length - 2)
+	out = torch.zeros(bs, context_length + 1, dtype=torch.int32, device=caps.device)
+	out.scatter_(1, torch.where(keep, pos, torch.full_like(pos, context_length)), tokens)
+	out = out[:, :context_length]
+	out[:, 0] = bpe.encoder['<|startoftext|>']
+	n = keep.sum(1, keepdim=True)
+	out.scatter_(1, n + 1, bpe.encoder['<|endoftext|>'])
+	return out
+
+
+def build_token_table(dataset, path, meta, batch_size=4096):
+	num = len(dataset.captions)
+	word_tokens, word_lens = word_token_table(dataset.ixtoword)
+	words_num = cfg.TEXT.WORDS_NUM
+
+	def fill(out):
+		for start in range(0, num, batch_size):
+			end = min(start + batch_size, num)
+			caps = torch.zeros(end - start, words_num, dtype=torch.long)
+			for i in range(start, end):
+				cap = np.asarray(dataset.captions[i][:words_num], dtype=np.int64)
+				caps[i - start, :len(cap)] = torch.from_numpy(cap)
+			out[start:end] = gather_clip_tokens(caps, word_tokens, word_lens).numpy()
+
+	write_table(path, meta, (num, CONTEXT_LENGTH), np.int32, fill)
+
+
+def index_clauses(texts):
+	clause_rows = {'': 0}
+	ids = np.zeros((len(texts), MAX_CLAUSES), dtype=np.int32)
+	lens = np.zeros(len(texts), dtype=np.int32)
+	for i, text in enumerate(texts):
+		clauses = split_clauses(text)
+		lens[i] = len(clauses)
+		for j, clause in enumerate(clauses):
+			ids[i, j] = clause_rows.setdefault(clause, len(clause_rows))
+	# dicts keep insertion order, so list index == row
+	return list(clause_rows), ids, lens
+
+
+@torch.no_grad()
+def build_clause_tables(dataset, clip_model, paths, meta, device, batch_size=1024):
+	clauses, ids, lens = index_clauses(dataset.ori_caps)
+	dim = clip_model.text_projection.shape[1]
+
+	def fill(out):
+		for start in range(0, len(clauses), batch_size):
+			tokens = clip.tokenize(
+				clauses[start:start + batch_size], truncate=True
+			).to(device)
+			out[start:start + len(tokens)] = \
+				clip_model.encode_text(tokens).half().cpu().numpy()
+
+	# the embedding table goes last, its sidecar marks the set complete
+	for name, value in (('clause_ids', ids), ('clause_len', lens)):
+		def copy(out, value=value):
+			out[...] = value
+		write_table(paths[name], dict(meta, table=name), value.shape,
+					value.dtype, copy)
+	write_table(paths['clause'], meta, (len(clauses), dim), np.float16, fill)
+	print('%d captions, %d unique clauses' % (len(ids), len(clauses)))
+
+
+@torch.no_grad()
+def empty_clause_emb(clip_model, device):
+	return clip_model.encode_text(clip.tokenize(['']).to(device))
+
+
+@torch.no_grad()
+def encode_clauses(clip_model, cap_ori, device, empty_emb=None):
+	"""Runtime counterpart of the clause tables for captions outside them.
+
+	Encodes the distinct non-empty clauses of the whole batch with one
+	encode_text call and scatters them into [bs, MAX_CLAUSES, dim];
+	padding takes empty_emb. Returns the features and the clause counts.
+	"""
+	captions = [split_clauses(cap) for cap in cap_ori]
+	clause_rows = {}
+	# row 0 of the gathered table is the empty string
+	ids = np.zeros((len(captions), MAX_CLAUSES), dtype=np.int64)
+	for i, clauses in enumerate(captions):
+		for j, clause in enumerate(clauses):
+			if clause != '':
+				ids[i, j] = clause_rows.setdefault(clause, len(clause_rows) + 1)
+	if empty_emb is None:
+		empty_emb = empty_clause_emb(clip_model, device)
+	feats = [empty_emb]
+	if len(clause_rows) > 0:
+		tokens = clip.tokenize(list(clause_rows), truncate=True).to(device)
+		feats.append(clip_model.encode_text(tokens))
+	table = torch.cat(feats, 0).float()
+	return table[torch.from_numpy(ids).to(device)], [len(c) for c in captions]
+
+
+def ensure_token_table(dataset):
+	path = table_path('tokens', dataset.split)
+	meta = table_meta(dataset, None, 'tokens')
+	if get_rank() == 0 and not table_is_fresh(path, meta):
+		build_token_table(dataset, path, meta)
+	synchronize()
+	return np.load(path, mmap_mode='r')
+
+
+def ensure_sent_table(dataset, clip_model, device):
+	path = table_path('sent', dataset.split)
+	meta = table_meta(dataset, clip_model, 'sent')
+	if get_rank() == 0 and not table_is_fresh(path, meta):
+		build_sent_table(dataset, clip_model, path, meta, device)
+	synchronize()
+	return np.load(path, mmap_mode='r')
+
+
+def ensure_clause_tables(dataset, clip_model, device):
+	"""Returns (clause_emb, clause_ids, clause_len) for dataset.ori_caps."""
+	meta = table_meta(dataset, clip_model, 'clause')
+	meta['max_clauses'] = MAX_CLAUSES
+	names = ('clause', 'clause_ids', 'clause_len')
+	paths = {name: table_path(name, dataset.split) for name in names}
+	fresh = all(
+		table_is_fresh(paths[name], dict(meta, table=name)) for name in names
+	)
+	if get_rank() == 0 and not fresh:
+		build_clause_tables(dataset, clip_model, paths, meta, device)
+	synchronize()
+	return tuple(np.load(paths[name], mmap_mode='r') for name in names)
+
+
+PROMPT_WORDS = 30
+
+
+def prompt_caption(words, wordtoix):
+	# word indices as get_Text_From_TediGan_val30000 builds them: unknown
+	# words dropped, 0-padded to PROMPT_WORDS, the last slot of a full
+	# caption forced to 0
+	rev = [wordtoix[w] for w in words if w in wordtoix]
+	if len(rev) < PROMPT_WORDS:
+		return rev + [0] * (PROMPT_WORDS - len(rev)), len(rev)
+	rev = rev[:PROMPT_WORDS]
+	rev[-1] = 0
+	return rev, PROMPT_WORDS
+
+
+def prompt_bundle_path(prompt_dir):
+	prompt_dir = os.path.normpath(prompt_dir)
+	root = cfg.TEXT.CLIP_CACHE or os.path.dirname(prompt_dir)
+	return os.path.join(root, 'clip_prompts_%s.npy' % os.path.basename(prompt_dir))
+
+
+def prompt_bundle_meta(prompt_dir, wordtoix, clip_model):
+	# contents, not sizes: a word swap keeps the length; the prompts are
+	# short, hashing them at start-up costs one read each
+	files = hashlib.sha1()
+	names = sorted(os.listdir(prompt_dir))
+	for name in names:
+		with open(os.path.join(prompt_dir, name), 'rb') as f:
+			data = f.read()
+		files.update(('%s|%d\n' % (name, len(data))).encode())
+		files.update(data)
+	vocab = hashlib.sha1(json.dumps(sorted(wordtoix.items())).encode())
+	return {
+		'table': 'prompts',
+		'clip': clip_fingerprint(clip_model),
+		'prompts': files.hexdigest()[:16],
+		'vocab': vocab.hexdigest()[:16],
+		'num_prompts': len(names),
+		'words_num': PROMPT_WORDS,
+	}
+
+
+def prompt_dtype(key_len, dim):
+	return np.dtype([
+		('key', 'S%d' % key_len),
+		('caps', np.int32, (PROMPT_WORDS,)),
+		('cap_len', np.int32),
+		('tokens', np.int32, (CONTEXT_LENGTH,)),
+		('emb', np.float16, (dim,)),
+	])
+
+
+@torch.no_grad()
+def build_prompt_bundle(prompt_dir, wordtoix, ixtoword, clip_model, path, meta,
+						device, batch_size=1024):
+	names = sorted(os.listdir(prompt_dir))
+	caps = np.zeros((len(names), PROMPT_WORDS), dtype=np.int64)
+	lens = np.zeros(len(names), dtype=np.int32)
+	for i, name in enumerate(names):
+		with open(os.path.join(prompt_dir, name), 'r') as f:
+			caps[i], lens[i] = prompt_caption(f.read().split(' '), wordtoix)
+	keys = [name.encode() for name in names]
+	word_tokens, word_lens = word_token_table(ixtoword)
+	dim = clip_model.text_projection.shape[1]
+
+	def fill(out):
+		out['key'] = keys
+		out['caps'] = caps
+		out['cap_len'] = lens
+		for start in range(0, len(names), batch_size):
+			end = min(start + batch_size, len(names))
+			tokens = gather_clip_tokens(
+				torch.from_numpy(caps[start:end]), word_tokens, word_lens
+			)
+			out['tokens'][start:end] = tokens.numpy()
+			out['emb'][start:end] = \
+				clip_model.encode_text(tokens.to(device)).half().cpu().numpy()
+
+	key_len = max([1] + [len(key) for key in keys])
+	write_table(path, meta, (len(names),), prompt_dtype(key_len, dim), fill)
+
+
+def ensure_prompt_bundle(prompt_dir, wordtoix, ixtoword, clip_model, device):
+	path = prompt_bundle_path(prompt_dir)
+	meta = prompt_bundle_meta(prompt_dir, wordtoix, clip_model)
+	if get_rank() == 0 and not table_is_fresh(path, meta):
+		build_prompt_bundle(prompt_dir, wordtoix, ixtoword, clip_model, path, meta, device)
+	synchronize()
+	return np.load(path, mmap_mode='r')
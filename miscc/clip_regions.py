@@ -0,0 +1,112 @@
+# coding=utf-8
+"""Region features of generated images for words_loss_trainer_fine.
+
+	crop   num_crop random crops per sample, each encoded on its own
+	       (num_crop + 1 image forwards per step, with CLIPLoss)
+	patch  one CLIP ViT forward over the full image; the projected patch
+	       tokens are pooled to a sqrt(num_crop) x sqrt(num_crop) grid
+	       (2 image forwards per step). Not numerically the crop features,
+	       so crop stays the default until the two have been compared
+
+CLIPLoss encodes the full image with its own plain resize in both modes.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class ClipPreprocess(nn.Module):
+	"""Bicubic resize to size x size and CLIP mean/std normalization.
+
+	Both are linear and the interpolation weights sum to one, so the
+	normalization (one addcmul) runs at whichever resolution is smaller.
+	"""
+	def __init__(self, size=224):
+		super(ClipPreprocess, self).__init__()
+		self.size = size
+		std = torch.tensor(CLIP_STD).view(1, -1, 1, 1)
+		mean = torch.tensor(CLIP_MEAN).view(1, -1, 1, 1)
+		# (x - mean) / std == x * scale + shift
+		self.register_buffer('scale', 1. / std)
+		self.register_buffer('shift', -mean / std)
+
+	def normalize(self, image):
+		return torch.addcmul(self.shift.to(image.dtype), image, self.scale.to(image.dtype))
+
+	def forward(self, image):
+		h, w = image.size(-2), image.size(-1)
+		if h == self.size and w == self.size:
+			return self.normalize(image)
+		if h * w < self.size * self.size:
+			return F.interpolate(self.normalize(image), size=self.size, mode='bicubic')
+		return self.normalize(F.interpolate(image, size=self.size, mode='bicubic'))
+
+
+def encode_image_patches(clip_model, image):
+	"""clip_model.encode_image(image) plus its projected patch tokens.
+
+	Returns [bs, dim] and [bs, dim, grid, grid] (7 x 7 for ViT-B/32).
+	"""
+	visual = clip_model.visual
+	x = visual.conv1(image.type(clip_model.dtype))
+	grid = x.shape[-1]
+	# --> bs x grid*grid x width
+	x = x.reshape(x.shape[0], x.shape[1], -1).permute(0, 2, 1)
+	cls = visual.class_embedding.to(x.dtype) + torch.zeros(
+		x.shape[0], 1, x.shape[-1], dtype=x.dtype, device=x.device
+	)
+	x = torch.cat([cls, x], dim=1)
+	x = x + visual.positional_embedding.to(x.dtype)
+	x = visual.ln_pre(x)
+	x = visual.transformer(x.permute(1, 0, 2)).permute(1, 0, 2)
+	# encode_image applies ln_post and proj to the class token only
+	x = visual.ln_post(x) @ visual.proj
+	patches = x[:, 1:].transpose(1, 2).reshape(x.shape[0], -1, grid, grid)
+	return x[:, 0], patches
+
+
+def patch_regions(clip_model, image, num_crop):
+	"""image: CLIP-normalized bs x 3 x 224 x 224.
+
+	Returns the image embedding and bs x dim x sqrt(num_crop) x sqrt(num_crop)
+	region features, the layout crop_imgs produces.
+	"""
+	image_features, patches = encode_image_patches(clip_model, image)
+	side = int(pow(num_crop, 0.5))
+	regions = F.adaptive_avg_pool2d(patches.float(), side)
+	return image_features, regions
+
+
+def random_crops(imgs, num_crop, crop_size):
+	"""num_crop crops per sample, each at its own random offset, in a
+	single gather. Returns (bs*num_crop) x C x crop_size x crop_size,
+	sample-major (the crops of sample 0 first).
+	"""
+	bs, _, h, w = imgs.size()
+	device = imgs.device
+	n = bs * num_crop
+	top = torch.randint(0, h - crop_size + 1, (n, 1), device=device)
+	left = torch.randint(0, w - crop_size + 1, (n, 1), device=device)
+	steps = torch.arange(crop_size, device=device)[None, :]
+	rows = (top + steps)[:, :, None]
+	cols = (left + steps)[:, None, :]
+	samples = torch.arange(bs, device=device).repeat_interleave(num_crop)
+	# advanced indices around the channel slice --> n x crop x crop x C
+	crops = imgs[samples[:, None, None], :, rows, cols]
+	return crops.permute(0, 3, 1, 2)
+
+
+def crop_regions(region_feat, num_crop):
+	"""(bs*num_crop) x dim sample-major crop embeddings -->
+	bs x dim x sqrt(num_crop) x sqrt(num_crop).
+	"""
+	side = int(pow(num_crop, 0.5))
+	bs = region_feat.size(0) // num_crop
+	return region_feat.view(bs, side, side, -1).permute(0, 3, 1, 2)
@@ -14,7 +14,10 @@ __C.DATASET_NAME = ''
 __C.CONFIG_NAME = ''
 __C.DATA_DIR = ''
 __C.IMG_DIR = ''
-__C.MU_SIG = ''
+__C.IMG_STORE = ''  # uint8 store from miscc/image_store.py, '' = decode JPEGs
+__C.JPEG_DRAFT = True  # DCT-domain downscale while decoding JPEGs
+__C.MU_SIG = ''  # unused, see FID_REF_DIR
+__C.FID_REF_DIR = ''  # cached FID reference statistics, '' = DATA_DIR/fid_stats
 __C.GPU_ID = [0]
 __C.CUDA = True
 __C.WORKERS = 6
@@ -47,12 +50,24 @@ __C.TRAIN.NET_Adain_Mapper = ''
 __C.TRAIN.NET_INV = ''
 __C.TRAIN.B_NET_D = True
 __C.TRAIN.GRAD_ACCU_STEPS = 4
-__C.TRAIN.LOSS_REDUCTION = 'sum'
+__C.TRAIN.LOSS_REDUCTION = 'sum'  # 'sum' or 'mean' over the GRAD_ACCU_STEPS micro-batches
+__C.TRAIN.ACCU_CONTRASTIVE = False  # contrastive losses over all micro-batches (feature caching)
+# lazy regularization intervals in micro-batches (loader batches), rounded
+# down to whole optimizer steps; R1 and path length use one micro-batch
 __C.TRAIN.D_REG_EVERY = 16
 __C.TRAIN.G_REG_EVERY = 4
 __C.TRAIN.R1 = 10
 __C.TRAIN.PATH_BATCH_SHRINK = 2
 __C.TRAIN.PATH_REGULARIZE = 2
+__C.TRAIN.WORDS_LOSS_CHUNK = 0  # texts per pass of words_loss_trainer_fine, 0 = all
+__C.TRAIN.REGION_MODE = 'crop'  # 'crop' or 'patch', see miscc/clip_regions.py
+__C.TRAIN.AMP = ''  # '', 'fp16' or 'bf16', see miscc/train_utils.py
+__C.TRAIN.EMA_EVERY = 1  # g_ema update interval, see miscc/ema.py
+__C.TRAIN.EMA_CPU = False  # keep g_ema in CPU memory
+__C.TRAIN.CKPT_KEEP_LAST = 0  # newest ckpt_<epoch>.pth files kept, 0 = all
+__C.TRAIN.FID_DUMP_SAMPLES = 0  # generated images (and captions) kept per FID run
+__C.TRAIN.EVAL_ASYNC = False  # FID of a g_ema snapshot on a rank 0 thread, see miscc/evaluator.py
+__C.TRAIN.EVAL_QUEUE = 1  # snapshots waiting for the evaluator, the oldest is dropped beyond
 
 __C.TRAIN.SMOOTH = edict()
 __C.TRAIN.SMOOTH.GAMMA1 = 5.0
@@ -82,6 +97,13 @@ __C.TEXT.WORDS_NUM = 18
 
 __C.TEXT.USE_PRE_EMB = False
 __C.TEXT.CAPTIONS_PKL = ''
+__C.TEXT.CAPTION_STORE = ''  # columnar store from miscc/caption_store.py
+__C.TEXT.EMB_BACKEND = 'bert_client'  # 'bert_client', 'local' or 'stub'
+__C.TEXT.EMB_MODEL = 'bert-base-uncased'
+__C.TEXT.EMB_BATCH = 256
+__C.TEXT.EMB_THREADS = 4
+__C.TEXT.CLIP_CACHE = ''  # dir of the CLIP caption tables, see miscc/clip_cache.py
+__C.TEXT.EVAL_PROMPTS = '../valid_text_30000/'  # FID prompts, one .txt each
 
 
 def _merge_a_into_b(a, b):
@@ -0,0 +1,132 @@
+# coding=utf-8
+"""Exponential moving average of the generator (g_ema).
+
+The parameter and floating-point buffer lists of both models are captured
+once, and an update is one torch._foreach_mul_ / _foreach_add_ pair over
+them instead of a mul_/add_ per tensor.
+
+	every    update every k calls with the decay raised to the k-th power,
+	         the same horizon as per-step updates
+	offload  keep g_ema in CPU memory; the training weights are gathered
+	         into one persistent flat buffer and copied to pinned memory
+	         without waiting, the CPU update with that copy runs at the
+	         next update (or before g_ema is read), on_device() brings
+	         the model back to the training device for sampling and FID
+"""
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+
+import torch
+from torch._utils import _unflatten_dense_tensors
+
+
+def ema_tensors(model):
+	# parameters then floating buffers, the order both models share
+	tensors = [p.data for p in model.parameters()]
+	tensors += [b for b in model.buffers() if b.is_floating_point()]
+	return tensors
+
+
+class EMA(object):
+	def __init__(self, model, ema_model, every=1, offload=False):
+		self.model = model
+		self.ema_model = ema_model
+		self.every = max(1, every)
+		self.offload = offload
+		self.device = next(model.parameters()).device
+		self.num_updates = 0
+		# offload: flat device buffer, pinned copy of it, and the update
+		# waiting for that copy
+		self.flat = None
+		self.staging = None
+		self.event = None
+		self.pending = None
+		if offload:
+			self.ema_model.cpu()
+		self.capture()
+
+	def capture(self):
+		# Module.to() replaces buffer tensors, so the lists are rebuilt after a move
+		self.src = ema_tensors(self.model)
+		self.dst = ema_tensors(self.ema_model)
+		if len(self.src) != len(self.dst):
+			raise ValueError('EMA model does not match the trained model')
+
+	def stage(self):
+		# training weights -> pinned staging, queued on the current stream
+		if self.flat is None:
+			numel = sum(t.numel() for t in self.src)
+			self.flat = torch.empty(numel, dtype=self.src[0].dtype, device=self.device)
+			pin = self.device.type == 'cuda'
+			self.staging = torch.empty(numel, dtype=self.flat.dtype, pin_memory=pin)
+			self.staged = _unflatten_dense_tensors(self.staging, self.src)
+		torch.cat([t.reshape(-1) for t in self.src], out=self.flat)
+		self.staging.copy_(self.flat, non_blocking=True)
+		if self.device.type == 'cuda':
+			self.event = torch.cuda.Event()
+			self.event.record()
+
+	@torch.no_grad()
+	def finish(self):
+		"""Apply the offloaded update still waiting for its copy."""
+		if self.pending is None:
+			return
+		if self.event is not None:
+			self.event.synchronize()
+		decay, self.pending = self.pending, None
+		if decay == 0:
+			for dst, src in zip(self.dst, self.staged):
+				dst.copy_(src)
+			return
+		torch._foreach_mul_(self.dst, decay)
+		torch._foreach_add_(self.dst, self.staged, alpha=1 - decay)
+
+	@torch.no_grad()
+	def update(self, decay=0.999):
+		self.num_updates += 1
+		if self.num_updates % self.every:
+			return
+		decay = decay ** self.every
+		if self.offload:
+			self.finish()
+			self.stage()
+			self.pending = decay
+			return
+		torch._foreach_mul_(self.dst, decay)
+		torch._foreach_add_(self.dst, self.src, alpha=1 - decay)
+
+	@torch.no_grad()
+	def copy_(self):
+		# decay 0, only at start-up
+		if self.offload:
+			self.finish()
+			self.stage()
+			self.pending = 0
+			self.finish()
+			return
+		for dst, src in zip(self.dst, self.src):
+			dst.copy_(src)
+
+	@contextlib.contextmanager
+	def on_device(self):
+		"""g_ema on the training device for the duration of the block."""
+		if not self.offload:
+			yield self.ema_model
+			return
+		self.finish()
+		self.ema_model.to(self.device)
+		try:
+			yield self.ema_model
+		finally:
+			self.ema_model.cpu()
+			self.capture()
+
+	def state_dict(self):
+		self.finish()
+		return self.ema_model.state_dict()
+
+	def load_state_dict(self, state):
+		self.pending = None
+		self.ema_model.load_state_dict(state)
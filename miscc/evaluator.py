@@ -0,0 +1,102 @@
+# coding=utf-8
+"""FID evaluation off the training loop.
+
+submit() snapshots the g_ema state dict to CPU (pinned) memory with
+non-blocking copies, the same way CheckpointWriter.save() does, and puts
+it on a bounded queue; training goes on at once. A thread on rank 0 loads
+each snapshot into its own copy of the generator, runs evaluate(netG,
+epoch) on a side CUDA stream and hands the result to report(epoch,
+result, extra), which logs it and picks the best checkpoint. When the
+evaluator falls behind and depth snapshots are already waiting, the
+oldest is dropped (drop(epoch, extra)) to make room for the new one.
+A snapshot whose evaluate or report raises is logged and dropped the
+same way; training goes on.
+
+evaluate must not run collectives: the other ranks keep training.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import queue
+import atexit
+import threading
+import traceback
+import contextlib
+
+import torch
+
+from miscc.checkpoint import to_host
+
+
+class AsyncEvaluator(object):
+	def __init__(self, netG, evaluate, report, drop=None, depth=1):
+		self.netG = netG
+		self.evaluate = evaluate
+		self.report = report
+		self.drop = drop
+		self.device = next(netG.parameters()).device
+		self.queue = queue.Queue(maxsize=max(1, depth))
+		self.thread = threading.Thread(target=self.worker, daemon=True)
+		self.thread.start()
+		atexit.register(self.close)
+
+	def submit(self, epoch, state, extra=None):
+		state = to_host(state)
+		event = None
+		if torch.cuda.is_available() and torch.cuda.is_initialized():
+			event = torch.cuda.Event()
+			event.record()
+		item = (epoch, state, event, extra)
+		while True:
+			try:
+				self.queue.put_nowait(item)
+				return
+			except queue.Full:
+				pass
+			try:
+				stale = self.queue.get_nowait()
+			except queue.Empty:
+				continue
+			self.queue.task_done()
+			print('evaluator: behind, dropped the snapshot of epoch %d' % stale[0])
+			if self.drop is not None:
+				self.drop(stale[0], stale[3])
+
+	def worker(self):
+		stream = None
+		if self.device.type == 'cuda':
+			stream = torch.cuda.Stream(self.device)
+		while True:
+			item = self.queue.get()
+			try:
+				if item is None:
+					return
+				epoch, state, event, extra = item
+				if event is not None:
+					event.synchronize()
+				context = torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()
+				with torch.no_grad(), context:
+					self.netG.load_state_dict(state)
+					self.netG.eval()
+					result = self.evaluate(self.netG, epoch)
+				if stream is not None:
+					stream.synchronize()
+				self.report(epoch, result, extra)
+			except Exception as e:
+				# only rank 0 gets here, raising would leave the others in a collective
+				traceback.print_exc()
+				print('evaluator: epoch %d failed: %s' % (epoch, e))
+				if self.drop is not None:
+					self.drop(epoch, extra)
+			finally:
+				self.queue.task_done()
+
+	def wait(self):
+		"""Block until every queued snapshot is evaluated."""
+		self.queue.join()
+
+	def close(self):
+		if self.thread is not None and self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join()
+		self.thread = None
@@ -0,0 +1,109 @@
+# coding=utf-8
+"""Cached FID reference statistics (Inception mu / sigma of the real images).
+
+One .npz per split under cfg.FID_REF_DIR (default DATA_DIR/fid_stats),
+named by a key over the image set (sorted filenames plus file sizes, or
+the uint8 store it is read from), the image size and the feature
+extractor, e.g. fid_ref_test.3f2a9c01d4e5b6a7.npz. A changed dataset or
+extractor simply misses the cache and is rebuilt.
+
+	python -m miscc.fid_reference --cfg cfg/mmceleba_trainer_fine.yml \
+		--splits train test
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+import argparse
+
+import numpy as np
+
+from miscc.config import cfg, cfg_from_file
+from miscc.caption_cache import file_digest
+from miscc.image_store import store_index_path
+from calculate_fid import FEATURE_EXTRACTOR, dataset_statistics
+from distributed import get_rank, synchronize
+
+
+# EvalDataset_Final always yields 256x256 images
+REF_IMSIZE = 256
+
+
+def image_set_digest(dataset):
+	h = hashlib.sha1()
+	names = sorted(set(dataset.filenames))
+	h.update('\n'.join(names).encode())
+	if dataset.img_store is not None:
+		h.update(b'store')
+		h.update(file_digest(store_index_path(cfg.IMG_STORE)).encode())
+		h.update(str(os.path.getsize(cfg.IMG_STORE)).encode())
+	else:
+		# draft decoding changes the pixels
+		h.update(('jpeg|draft=%d' % bool(cfg.JPEG_DRAFT)).encode())
+		img_dir = f'{dataset.data_dir}/{cfg.IMG_DIR}'
+		for name in names:
+			h.update(str(os.path.getsize(f'{img_dir}/{name}.jpg')).encode())
+	return h.hexdigest()
+
+
+def reference_key(dataset):
+	h = hashlib.sha1()
+	h.update(image_set_digest(dataset).encode())
+	h.update(('%d|%s' % (REF_IMSIZE, FEATURE_EXTRACTOR)).encode())
+	return h.hexdigest()[:16]
+
+
+def reference_path(dataset):
+	ref_dir = cfg.FID_REF_DIR or os.path.join(cfg.DATA_DIR, 'fid_stats')
+	return os.path.join(ref_dir, 'fid_ref_%s.%s.npz' % (dataset.split, reference_key(dataset)))
+
+
+def build_reference(dataset, path, bs=64, device='cuda', num_workers=0):
+	stats = dataset_statistics(dataset, bs, device, num_workers)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	tmp_path = '%s.%d.tmp' % (path, os.getpid())
+	with open(tmp_path, 'wb') as f:
+		np.savez(f, mu=stats['mu'], sigma=stats['sigma'])
+	os.replace(tmp_path, path)
+	print('Save to: ', path)
+	return stats
+
+
+def reference_statistics(dataset, bs=64, device='cuda', num_workers=0):
+	"""mu / sigma of dataset's images, from the cache or built into it
+	by rank 0."""
+	path = reference_path(dataset)
+	if get_rank() == 0 and not os.path.isfile(path):
+		print('Build FID reference statistics: ', path)
+		build_reference(dataset, path, bs, device, num_workers)
+	synchronize()
+	with np.load(path) as f:
+		return {'mu': f['mu'], 'sigma': f['sigma']}
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='build the FID reference statistics')
+	parser.add_argument('--cfg', type=str, dest='cfg_file', required=True)
+	parser.add_argument('--data_dir', type=str, default='')
+	parser.add_argument('--splits', type=str, nargs='+', default=['train', 'test'])
+	parser.add_argument('--batch_size', type=int, default=64)
+	parser.add_argument('--workers', type=int, default=8)
+	parser.add_argument('--device', type=str, default='cuda')
+	parser.add_argument('--force', action='store_true')
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = parse_args()
+	cfg_from_file(args.cfg_file)
+	if args.data_dir != '':
+		cfg.DATA_DIR = args.data_dir
+	from datasets_fine import EvalDataset_Final
+	for split in args.splits:
+		dataset = EvalDataset_Final(cfg.DATA_DIR, split, base_size=REF_IMSIZE)
+		path = reference_path(dataset)
+		if os.path.isfile(path) and not args.force:
+			print('Up to date: ', path)
+			continue
+		build_reference(dataset, path, args.batch_size, args.device, args.workers)
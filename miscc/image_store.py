@@ -0,0 +1,157 @@
+# coding=utf-8
+"""Pre-decoded uint8 image store.
+
+Every image referenced by dataset2.json is decoded once, resized to
+cfg.TREE.BASE_SIZE and written into a single N x H x W x 3 uint8 .npy
+file, together with a json index mapping filename -> row. The datasets
+open it with np.load(mmap_mode) so all DataLoader workers share the same
+page cache; put the file on /dev/shm to also share it across the ranks
+of one node.
+
+	python -m miscc.image_store --cfg cfg/mmceleba_trainer_fine.yml \
+		--out /dev/shm/mmceleba_256.npy
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from miscc.config import cfg, cfg_from_file
+from distributed import get_rank
+
+
+def store_index_path(store_path):
+	return os.path.splitext(store_path)[0] + '_index.json'
+
+
+def collect_filenames(split_data):
+	# dataset2.json repeats each filename once per caption
+	filenames, seen = [], set()
+	for split in split_data:
+		for name in split_data[split]['filenames']:
+			if name not in seen:
+				seen.add(name)
+				filenames.append(name)
+	return filenames
+
+
+def _decode(job):
+	img_path, imsize = job
+	resize = transforms.Compose([
+		transforms.Resize(imsize),
+		transforms.CenterCrop(imsize),
+	])
+	img = Image.open(img_path).convert('RGB')
+	return np.asarray(resize(img), dtype=np.uint8)
+
+
+def pack_images(img_dir, filenames, imsize, out_path, workers=8):
+	jobs = [(f'{img_dir}/{name}.jpg', imsize) for name in filenames]
+	tmp_path = out_path + '.tmp.npy'
+	images = np.lib.format.open_memmap(
+		tmp_path, mode='w+', dtype=np.uint8,
+		shape=(len(jobs), imsize, imsize, 3)
+	)
+	with Pool(workers) as pool:
+		for i, img in enumerate(pool.imap(_decode, jobs, chunksize=64)):
+			images[i] = img
+			if (i + 1) % 10000 == 0:
+				print('packed %d/%d' % (i + 1, len(jobs)))
+	images.flush()
+	del images
+	os.replace(tmp_path, out_path)
+
+	with open(store_index_path(out_path), 'w') as f:
+		json.dump({'size': imsize, 'filenames': filenames}, f)
+	print('Save to: ', out_path)
+
+
+class ImageStore(object):
+	def __init__(self, path):
+		self.path = path
+		with open(store_index_path(path), 'r') as f:
+			index = json.load(f)
+		self.imsize = int(index['size'])
+		self.rows = {name: i for i, name in enumerate(index['filenames'])}
+		self._images = None
+
+	def __getstate__(self):
+		# workers started with spawn map the file themselves
+		state = self.__dict__.copy()
+		state['_images'] = None
+		return state
+
+	def __contains__(self, name):
+		return name in self.rows
+
+	@property
+	def images(self):
+		if self._images is None:
+			# copy-on-write mapping: pages stay shared, tensors are writable
+			self._images = np.load(self.path, mmap_mode='c')
+		return self._images
+
+	def get(self, name):
+		# H x W x 3 uint8 view into the mapping
+		return self.images[self.rows[name]]
+
+	def get_tensor(self, name, flip=False, normalize=True):
+		img = torch.from_numpy(self.get(name)).permute(2, 0, 1)
+		if flip:
+			img = img.flip(2)
+		if not normalize:
+			return img.contiguous()
+		# same as ToTensor() + Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+		return img.float().div_(127.5).sub_(1.)
+
+
+def load_image_store(imsize, bbox=None):
+	"""The store at cfg.IMG_STORE if it holds imsize images, else None."""
+	if cfg.IMG_STORE == '':
+		return None
+	if bbox is not None:
+		# the store keeps whole images, bbox crops happen at decode time
+		raise ValueError('IMG_STORE does not support bbox cropping, unset it for %s'
+						 % cfg.DATASET_NAME)
+	img_store = ImageStore(cfg.IMG_STORE)
+	if img_store.imsize != imsize:
+		if get_rank() == 0:
+			print('Skip image store %s: size %d != %d'
+				  % (cfg.IMG_STORE, img_store.imsize, imsize))
+		return None
+	if get_rank() == 0:
+		print('Load images from: %s' % cfg.IMG_STORE)
+	return img_store
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='pack images into a uint8 store')
+	parser.add_argument('--cfg', type=str, dest='cfg_file', required=True)
+	parser.add_argument('--data_dir', type=str, default='')
+	parser.add_argument('--out', type=str, required=True)
+	parser.add_argument('--size', type=int, default=0)
+	parser.add_argument('--workers', type=int, default=8)
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = parse_args()
+	cfg_from_file(args.cfg_file)
+	if args.data_dir != '':
+		cfg.DATA_DIR = args.data_dir
+	imsize = args.size if args.size > 0 else int(cfg.TREE.BASE_SIZE)
+
+	with open(os.path.join(cfg.DATA_DIR, 'dataset2.json'), 'r') as f:
+		filenames = collect_filenames(json.load(f))
+	pack_images(
+		f'{cfg.DATA_DIR}/{cfg.IMG_DIR}', filenames, imsize,
+		args.out, workers=args.workers
+	)
@@ -13,7 +13,8 @@ from distributed import (
 	get_world_size,
 )
 
-from GlobalAttention import func_attention
+from GlobalAttention import word_softmax
+from miscc.train_utils import scaled_grad
 from ipdb import set_trace
 
 # ##################Loss for matching text-image###################
@@ -72,62 +73,70 @@ def sent_loss(cnn_code, rnn_code, labels, class_ids,
 
 
 
+def words_similarity(img_features, words_emb, cap_lens, chunk_size=None):
+	"""
+		img_features(context): batch x nef x ih x iw
+		words_emb(query): batch x nef x seq_len, words past cap_lens[i] are padding
+		returns similarities(j, i) of the j-th image and i-th text, before GAMMA3,
+		and the attention of every text on its own image (1 x words_num x ih x iw)
+
+		All image-text pairs go through one masked attention; chunk_size bounds
+		the texts per pass (memory ~ batch x chunk_size x seq_len x ih*iw).
+	"""
+	batch_size, nef, seq_len = words_emb.size()
+	ih, iw = img_features.size(2), img_features.size(3)
+	gamma1, gamma2 = cfg.TRAIN.SMOOTH.GAMMA1, cfg.TRAIN.SMOOTH.GAMMA2
+	# fp32 for the norm below, the features themselves are small
+	context = img_features.reshape(batch_size, nef, ih * iw).float()
+	words = words_emb.float()
+	lens = torch.as_tensor([int(n) for n in cap_lens], device=words.device)
+	# text x seq_len
+	word_mask = torch.arange(seq_len, device=words.device)[None, :] < lens[:, None]
+	words_norm = torch.norm(words, 2, dim=1)
+	# weiContext = context @ attn, so its norm follows from the region Gram matrix
+	gram = torch.bmm(context.transpose(1, 2), context)
+
+	chunk_size = chunk_size or batch_size
+	similarities, att_maps = [], []
+	for start in range(0, batch_size, chunk_size):
+		end = min(start + chunk_size, batch_size)
+		mask = word_mask[start:end]
+		# Eq. (7): image x text x region x word
+		attn = torch.einsum('jds,idl->jisl', context, words[start:end])
+		# Eq. (8), over the words of each text only
+		attn1 = word_softmax(attn, ~mask[None, :, None, :])
+		# Eq. (9): image x text x word x region
+		attn2 = (attn1.transpose(2, 3) * gamma1).softmax(dim=-1)
+		# cosine_similarity(word, weiContext) without materializing weiContext
+		w12 = (attn2 * attn.transpose(2, 3)).sum(-1)
+		w2 = (torch.matmul(attn2, gram[:, None]) * attn2).sum(-1).clamp(min=0).sqrt()
+		row_sim = w12 / (words_norm[None, start:end] * w2).clamp(min=1e-8)
+		# Eq. (10), log-sum-exp over the real words
+		row_sim = (row_sim * gamma2).masked_fill(~mask[None], -float('inf'))
+		similarities.append(torch.logsumexp(row_sim, dim=-1))
+
+		for i in range(start, end):
+			words_num = int(lens[i])
+			att_maps.append(
+				attn2[i, i - start, :words_num].reshape(1, words_num, ih, iw)
+			)
+	# batch_size x batch_size
+	return torch.cat(similarities, 1), att_maps
+
+
 def words_loss_trainer_fine(img_features, words_emb, labels,
-			   cap_lens, class_ids, batch_size):
+			   cap_lens, class_ids, batch_size, chunk_size=None):
 	"""
 		words_emb(query): batch x nef x seq_len
 		img_features(context): batch x nef x 17 x 17
 	"""
-	masks = []
-	att_maps = []
-	similarities = []
-	cap_lens = cap_lens
-	for i in range(batch_size):
-		if class_ids is not None:
-			mask = (class_ids == class_ids[i]).astype(np.uint8)
-			mask[i] = 0
-			masks.append(mask.reshape((1, -1)))
-		# Get the i-th text description
-		words_num = cap_lens[i]
-		# -> 1 x nef x words_num
-		word = words_emb[i, :, :words_num].unsqueeze(0).contiguous()
-		# -> batch_size x nef x words_num
-		word = word.repeat(batch_size, 1, 1)
-		# batch x nef x 17*17
-		context = img_features
-		"""
-			word(query): batch x nef x words_num
-			context: batch x nef x 17 x 17
-			weiContext: batch x nef x words_num
-			attn: batch x words_num x 17 x 17
-		"""
-		weiContext, attn = func_attention(word, context, cfg.TRAIN.SMOOTH.GAMMA1)
-		att_maps.append(attn[i].unsqueeze(0).contiguous())
-		# --> batch_size x words_num x nef
-		word = word.transpose(1, 2).contiguous()
-		weiContext = weiContext.transpose(1, 2).contiguous()
-		# --> batch_size*words_num x nef
-		word = word.view(batch_size * words_num, -1)
-		weiContext = weiContext.view(batch_size * words_num, -1)
-		#
-		# -->batch_size*words_num
-		row_sim = cosine_similarity(word, weiContext)
-		# --> batch_size x words_num
-		row_sim = row_sim.view(batch_size, words_num)
-
-		# Eq. (10)
-		row_sim.mul_(cfg.TRAIN.SMOOTH.GAMMA2).exp_()
-		row_sim = row_sim.sum(dim=1, keepdim=True)
-		row_sim = torch.log(row_sim)
-
-		# --> 1 x batch_size
-		# similarities(i, j): the similarity between the i-th image and the j-th text description
-		similarities.append(row_sim)
-
-	# batch_size x batch_size
-	similarities = torch.cat(similarities, 1)
+	similarities, att_maps = words_similarity(
+		img_features[:batch_size], words_emb[:batch_size],
+		cap_lens[:batch_size], chunk_size
+	)
 	if class_ids is not None:
-		masks = np.concatenate(masks, 0)
+		masks = (class_ids[None, :] == class_ids[:, None]).astype(np.uint8)
+		np.fill_diagonal(masks, 0)
 		# masks: batch_size x batch_size
 		masks = torch.ByteTensor(masks)
 		if cfg.CUDA:
@@ -292,11 +301,9 @@ def d_logistic_loss(netD, real_img, fake_img,
 	return d_loss, real_pred, fake_pred
 
 	
-def d_r1_loss(netD, real_img, c_code=None):
+def d_r1_loss(netD, real_img, c_code=None, scaler=None):
 	real_pred, _ = netD(real_img)
-	grad_real, = autograd.grad(
-		outputs=real_pred.sum(), inputs=real_img, create_graph=True
-	)
+	grad_real, = scaled_grad(real_pred.float().sum(), [real_img], scaler)
 	grad_penalty = grad_real.pow(2).reshape(grad_real.shape[0], -1).sum(1).mean()
 	
 	return grad_penalty, real_pred
@@ -335,14 +342,14 @@ def pixel_g_nonsaturating_loss(
 	return g_loss
 
 
-def g_path_regularize(fake_img, latents, mean_path_length, decay=0.01):
+def g_path_regularize(fake_img, latents, mean_path_length, decay=0.01, scaler=None):
+	# fp32 throughout, call it outside autocast
+	fake_img = fake_img.float()
 	noise = torch.randn_like(fake_img) / math.sqrt(
 		fake_img.shape[2] * fake_img.shape[3]
 	)
 
-	grad, = autograd.grad(
-		outputs=(fake_img * noise).sum(), inputs=latents, create_graph=True
-	)
+	grad, = scaled_grad((fake_img * noise).sum(), [latents], scaler)
 
 	path_lengths = torch.sqrt(grad.pow(2).sum(2).mean(1))
 
@@ -374,11 +381,21 @@ class CLIPLoss(torch.nn.Module):
 		# self.avg_pool = torch.nn.AvgPool2d(kernel_size=32)
 		self.preprocess = transforms.Resize([224, 224])
 
-	def forward(self, image, text, labels):
+	def forward(self, image, text, labels, image_features=None, text_features=None):
 		# image = self.avg_pool(self.upsample(image))
 		# similarity = 1 - self.model(image, text)[0] / 100
-		image = self.preprocess(image)
-		logits_per_image, logits_per_text = self.model(image, text)
+		# same logits as self.model(image, text), but either side can come
+		# precomputed: image_features from clip_regions.patch_regions,
+		# text_features from the encode_text the trainer already ran
+		if image_features is None:
+			image_features = self.model.encode_image(self.preprocess(image))
+		if text_features is None:
+			text_features = self.model.encode_text(text)
+		text_features = text_features.to(image_features.dtype)
+		image_features = image_features / image_features.norm(dim=1, keepdim=True)
+		text_features = text_features / text_features.norm(dim=1, keepdim=True)
+		logit_scale = self.model.logit_scale.exp()
+		logits_per_image = logit_scale * image_features @ text_features.t()
 		loss = nn.CrossEntropyLoss()(logits_per_image, labels)
 		return loss
 
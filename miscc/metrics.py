@@ -0,0 +1,162 @@
+# coding=utf-8
+"""Training losses summed on the device and reported once per window.
+
+Metrics.add() folds a dict of scalar tensors into running sums with one
+torch._foreach_add_ and never reads them back; the EXTREMA keys keep a
+running min / max instead. Metrics.flush(), called by every rank every
+display_gap steps, all-reduces the window's sums in one collective (and
+the extrema in a second) and copies the results to pinned host memory
+without waiting; a background thread on rank 0 waits for the copy, prints
+the window and writes it to TensorBoard. wait() blocks until the thread
+has reported everything flushed, so last holds the reduced values of the
+latest window. close(step), on every rank at the end of training, flushes
+the last partial window.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import queue
+import atexit
+import threading
+
+import torch
+from torch import distributed as dist
+
+from distributed import get_rank, get_world_size
+
+
+# loss_dict key --> TensorBoard tag under loss/, in print order
+LOSS_TAGS = {
+	'd': 'Discriminator',
+	'clip': 'CLIP LOSS',
+	'loss_word0': 'CLIP word0_LOSS',
+	'loss_word1': 'CLIP word1_LOSS',
+	'g': 'Generator',
+	'r1': 'R1',
+	'path': 'Path Length Regularization',
+	'mean_path': 'Mean Path Length',
+	'real_score': 'Real Score',
+	'fake_score': 'Fake Score',
+	'path_length': 'Path Length',
+}
+
+# reduced over steps and ranks with min / max instead of the mean
+EXTREMA = {'fake_min': min, 'fake_max': max}
+
+
+class Metrics(object):
+	def __init__(self, device, writer=None):
+		self.device = torch.device(device)
+		self.writer = writer
+		self.sums = {}
+		self.counts = {}
+		self.extrema = {}
+		# values of the last window printed, for the per-epoch summary
+		self.last = {}
+		self.queue = queue.Queue()
+		self.thread = None
+		if get_rank() == 0:
+			self.thread = threading.Thread(target=self.worker, daemon=True)
+			self.thread.start()
+			atexit.register(self.close)
+
+	def add(self, values):
+		keys = [key for key in values if key not in EXTREMA]
+		for key in keys:
+			if key not in self.sums:
+				self.sums[key] = torch.zeros((), device=self.device)
+				self.counts[key] = 0
+			self.counts[key] += 1
+		torch._foreach_add_(
+			[self.sums[key] for key in keys],
+			[torch.as_tensor(values[key], device=self.device).detach().float() for key in keys]
+		)
+		for key in values:
+			if key in EXTREMA:
+				value = torch.as_tensor(values[key], device=self.device).detach().float()
+				if key in self.extrema:
+					combine = torch.minimum if EXTREMA[key] is min else torch.maximum
+					value = combine(self.extrema[key], value)
+				self.extrema[key] = value
+
+	def flush(self, step, header=''):
+		"""Reduce and hand the window to the logging thread; no host sync."""
+		if not self.sums and not self.extrema:
+			return
+		keys = sorted(self.sums)
+		world_size = get_world_size()
+		results = []
+		if keys:
+			sums = torch.stack([self.sums[key] for key in keys])
+			if world_size > 1:
+				dist.all_reduce(sums, op=dist.ReduceOp.SUM)
+			counts = torch.tensor([self.counts[key] * world_size for key in keys], dtype=torch.float)
+			results.append(sums / counts.to(self.device))
+		ext_keys = sorted(self.extrema)
+		if ext_keys:
+			# minima negated, so one MAX reduction covers both
+			signs = torch.tensor(
+				[-1. if EXTREMA[key] is min else 1. for key in ext_keys], device=self.device
+			)
+			extrema = torch.stack([self.extrema[key] for key in ext_keys]) * signs
+			if world_size > 1:
+				dist.all_reduce(extrema, op=dist.ReduceOp.MAX)
+			results.append(extrema * signs)
+		keys += ext_keys
+		self.sums, self.counts, self.extrema = {}, {}, {}
+		if self.thread is None:
+			return
+		values = torch.cat(results)
+		host = torch.empty(values.shape, dtype=values.dtype, pin_memory=self.device.type == 'cuda')
+		host.copy_(values, non_blocking=True)
+		event = None
+		if self.device.type == 'cuda':
+			event = torch.cuda.Event()
+			event.record()
+		self.queue.put((step, header, keys, host, event))
+
+	def worker(self):
+		while True:
+			item = self.queue.get()
+			try:
+				if item is None:
+					break
+				step, header, keys, host, event = item
+				if event is not None:
+					event.synchronize()
+				values = dict(zip(keys, host.tolist()))
+				self.last = values
+				self.report(step, header, values)
+			finally:
+				self.queue.task_done()
+
+	def wait(self):
+		"""Block until every flushed window is reported."""
+		if self.thread is not None:
+			self.queue.join()
+
+	def report(self, step, header, values):
+		if header:
+			print(header)
+		print(''.join(
+			f'{key}: {values[key]:.4f}; ' for key in LOSS_TAGS if key in values
+		))
+		if 'fake_min' in values:
+			print('[%.4f, %.4f]' % (values['fake_min'], values['fake_max']))
+		print('-' * 40)
+		if self.writer is not None:
+			for key, tag in LOSS_TAGS.items():
+				if key in values:
+					self.writer.add_scalar(f'loss/{tag}', values[key], step)
+
+	def close(self, step=None):
+		"""Flush the last window if step is given (a collective, every
+		rank calls it), then drain the logging thread."""
+		if step is not None:
+			self.flush(step)
+		if self.thread is not None:
+			self.queue.put(None)
+			self.thread.join()
+			self.thread = None
+		if self.writer is not None:
+			self.writer.flush()
@@ -0,0 +1,170 @@
+# coding=utf-8
+"""Mixed precision for the trainers, selected by cfg.TRAIN.AMP:
+
+	''    fp32, autocast and scaling disabled
+	fp16  autocast to float16, one GradScaler for G and one for D
+	bf16  autocast to bfloat16, no scaling (also runs on CPU)
+
+Gradient penalties (d_r1_loss, g_path_regularize) take the network's
+scaler to scale the output before autograd.grad and unscale the result.
+
+Gradient accumulation over cfg.TRAIN.GRAD_ACCU_STEPS micro-batches uses
+sync_context to skip the DDP all-reduce on all but the last one, and
+RandState to replay a micro-batch forward with the same noise and crops
+when the contrastive losses are computed on cached features.
+
+GANParams holds the G and D parameter lists for the per-step
+requires_grad flips and gradient clearing, make_adam builds the fused
+(or foreach) Adam both trainers use.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import inspect
+import contextlib
+
+import torch
+from torch.cuda.amp import GradScaler
+from torch.nn.parallel import DistributedDataParallel
+
+from miscc.config import cfg
+
+
+AMP_DTYPES = {
+	'': None,
+	'fp16': torch.float16,
+	'bf16': torch.bfloat16,
+}
+
+
+class Amp(object):
+	def __init__(self, mode, device):
+		if mode not in AMP_DTYPES:
+			raise ValueError('unknown TRAIN.AMP mode: %s' % mode)
+		self.mode = mode
+		self.dtype = AMP_DTYPES[mode]
+		self.device_type = 'cuda' if str(device).startswith('cuda') else 'cpu'
+		if mode == 'fp16' and self.device_type != 'cuda':
+			raise ValueError('TRAIN.AMP fp16 needs a CUDA device, use bf16 on CPU')
+		# separate scalers, an overflow in D must not skip G steps
+		self.scaler_g = GradScaler(enabled=mode == 'fp16')
+		self.scaler_d = GradScaler(enabled=mode == 'fp16')
+
+	def autocast(self):
+		return torch.autocast(
+			self.device_type, dtype=self.dtype or torch.float32,
+			enabled=self.dtype is not None
+		)
+
+	def backward(self, scaler, loss):
+		scaler.scale(loss).backward()
+
+	def step(self, scaler, optimizer):
+		scaler.step(optimizer)
+		scaler.update()
+
+	def backward_step(self, scaler, loss, optimizer):
+		self.backward(scaler, loss)
+		self.step(scaler, optimizer)
+
+	def state_dict(self):
+		return {
+			'scaler_g': self.scaler_g.state_dict(),
+			'scaler_d': self.scaler_d.state_dict(),
+		}
+
+	def load_state_dict(self, state):
+		self.scaler_g.load_state_dict(state['scaler_g'])
+		self.scaler_d.load_state_dict(state['scaler_d'])
+
+
+def scaled_grad(output, inputs, scaler=None):
+	"""autograd.grad(output, inputs, create_graph=True) in fp32, computed
+	from scaler.scale(output) so fp16 gradients do not underflow."""
+	if scaler is not None:
+		output = scaler.scale(output)
+	grads = torch.autograd.grad(outputs=output, inputs=inputs, create_graph=True)
+	grads = [g.float() for g in grads]
+	if scaler is not None:
+		# an overflow leaves inf in the penalty and scaler.step skips the update
+		inv_scale = 1. / scaler.get_scale()
+		grads = [g * inv_scale for g in grads]
+	return grads
+
+
+def loss_scale(accu_steps):
+	# cfg.TRAIN.LOSS_REDUCTION: 'mean' averages the micro-batch gradients,
+	# 'sum' adds them up
+	if cfg.TRAIN.LOSS_REDUCTION == 'mean':
+		return 1. / accu_steps
+	elif cfg.TRAIN.LOSS_REDUCTION == 'sum':
+		return 1.
+	raise ValueError('unknown TRAIN.LOSS_REDUCTION: %s' % cfg.TRAIN.LOSS_REDUCTION)
+
+
+def sync_context(model, micro_step, accu_steps):
+	"""model.no_sync() for all but the last micro-batch of a DDP model."""
+	if isinstance(model, DistributedDataParallel) and micro_step < accu_steps - 1:
+		return model.no_sync()
+	return contextlib.nullcontext()
+
+
+class RandState(object):
+	"""CPU and CUDA RNG state at construction, replay() runs a block
+	from it without disturbing the global generators."""
+	def __init__(self, device):
+		device = torch.device(device)
+		self.cuda = device.type == 'cuda'
+		self.devices = [device] if self.cuda else []
+		self.cpu_state = torch.get_rng_state()
+		self.cuda_state = torch.cuda.get_rng_state(device) if self.cuda else None
+
+	@contextlib.contextmanager
+	def replay(self):
+		with torch.random.fork_rng(devices=self.devices):
+			torch.set_rng_state(self.cpu_state)
+			if self.cuda:
+				torch.cuda.set_rng_state(self.cuda_state, self.devices[0])
+			yield
+
+
+def make_adam(params, lr, betas):
+	"""optim.Adam with the fused CUDA kernel when this torch has it and
+	every parameter is on a GPU, the foreach implementation otherwise."""
+	params = list(params)
+	supported = inspect.signature(torch.optim.Adam).parameters
+	kwargs = {}
+	if 'fused' in supported and all(p.is_cuda for p in params):
+		kwargs['fused'] = True
+	elif 'foreach' in supported:
+		kwargs['foreach'] = True
+	return torch.optim.Adam(params, lr=lr, betas=betas, **kwargs)
+
+
+class GANParams(object):
+	"""G and D parameter lists captured once; train_d()/train_g() set
+	requires_grad for the coming step and clear the stale gradients."""
+	def __init__(self, g_module, d_module, optimG, optimD):
+		self.g_params = list(g_module.parameters())
+		self.d_params = list(d_module.parameters())
+		self.optimG = optimG
+		self.optimD = optimD
+		self.training = None
+
+	def set_requires_grad(self, params, flag):
+		for p in params:
+			p.requires_grad_(flag)
+
+	def train_d(self):
+		if self.training != 'd':
+			self.set_requires_grad(self.g_params, False)
+			self.set_requires_grad(self.d_params, True)
+			self.training = 'd'
+		self.optimD.zero_grad(set_to_none=True)
+
+	def train_g(self):
+		if self.training != 'g':
+			self.set_requires_grad(self.g_params, True)
+			self.set_requires_grad(self.d_params, False)
+			self.training = 'g'
+		self.optimG.zero_grad(set_to_none=True)
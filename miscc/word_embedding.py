@@ -0,0 +1,115 @@
+# coding=utf-8
+"""Word-embedding backends for build_dictionary.
+
+	bert_client  the bert-serving server (needs a running bert-serving-start)
+	local        in-process BERT via transformers, pooled like bert-serving's
+	             defaults (mean over the second-to-last layer)
+	stub         deterministic pseudo-random vectors, for machines without
+	             BERT weights; tools/bert_stub_server.py serves the same
+	             vectors over the bert-serving protocol to test bert_client
+
+The vocabulary is encoded in fixed-size batches across a thread pool and
+stored as a float16 .npy next to the caption cache, which the datasets
+open with mmap_mode instead of unpickling.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+class BertClientEncoder(object):
+	# BertClient is not thread-safe, every pool thread opens its own
+	def __init__(self, **client_kwargs):
+		self.client_kwargs = client_kwargs
+		self.local = threading.local()
+
+	def encode(self, words):
+		if not hasattr(self.local, 'bc'):
+			from bert_serving.client import BertClient
+			self.local.bc = BertClient(**self.client_kwargs)
+		return self.local.bc.encode(words)
+
+
+class LocalBertEncoder(object):
+	def __init__(self, model_name='bert-base-uncased', max_seq_len=25, device='cpu'):
+		from transformers import BertModel, BertTokenizerFast
+		self.tokenizer = BertTokenizerFast.from_pretrained(model_name)
+		self.model = BertModel.from_pretrained(model_name).to(device).eval()
+		self.max_seq_len = max_seq_len
+		self.device = device
+		# fast tokenizers refuse concurrent calls
+		self.lock = threading.Lock()
+
+	@torch.no_grad()
+	def encode(self, words):
+		with self.lock:
+			batch = self.tokenizer(
+				words, padding=True, truncation=True,
+				max_length=self.max_seq_len, return_tensors='pt'
+			)
+		batch = batch.to(self.device)
+		out = self.model(**batch, output_hidden_states=True)
+		hidden = out.hidden_states[-2]
+		mask = batch['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+		emb = (hidden * mask).sum(1) / mask.sum(1)
+		return emb.float().cpu().numpy()
+
+
+class StubEncoder(object):
+	def __init__(self, dim=768):
+		self.dim = dim
+
+	def encode(self, words):
+		out = np.empty((len(words), self.dim), dtype=np.float32)
+		for i, word in enumerate(words):
+			seed = int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:4], 'little')
+			out[i] = np.random.RandomState(seed).standard_normal(self.dim)
+		return out
+
+
+def get_word_encoder(backend, model_name='bert-base-uncased'):
+	if backend == 'bert_client':
+		return BertClientEncoder()
+	elif backend == 'local':
+		device = 'cuda' if torch.cuda.is_available() else 'cpu'
+		return LocalBertEncoder(model_name, device=device)
+	elif backend == 'stub':
+		return StubEncoder()
+	raise ValueError('unknown word embedding backend: %s' % backend)
+
+
+def encode_words(encoder, words, batch_size=256, threads=4):
+	batches = [words[i:i + batch_size] for i in range(0, len(words), batch_size)]
+	if threads <= 1 or len(batches) == 1:
+		embs = [encoder.encode(batch) for batch in batches]
+	else:
+		# map keeps the batch order
+		with ThreadPoolExecutor(threads) as pool:
+			embs = list(pool.map(encoder.encode, batches))
+	return np.concatenate([np.asarray(e) for e in embs], 0).astype(np.float16)
+
+
+def word_emb_path(captions_path):
+	return os.path.splitext(captions_path)[0] + '_emb.npy'
+
+
+def save_word_emb(captions_path, pretrained_emb):
+	emb_path = word_emb_path(captions_path)
+	tmp_path = '%s.%d.tmp.npy' % (emb_path[:-4], os.getpid())
+	np.save(tmp_path, pretrained_emb.astype(np.float16))
+	os.replace(tmp_path, emb_path)
+	return emb_path
+
+
+def load_word_emb(data_dir, pretrained_emb):
+	# new caches store the .npy name, older ones the array itself
+	if isinstance(pretrained_emb, str):
+		return np.load(os.path.join(data_dir, pretrained_emb), mmap_mode='r')
+	return pretrained_emb
@@ -282,7 +282,8 @@ class ModulatedConv2d(nn.Module):
 		# weight = self.scale * self.weight
 
 		if self.demodulate:
-			demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
+			# in fp32, the 1e-8 underflows in half precision
+			demod = torch.rsqrt(weight.float().pow(2).sum([2, 3, 4]) + 1e-8).to(weight.dtype)
 			weight = weight * demod.view(batch, self.out_channel, 1, 1, 1)
 
 		weight = weight.view(
@@ -0,0 +1,156 @@
+# Loss-curve parity of TRAIN.AMP against fp32 on a short synthetic run.
+#
+#   python -m tools.bench_amp --amp bf16 --device cpu --steps 100
+#   python -m tools.bench_amp --amp fp16 --device cuda
+#
+# A small text-conditioned G built from the shipped ModulatedConv2d
+# (model.py and tools.blocks, no up/downsampling) and a conv D are
+# trained on random images with the trainers' D step, R1, G step and path-length
+# regularization (same losses, same Amp helper), once in fp32 and once in
+# the requested mode, from the same seed and data. Prints smoothed D/G
+# losses side by side and exits non-zero if the curves drift apart by
+# more than --tol (mean relative difference of the moving averages).
+import sys
+import math
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from miscc.losses import d_logistic_loss, d_r1_loss, g_path_regularize
+from miscc.losses import pixel_g_nonsaturating_loss
+from miscc.train_utils import Amp
+from model import ModulatedConv2d
+from tools import blocks
+
+
+class TinyG(nn.Module):
+    def __init__(self, text_dim=32, style_dim=64, channels=32, size=16):
+        super().__init__()
+        self.mapping = nn.Sequential(
+            nn.Linear(text_dim, style_dim), nn.LeakyReLU(0.2),
+            nn.Linear(style_dim, style_dim),
+        )
+        self.const = nn.Parameter(torch.randn(1, channels, size, size))
+        # the shipped modulated convs without up/downsampling: model.py's
+        # and the tools.blocks one the Generator's StyledConv / ToRGB use
+        self.conv1 = ModulatedConv2d(channels, channels, 3, style_dim)
+        self.conv2 = blocks.ModulatedConv2d(channels, channels, 3, style_dim)
+        self.to_rgb = blocks.ModulatedConv2d(channels, 3, 1, style_dim, demodulate=False)
+
+    def forward(self, states, return_latents=False):
+        # one latent per layer, like the Generator's, for the path regularizer
+        latents = self.mapping(states).unsqueeze(1).repeat(1, 3, 1)
+        x = self.const.repeat(states.size(0), 1, 1, 1)
+        x = F.leaky_relu(self.conv1(x, latents[:, 0]), 0.2)
+        x = F.leaky_relu(self.conv2(x, latents[:, 1]), 0.2)
+        img = torch.tanh(self.to_rgb(x, latents[:, 2]))
+        # the trainers' Generator returns (img, mu, logvar, latents)
+        return img, None, None, latents if return_latents else None
+
+
+class TinyD(nn.Module):
+    def __init__(self, channels=32):
+        super().__init__()
+        self.net = nn.Sequential(
+            nn.Conv2d(3, channels, 3, padding=1), nn.LeakyReLU(0.2),
+            nn.Conv2d(channels, channels, 4, stride=2, padding=1), nn.LeakyReLU(0.2),
+            nn.Conv2d(channels, channels, 4, stride=2, padding=1), nn.LeakyReLU(0.2),
+            nn.Flatten(), nn.Linear(channels * 16, 1),
+        )
+
+    def forward(self, img, c_code=None):
+        return self.net(img), None
+
+
+def run(mode, device, steps, seed, batch_size=16, d_reg_every=4, g_reg_every=4):
+    torch.manual_seed(seed)
+    netG, netD = TinyG().to(device), TinyD().to(device)
+    optimG = torch.optim.Adam(netG.parameters(), lr=2e-3, betas=(0., 0.99))
+    optimD = torch.optim.Adam(netD.parameters(), lr=2e-3, betas=(0., 0.99))
+    amp = Amp(mode, device)
+    data = torch.Generator().manual_seed(seed + 1)
+    mean_path_length = 0
+    curves = {'d': [], 'g': [], 'r1': [], 'path': []}
+    for step in range(steps):
+        real_img = (torch.rand(batch_size, 3, 16, 16, generator=data) * 2 - 1).to(device)
+        states = torch.randn(batch_size, 32, generator=data).to(device)
+
+        with amp.autocast():
+            fake_img, _, _, _ = netG(states)
+            loss_d, _, _ = d_logistic_loss(netD, real_img, fake_img.detach())
+        netD.zero_grad()
+        amp.backward_step(amp.scaler_d, loss_d, optimD)
+        curves['d'].append(loss_d.item())
+
+        if step % d_reg_every == 0:
+            real_img.requires_grad = True
+            with amp.autocast():
+                r1_loss, real_pred = d_r1_loss(netD, real_img, scaler=amp.scaler_d)
+                loss_r1 = 10 / 2 * r1_loss * d_reg_every + 0 * real_pred[0]
+            netD.zero_grad()
+            amp.backward_step(amp.scaler_d, loss_r1, optimD)
+            curves['r1'].append(r1_loss.item())
+
+        with amp.autocast():
+            fake_img, _, _, _ = netG(states)
+            loss_g = pixel_g_nonsaturating_loss(netD, real_img, fake_img, states, None)
+        netG.zero_grad()
+        amp.backward_step(amp.scaler_g, loss_g, optimG)
+        curves['g'].append(loss_g.item())
+
+        if step % g_reg_every == 0:
+            with amp.autocast():
+                pl_img, _, _, pl_latents = netG(states[:batch_size // 2], return_latents=True)
+            path_loss, mean_path_length, _ = g_path_regularize(
+                pl_img, pl_latents, mean_path_length, scaler=amp.scaler_g)
+            netG.zero_grad()
+            amp.backward_step(amp.scaler_g, 2 * g_reg_every * path_loss, optimG)
+            curves['path'].append(path_loss.item())
+    return curves
+
+
+def smooth(values, window):
+    out, acc = [], 0.
+    for i, v in enumerate(values):
+        acc += v
+        if i >= window:
+            acc -= values[i - window]
+        out.append(acc / min(i + 1, window))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--amp', type=str, default='bf16', choices=['fp16', 'bf16'])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--window', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tol', type=float, default=0.1)
+    args = parser.parse_args()
+
+    ref = run('', args.device, args.steps, args.seed)
+    new = run(args.amp, args.device, args.steps, args.seed)
+
+    ok = True
+    for key in ('d', 'g', 'r1', 'path'):
+        a, b = smooth(ref[key], args.window), smooth(new[key], args.window)
+        rel = sum(abs(x - y) for x, y in zip(a, b)) / max(sum(abs(x) for x in a), 1e-12)
+        finite = all(math.isfinite(v) for v in new[key])
+        ok = ok and finite and rel <= args.tol
+        print(f'{key:>5}: fp32 end {a[-1]:.4f}  {args.amp} end {b[-1]:.4f}  '
+              f'mean rel diff {rel:.3f}{"" if finite else "  NON-FINITE"}')
+    print(f'{"step":>6} {"d fp32":>8} {"d " + args.amp:>8} {"g fp32":>8} {"g " + args.amp:>8}')
+    d_ref, d_new = smooth(ref['d'], args.window), smooth(new['d'], args.window)
+    g_ref, g_new = smooth(ref['g'], args.window), smooth(new['g'], args.window)
+    for step in range(0, args.steps, max(1, args.steps // 10)):
+        print(f'{step:>6} {d_ref[step]:>8.4f} {d_new[step]:>8.4f} '
+              f'{g_ref[step]:>8.4f} {g_new[step]:>8.4f}')
+    print('parity ok' if ok else 'PARITY FAILED')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Training throughput with FID evaluation in the loop against
+# miscc.evaluator.AsyncEvaluator, on a small synthetic run.
+#
+#   python -m tools.bench_async_eval --epochs 6 --steps 50 --samples 2048
+#
+# A small G (tools.bench_amp.TinyG) is trained with an EMA copy; at every
+# epoch end the g_ema statistics (calculate_fid.generate_statistics, a
+# seeded random extractor from tools.bench_fid_shard) are computed either
+# inline or by the evaluator thread from a snapshot. Prints wall time,
+# evaluated and dropped epochs, and exits non-zero if any snapshot the
+# evaluator kept gives statistics different from the inline run.
+import sys
+import time
+import argparse
+
+import torch
+
+from calculate_fid import generate_statistics
+from miscc.ema import EMA
+from miscc.evaluator import AsyncEvaluator
+from tools.bench_amp import TinyG
+from tools.bench_fid_shard import RandomExtractor
+
+
+def train(args, device, on_epoch):
+    torch.manual_seed(args.seed)
+    netG, g_ema = TinyG().to(device), TinyG().to(device)
+    ema = EMA(netG, g_ema)
+    ema.copy_()
+    optim = torch.optim.Adam(netG.parameters(), lr=1e-3)
+    for epoch in range(args.epochs):
+        for _ in range(args.steps):
+            fake, _, _, _ = netG(torch.randn(args.batch_size, 32, device=device))
+            loss = fake.square().mean()
+            optim.zero_grad(set_to_none=True)
+            loss.backward()
+            optim.step()
+            ema.update(0.99)
+        on_epoch(epoch, g_ema)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--epochs', type=int, default=6)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--samples', type=int, default=2048)
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tol', type=float, default=1e-8)
+    args = parser.parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    extractor = RandomExtractor().to(device).eval()
+    prompts = torch.randn(args.samples, 32, generator=torch.Generator().manual_seed(args.seed))
+
+    def evaluate(netG, epoch):
+        return generate_statistics(
+            netG, lambda begin, end: prompts[begin:end].to(device), args.samples,
+            args.batch_size, device, extractor=extractor, dim=64, shard=False,
+        )
+
+    inline = {}
+
+    def on_epoch_inline(epoch, g_ema):
+        g_ema.eval()
+        inline[epoch] = evaluate(g_ema, epoch)
+
+    start = time.perf_counter()
+    train(args, device, on_epoch_inline)
+    inline_time = time.perf_counter() - start
+
+    kept, dropped = {}, []
+    evaluator = AsyncEvaluator(
+        TinyG().to(device), evaluate,
+        lambda epoch, stats, extra: kept.__setitem__(epoch, stats),
+        lambda epoch, extra: dropped.append(epoch), depth=args.depth,
+    )
+    start = time.perf_counter()
+    train(args, device, lambda epoch, g_ema: evaluator.submit(epoch, g_ema.state_dict()))
+    train_time = time.perf_counter() - start
+    evaluator.wait()
+    async_time = time.perf_counter() - start
+    evaluator.close()
+
+    diff = max(
+        max(abs(inline[e]['mu'] - stats['mu']).max(), abs(inline[e]['sigma'] - stats['sigma']).max())
+        for e, stats in kept.items()
+    )
+    ok = diff <= args.tol and args.epochs - 1 in kept
+
+    print(f'device {device}, {args.epochs} epochs x {args.steps} steps, {args.samples} samples per eval')
+    print(f'{"":>8} {"train s":>8} {"total s":>8}')
+    print(f'{"inline":>8} {inline_time:>8.2f} {inline_time:>8.2f}')
+    print(f'{"async":>8} {train_time:>8.2f} {async_time:>8.2f}')
+    print(f'evaluated epochs {sorted(kept)}, dropped {dropped}')
+    print(f'statistics max |d| {diff:.2e}')
+    print('equivalent' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Memory footprint of the caption lists vs. the columnar caption store
+# under forked DataLoader workers.
+#
+#   python -m tools.bench_caption_store --cfg cfg/mmceleba_trainer_fine.yml \
+#       --store /PATH/TO/multi_model_celeba/captions_store
+#
+# For 1/4/8 workers it iterates the train set and reports the summed PSS
+# (proportional set size, shared pages split between processes) and the
+# private dirty memory of the main process plus all workers.
+import argparse
+
+import torch
+from torch.utils import data
+
+from miscc.config import cfg, cfg_from_file
+
+
+def read_rollup(pid):
+    stats = {}
+    with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                stats[fields[0].rstrip(':')] = int(fields[1])
+    return stats
+
+
+def measure(dataset, workers, batches, batch_size):
+    loader = data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=True,
+        num_workers=workers, drop_last=True,
+    )
+    it = iter(loader)
+    for _ in range(batches):
+        next(it)
+    pids = ['self'] + [w.pid for w in it._workers]
+    pss = private = 0
+    for pid in pids:
+        stats = read_rollup(pid)
+        pss += stats.get('Pss', 0)
+        private += stats.get('Private_Dirty', 0)
+    del it
+    return pss / 1024., private / 1024.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, dest='cfg_file', required=True)
+    parser.add_argument('--store', type=str, required=True)
+    parser.add_argument('--fine', action='store_true',
+                        help='use datasets_fine instead of datasets_coarse')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parser.parse_args()
+    cfg_from_file(args.cfg_file)
+    if args.fine:
+        from datasets_fine import TextDataset
+    else:
+        from datasets_coarse import TextDataset
+
+    torch.multiprocessing.set_start_method('fork', force=True)
+    print(f'{"mode":>8} {"workers":>8} {"PSS MiB":>10} {"private MiB":>12}')
+    for mode, store in (('lists', ''), ('store', args.store)):
+        cfg.TEXT.CAPTION_STORE = store
+        dataset = TextDataset(cfg.DATA_DIR, 'train', base_size=cfg.TREE.BASE_SIZE)
+        for workers in args.workers:
+            pss, private = measure(dataset, workers, args.batches, args.batch_size)
+            print(f'{mode:>8} {workers:>8} {pss:>10.1f} {private:>12.1f}')
+        del dataset
+
+
+if __name__ == '__main__':
+    main()
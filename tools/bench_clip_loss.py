@@ -0,0 +1,85 @@
+# Parity check of CLIPLoss with precomputed text features against the
+# full CLIP forward (self.model(image, text)) it used to run, plus timing.
+#
+#   python -m tools.bench_clip_loss --batch_size 16
+#
+# Compares the loss and the gradient w.r.t. the images; exits non-zero
+# if either differs by more than --tol (relative).
+import sys
+import time
+import argparse
+
+import clip
+import torch
+import torch.nn as nn
+from torchvision import transforms
+
+from miscc.losses import CLIPLoss
+
+
+def reference_loss(model, image, text, labels):
+    # the old CLIPLoss.forward
+    image = transforms.Resize([224, 224])(image)
+    logits_per_image, _ = model(image, text)
+    return nn.CrossEntropyLoss()(logits_per_image, labels)
+
+
+def loss_and_grad(fn, image):
+    image.grad = None
+    loss = fn()
+    loss.backward()
+    return loss.detach().float(), image.grad.detach().float().clone()
+
+
+def timeit(fn, iters, device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--img_size', type=int, default=256)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--tol', type=float, default=1e-2)
+    args = parser.parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+
+    model, _ = clip.load('ViT-B/32', device=device)
+    model.eval()
+    clip_loss = CLIPLoss(model)
+    bs = args.batch_size
+    image = torch.randn(bs, 3, args.img_size, args.img_size, device=device, requires_grad=True)
+    words = ['woman', 'man', 'black hair', 'smiling', 'blond', 'beard', 'glasses', 'young']
+    text = clip.tokenize([f'a {words[i % len(words)]} photo {i}' for i in range(bs)]).to(device)
+    labels = torch.arange(bs, device=device)
+    with torch.no_grad():
+        # what the trainers pass in, states = encode_text(texts).float()
+        text_features = model.encode_text(text).float()
+
+    ref = lambda: reference_loss(model, image, text, labels)
+    new = lambda: clip_loss(image, text, labels, text_features=text_features)
+    ref_loss, ref_grad = loss_and_grad(ref, image)
+    new_loss, new_grad = loss_and_grad(new, image)
+    loss_d = ((ref_loss - new_loss).abs() / ref_loss.abs()).item()
+    grad_d = ((ref_grad - new_grad).norm() / ref_grad.norm()).item()
+
+    ref_ms = timeit(lambda: loss_and_grad(ref, image), args.iters, device)
+    new_ms = timeit(lambda: loss_and_grad(new, image), args.iters, device)
+    print(f'loss  ref {ref_loss.item():.6f}  new {new_loss.item():.6f}  rel |d| {loss_d:.2e}')
+    print(f'grad  rel |d| {grad_d:.2e}')
+    print(f'time  ref {ref_ms:.2f} ms  new {new_ms:.2f} ms  {ref_ms / new_ms:.2f}x')
+    ok = max(loss_d, grad_d) <= args.tol
+    print('equivalent' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
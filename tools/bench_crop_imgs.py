@@ -0,0 +1,100 @@
+# Region sampling + CLIP preprocessing in trainer_fine.crop_imgs: the old
+# per-crop RandomCrop / torch.cat loop and clip_normalize against
+# random_crops and ClipPreprocess, for num_crop 4, 9 and 16.
+#
+#   python -m tools.bench_crop_imgs --batch_size 16 --img_size 256
+#
+# Only the image side is timed (no CLIP forward). The old crop feature
+# assembly loop runs on random [bs*num_crop, 512] features. Also checks
+# that ClipPreprocess matches clip_normalize on the same crops and that
+# both layouts agree.
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+from miscc.clip_regions import ClipPreprocess, random_crops, crop_regions, CLIP_MEAN, CLIP_STD
+
+
+def clip_normalize(image):
+    image = F.interpolate(image, size=224, mode='bicubic')
+    mean = torch.tensor(CLIP_MEAN).to(image.device).view(1, -1, 1, 1)
+    std = torch.tensor(CLIP_STD).to(image.device).view(1, -1, 1, 1)
+    return (image - mean) / std
+
+
+def old_crop_imgs(imgs, num_crop, cropper, feat):
+    bs = imgs.size(0)
+    img_proc = torch.cat([cropper(imgs) for _ in range(num_crop)], dim=0)
+    img_proc = clip_normalize(img_proc)
+    # feat stands in for encode_image(img_proc)
+    out = feat[:bs].unsqueeze(1)
+    for i in range(num_crop - 1):
+        out = torch.cat((out, feat[(i + 1) * bs:(i + 2) * bs].unsqueeze(1)), dim=1)
+    side = int(num_crop ** 0.5)
+    return img_proc, out.reshape(bs, -1, side, feat.size(1)).permute(0, 3, 1, 2)
+
+
+def new_crop_imgs(imgs, num_crop, crop_size, preprocess, feat):
+    img_proc = preprocess(random_crops(imgs, num_crop, crop_size))
+    return img_proc, crop_regions(feat, num_crop)
+
+
+def timeit(fn, iters, device):
+    fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--img_size', type=int, default=256)
+    parser.add_argument('--crop_size', type=int, default=128)
+    parser.add_argument('--num_crops', type=int, nargs='+', default=[4, 9, 16])
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--tol', type=float, default=1e-4)
+    args = parser.parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+
+    preprocess = ClipPreprocess(224).to(device)
+    cropper = transforms.RandomCrop(args.crop_size)
+    imgs = torch.rand(args.batch_size, 3, args.img_size, args.img_size, device=device) * 2 - 1
+
+    # preprocessing parity on identical crops
+    crops = random_crops(imgs, 4, args.crop_size)
+    pre_d = (clip_normalize(crops) - preprocess(crops)).abs().max().item()
+    full_d = (clip_normalize(imgs) - preprocess(imgs)).abs().max().item()
+    ok = max(pre_d, full_d) <= args.tol
+    print(f'ClipPreprocess vs clip_normalize: crops |d| {pre_d:.2e}, full |d| {full_d:.2e}')
+
+    print(f'{"crops":>6} {"old ms":>8} {"new ms":>8} {"speedup":>8} {"layout":>7}')
+    for num_crop in args.num_crops:
+        feat = torch.randn(args.batch_size * num_crop, 512, device=device)
+        _, old_regions = old_crop_imgs(imgs, num_crop, cropper, feat)
+        # the old loop is crop-major, random_crops sample-major
+        sample_major = feat.view(num_crop, args.batch_size, -1).transpose(0, 1).reshape(-1, 512)
+        _, new_regions = new_crop_imgs(imgs, num_crop, args.crop_size, preprocess, sample_major)
+        same = torch.equal(old_regions, new_regions)
+        ok = ok and same
+        old_ms = timeit(lambda: old_crop_imgs(imgs, num_crop, cropper, feat), args.iters, device)
+        new_ms = timeit(lambda: new_crop_imgs(
+            imgs, num_crop, args.crop_size, preprocess, sample_major), args.iters, device)
+        print(f'{num_crop:>6} {old_ms:>8.2f} {new_ms:>8.2f} {old_ms / new_ms:>7.2f}x '
+              f'{"ok" if same else "DIFF":>7}')
+    print('equivalent' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# g_ema update: the old per-parameter condGANTrainer.accumulate against
+# miscc.ema.EMA (foreach, optionally strided / CPU-offloaded).
+#
+#   python -m tools.bench_ema --size 256 --iters 50
+#
+# Checks that EMA(every=1) matches accumulate on the real Generator and
+# that every=k tracks it closely on a slowly moving model and that the
+# offloaded (one update late, applied by finish()) copy ends up identical,
+# then times one update of each mode.
+import sys
+import copy
+import time
+import argparse
+
+import torch
+
+from miscc.ema import EMA
+from model import Generator
+
+
+def accumulate(model1, model2, decay=0.999):
+    # the old trainer method
+    par1 = dict(model1.named_parameters())
+    par2 = dict(model2.named_parameters())
+    for k in par1.keys():
+        par1[k].data.mul_(decay).add_(par2[k].data, alpha=1 - decay)
+
+
+def max_diff(model1, model2):
+    return max((p1.detach().cpu() - p2.detach().cpu()).abs().max().item()
+               for p1, p2 in zip(model1.parameters(), model2.parameters()))
+
+
+def perturb(model, scale):
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p) * scale)
+
+
+def timeit(fn, iters, device):
+    fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--iters', type=int, default=50)
+    parser.add_argument('--every', type=int, default=4)
+    parser.add_argument('--tol', type=float, default=1e-5)
+    args = parser.parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    decay = 0.5 ** (32 / (10 * 1000))
+
+    netG = Generator(args.size).to(device)
+    ref, ema_model = copy.deepcopy(netG), copy.deepcopy(netG)
+    ema = EMA(netG, ema_model)
+    cpu_ema = EMA(netG, copy.deepcopy(netG), offload=True)
+    for _ in range(20):
+        perturb(netG, 1e-3)
+        accumulate(ref, netG, decay)
+        ema.update(decay)
+        cpu_ema.update(decay)
+    exact = max_diff(ref, ema_model)
+    cpu_ema.finish()
+    offload = max_diff(ref, cpu_ema.ema_model)
+
+    # strided: the model drifts slowly, the k-step update should follow
+    ref, ema_model = copy.deepcopy(netG), copy.deepcopy(netG)
+    ema = EMA(netG, ema_model, every=args.every)
+    for _ in range(20 * args.every):
+        perturb(netG, 1e-5)
+        accumulate(ref, netG, decay)
+        ema.update(decay)
+    strided = max_diff(ref, ema_model)
+    ok = exact <= args.tol and offload <= args.tol and strided <= 1e-3
+    print(f'every=1 max |d| {exact:.2e}   offload max |d| {offload:.2e}   '
+          f'every={args.every} max |d| {strided:.2e}')
+
+    modes = [('foreach', {}), (f'every={args.every}', {'every': args.every})]
+    if device == 'cuda':
+        modes.append(('offload', {'offload': True}))
+    ref_ms = timeit(lambda: accumulate(ref, netG, decay), args.iters, device)
+    print(f'{"mode":>12} {"ms/step":>8} {"speedup":>8}')
+    print(f'{"accumulate":>12} {ref_ms:>8.3f} {1:>7.2f}x')
+    for name, kwargs in modes:
+        ema = EMA(netG, copy.deepcopy(netG), **kwargs)
+        ms = timeit(lambda: ema.update(decay), args.iters, device)
+        print(f'{name:>12} {ms:>8.3f} {ref_ms / ms:>7.2f}x')
+    print('equivalent' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
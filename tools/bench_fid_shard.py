@@ -0,0 +1,93 @@
+# Sharded FID generation (calculate_fid.generate_statistics) against a
+# single-process run, on CPU with the gloo backend.
+#
+#   python -m tools.bench_fid_shard --world_size 4 --samples 512
+#
+# A small text-conditioned G (tools.bench_amp.TinyG) generates from fixed
+# random prompt embeddings and a seeded random conv net stands in for
+# Inception, so no weights are downloaded. Every rank generates its shard;
+# the statistics after the single all_reduce must match the unsharded mu
+# and sigma. Prints wall time per world size.
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from torch import distributed as dist
+
+from calculate_fid import generate_statistics
+from tools.bench_amp import TinyG
+
+
+class RandomExtractor(nn.Module):
+    # uint8 images -> (features,), like FeatureExtractorInceptionV3
+    def __init__(self, dim=64):
+        super().__init__()
+        self.net = nn.Sequential(
+            nn.Conv2d(3, 32, 3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(32, dim, 3, stride=2, padding=1), nn.AdaptiveAvgPool2d(1),
+        )
+
+    def forward(self, images):
+        return (self.net(images.float() / 255.).flatten(1),)
+
+
+def run(args):
+    torch.manual_seed(args.seed)
+    model, extractor = TinyG().eval(), RandomExtractor(args.dim).eval()
+    prompts = torch.randn(args.samples, 32, generator=torch.Generator().manual_seed(args.seed))
+    start = time.perf_counter()
+    stats = generate_statistics(
+        model, lambda begin, end: prompts[begin:end], args.samples, args.batch_size,
+        device='cpu', extractor=extractor, dim=args.dim,
+    )
+    return stats, time.perf_counter() - start
+
+
+def worker(rank, args, out_path):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(args.port))
+    dist.init_process_group('gloo', rank=rank, world_size=args.world_size)
+    torch.set_num_threads(1)
+    stats, elapsed = run(args)
+    if rank == 0:
+        torch.save({'stats': stats, 'time': elapsed}, out_path)
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--world_size', type=int, default=4)
+    parser.add_argument('--samples', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=29511)
+    parser.add_argument('--tol', type=float, default=1e-8)
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    ref, ref_time = run(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = os.path.join(tmp, 'stats.pt')
+        mp.spawn(worker, args=(args, out_path), nprocs=args.world_size)
+        result = torch.load(out_path)
+    stats = result['stats']
+    mu_d = abs(ref['mu'] - stats['mu']).max()
+    sigma_d = abs(ref['sigma'] - stats['sigma']).max() / max(abs(ref['sigma']).max(), 1e-12)
+    ok = mu_d <= args.tol and sigma_d <= args.tol
+
+    print(f'{"ranks":>6} {"time s":>8} {"speedup":>8}')
+    print(f'{1:>6} {ref_time:>8.2f} {1:>7.2f}x')
+    print(f'{args.world_size:>6} {result["time"]:>8.2f} {ref_time / result["time"]:>7.2f}x')
+    print(f'mu max |d| {mu_d:.2e}   sigma max rel |d| {sigma_d:.2e}')
+    print('equivalent' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
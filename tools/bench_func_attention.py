@@ -0,0 +1,102 @@
+# Latency and peak memory of GlobalAttention.func_attention against the
+# transpose/contiguous implementation it replaced.
+#
+#   python -m tools.bench_func_attention --batch_sizes 16 64 --num_crops 4 16
+#
+# Shapes follow the fine trainer's words loss: query [bs, 512, 20] clause
+# features against [bs, 512, sqrt(num_crop), sqrt(num_crop)] region
+# features. Peak memory is only reported on CUDA. The masked path is
+# checked against the reference run on the unpadded clauses.
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+from GlobalAttention import func_attention
+
+
+def reference_func_attention(query, context, gamma1):
+    batch_size, queryL = query.size(0), query.size(2)
+    ih, iw = context.size(2), context.size(3)
+    sourceL = ih * iw
+    context = context.view(batch_size, -1, sourceL)
+    contextT = torch.transpose(context, 1, 2).contiguous()
+    attn = torch.bmm(contextT, query)
+    attn = attn.view(batch_size * sourceL, queryL)
+    attn = nn.Softmax(dim=-1)(attn)
+    attn = attn.view(batch_size, sourceL, queryL)
+    attn = torch.transpose(attn, 1, 2).contiguous()
+    attn = attn.view(batch_size * queryL, sourceL)
+    attn = attn * gamma1
+    attn = nn.Softmax(dim=-1)(attn)
+    attn = attn.view(batch_size, queryL, sourceL)
+    attnT = torch.transpose(attn, 1, 2).contiguous()
+    weightedContext = torch.bmm(context, attnT)
+    return weightedContext, attn.view(batch_size, -1, ih, iw)
+
+
+def measure(fn, iters, device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        peak = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    else:
+        peak = float('nan')
+    return (time.perf_counter() - start) / iters * 1000., peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 64])
+    parser.add_argument('--num_crops', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--words', type=int, default=20)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--gamma1', type=float, default=5.0)
+    parser.add_argument('--iters', type=int, default=50)
+    parser.add_argument('--tol', type=float, default=1e-4)
+    args = parser.parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+
+    ok = True
+    print(f'{"bs":>4} {"crops":>6} {"ref ms":>8} {"new ms":>8} {"ref MiB":>8} '
+          f'{"new MiB":>8} {"max|d|":>9} {"mask|d|":>9}')
+    for bs in args.batch_sizes:
+        for num_crop in args.num_crops:
+            side = int(num_crop ** 0.5)
+            query = torch.randn(bs, args.dim, args.words, device=device)
+            context = torch.randn(bs, args.dim, side, side, device=device)
+            ref = reference_func_attention(query, context, args.gamma1)
+            new = func_attention(query, context, args.gamma1)
+            diff = max((a - b).abs().max().item() for a, b in zip(ref, new))
+
+            # padding words masked out == the reference on the real words only
+            n = args.words // 2
+            mask = torch.zeros(bs, args.words, dtype=torch.bool, device=device)
+            mask[:, n:] = True
+            ref_m = reference_func_attention(query[:, :, :n].contiguous(), context, args.gamma1)
+            new_m = func_attention(query, context, args.gamma1, mask=mask)
+            mask_diff = max((ref_m[0] - new_m[0][:, :, :n]).abs().max().item(),
+                            (ref_m[1] - new_m[1][:, :n]).abs().max().item())
+            ok = ok and max(diff, mask_diff) <= args.tol
+
+            ref_ms, ref_mb = measure(
+                lambda: reference_func_attention(query, context, args.gamma1), args.iters, device)
+            new_ms, new_mb = measure(
+                lambda: func_attention(query, context, args.gamma1), args.iters, device)
+            print(f'{bs:>4} {num_crop:>6} {ref_ms:>8.3f} {new_ms:>8.3f} {ref_mb:>8.2f} '
+                  f'{new_mb:>8.2f} {diff:>9.2e} {mask_diff:>9.2e}')
+    print('equivalent' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
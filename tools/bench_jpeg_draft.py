@@ -0,0 +1,57 @@
+# Compare full JPEG decode + resize against PIL draft-mode decoding.
+#
+#   python -m tools.bench_jpeg_draft --img_dir /PATH/TO/multi_model_celeba/images_512
+#
+# For every target size it reports images/sec of both paths and the pixel
+# drift (mean / max absolute difference in uint8, PSNR) of the draft path.
+import os
+import time
+import argparse
+
+import numpy as np
+import torchvision.transforms as transforms
+from PIL import Image
+
+
+def decode(path, resize, draft_size=None):
+    img = Image.open(path)
+    if draft_size is not None:
+        img.draft('RGB', (draft_size, draft_size))
+    return np.asarray(resize(img.convert('RGB')), dtype=np.uint8)
+
+
+def run(paths, size, draft):
+    resize = transforms.Resize(size)
+    draft_size = size if draft else None
+    start = time.perf_counter()
+    out = [decode(path, resize, draft_size) for path in paths]
+    return out, len(paths) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--img_dir', type=str, required=True)
+    parser.add_argument('--n', type=int, default=500)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256])
+    args = parser.parse_args()
+
+    names = sorted(f for f in os.listdir(args.img_dir) if f.endswith('.jpg'))
+    paths = [os.path.join(args.img_dir, f) for f in names[:args.n]]
+
+    print(f'{"size":>6} {"full img/s":>11} {"draft img/s":>12} '
+          f'{"speedup":>8} {"mean|d|":>8} {"max|d|":>7} {"PSNR":>7}')
+    for size in args.sizes:
+        ref, ref_ips = run(paths, size, draft=False)
+        new, new_ips = run(paths, size, draft=True)
+        diff = np.concatenate([
+            np.abs(a.astype(np.int16) - b.astype(np.int16)).ravel()
+            for a, b in zip(ref, new)
+        ])
+        mse = np.mean(diff.astype(np.float64) ** 2)
+        psnr = 10 * np.log10(255. ** 2 / mse) if mse > 0 else float('inf')
+        print(f'{size:>6} {ref_ips:>11.1f} {new_ips:>12.1f} {new_ips / ref_ips:>7.2f}x '
+              f'{diff.mean():>8.3f} {diff.max():>7d} {psnr:>7.2f}')
+
+
+if __name__ == '__main__':
+    main()
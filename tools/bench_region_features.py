@@ -0,0 +1,99 @@
+# Step time of the CLIP image work in trainer_fine's G step, crop mode
+# (CLIPLoss forward + num_crop random crops) against patch mode (CLIPLoss
+# forward + one forward with pooled patch tokens), forward and backward
+# into the images.
+#
+#   python -m tools.bench_region_features --batch_size 16 --num_crops 4 9 16
+#
+# Uses ViT-B/32 on CUDA if available; the generator is replaced by a
+# random image tensor that requires grad.
+import time
+import argparse
+
+import clip
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+from miscc.losses import CLIPLoss
+from miscc.clip_regions import patch_regions
+
+
+MEAN = (0.48145466, 0.4578275, 0.40821073)
+STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def clip_normalize(image):
+    # trainer_fine.clip_normalize
+    image = F.interpolate(image, size=224, mode='bicubic')
+    mean = torch.tensor(MEAN, device=image.device).view(1, -1, 1, 1)
+    std = torch.tensor(STD, device=image.device).view(1, -1, 1, 1)
+    return (image - mean) / std
+
+
+def crop_step(clip_model, clip_loss, imgs, texts, labels, num_crop, cropper):
+    # trainer_fine.crop_imgs followed by CLIPLoss on the full image
+    bs = imgs.size(0)
+    crops = torch.cat([cropper(imgs) for _ in range(num_crop)], dim=0)
+    feat = clip_model.encode_image(clip_normalize(crops).float())
+    side = int(num_crop ** 0.5)
+    regions = feat.view(num_crop, bs, -1).transpose(0, 1).reshape(bs, side, side, -1)
+    regions = regions.permute(0, 3, 1, 2)
+    loss = clip_loss(imgs, texts, labels)
+    return loss + regions.float().mean()
+
+
+def patch_step(clip_model, clip_loss, imgs, texts, labels, num_crop):
+    _, regions = patch_regions(clip_model, clip_normalize(imgs), num_crop)
+    loss = clip_loss(imgs, texts, labels)
+    return loss + regions.mean()
+
+
+def timeit(fn, iters, device):
+    fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--img_size', type=int, default=256)
+    parser.add_argument('--crop_size', type=int, default=128)
+    parser.add_argument('--num_crops', type=int, nargs='+', default=[4, 9, 16])
+    parser.add_argument('--iters', type=int, default=10)
+    args = parser.parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    clip_model, _ = clip.load('ViT-B/32', device=device)
+    clip_model.eval()
+    clip_loss = CLIPLoss(clip_model)
+    cropper = transforms.RandomCrop(args.crop_size)
+    bs = args.batch_size
+    imgs = torch.randn(bs, 3, args.img_size, args.img_size, device=device, requires_grad=True)
+    texts = clip.tokenize(['a woman with black hair'] * bs).to(device)
+    labels = torch.arange(bs, device=device)
+
+    def run(step):
+        def fn():
+            imgs.grad = None
+            step().backward()
+        return fn
+
+    print(f'{"crops":>6} {"crop ms":>9} {"patch ms":>9} {"speedup":>8}')
+    for num_crop in args.num_crops:
+        crop_ms = timeit(run(lambda: crop_step(
+            clip_model, clip_loss, imgs, texts, labels, num_crop, cropper)), args.iters, device)
+        patch_ms = timeit(run(lambda: patch_step(
+            clip_model, clip_loss, imgs, texts, labels, num_crop)), args.iters, device)
+        print(f'{num_crop:>6} {crop_ms:>9.2f} {patch_ms:>9.2f} {crop_ms / patch_ms:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
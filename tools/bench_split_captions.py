@@ -0,0 +1,93 @@
+# Equivalence check and micro-benchmark of the batched clause encoder
+# (miscc.clip_cache.encode_clauses) against the per-caption loop that
+# trainer_fine.split_captions used to run.
+#
+#   python -m tools.bench_split_captions --cfg cfg/mmceleba_trainer_fine.yml
+#
+# Captions come from the fine train set; without --cfg a synthetic set of
+# comma separated clauses is used. Exits non-zero if the features or the
+# clause counts differ.
+import sys
+import time
+import random
+import argparse
+
+import torch
+import clip
+
+from miscc.config import cfg, cfg_from_file
+from miscc.clip_cache import MAX_CLAUSES, split_clauses, encode_clauses, empty_clause_emb
+
+
+@torch.no_grad()
+def loop_split_captions(clip_model, cap_ori, device):
+    # the old implementation, one encode_text per caption, lengths fixed
+    res, split_cap_len = [], []
+    for cap in [split_clauses(c) for c in cap_ori]:
+        split_cap_len.append(len(cap))
+        while len(cap) < MAX_CLAUSES:
+            cap.append('')
+        tokens = clip.tokenize(cap, truncate=True).to(device)
+        res.append(clip_model.encode_text(tokens).unsqueeze(0).float())
+    return torch.cat(res, dim=0), split_cap_len
+
+
+def synthetic_captions(n, seed=0):
+    rng = random.Random(seed)
+    words = ['the', 'woman', 'man', 'has', 'black', 'hair', 'smiles', 'wears',
+             'earrings', 'lipstick', 'young', 'eyeglasses', 'beard', 'pale', 'skin']
+    caps = []
+    for _ in range(n):
+        clauses = [' '.join(rng.choice(words) for _ in range(rng.randint(2, 6)))
+                   for _ in range(rng.randint(1, 24))]
+        caps.append(', '.join(clauses) + '.')
+    return caps
+
+
+def timeit(fn, iters):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, dest='cfg_file', default='')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--atol', type=float, default=2e-2)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    clip_model, _ = clip.load('ViT-B/32', device=device)
+    clip_model.eval()
+    if args.cfg_file != '':
+        cfg_from_file(args.cfg_file)
+        from datasets_fine import TextDataset
+        captions = list(TextDataset(cfg.DATA_DIR, 'train').ori_caps[:4096])
+    else:
+        captions = synthetic_captions(4096)
+    empty = empty_clause_emb(clip_model, device)
+
+    ok = True
+    print(f'{"bs":>4} {"loop ms":>9} {"batched ms":>11} {"speedup":>8} {"max|d|":>8}')
+    for bs in args.batch_sizes:
+        cap_ori = random.Random(bs).sample(captions, bs)
+        ref, ref_len = loop_split_captions(clip_model, cap_ori, device)
+        new, new_len = encode_clauses(clip_model, cap_ori, device, empty)
+        diff = (ref - new).abs().max().item()
+        ok = ok and ref_len == new_len and diff <= args.atol
+        loop_ms = timeit(lambda: loop_split_captions(clip_model, cap_ori, device), args.iters)
+        new_ms = timeit(lambda: encode_clauses(clip_model, cap_ori, device, empty), args.iters)
+        print(f'{bs:>4} {loop_ms:>9.2f} {new_ms:>11.2f} {loop_ms / new_ms:>7.2f}x {diff:>8.4f}')
+    print('equivalent' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# The bert_client word-embedding path (miscc.word_embedding.encode_words
+# with BertClientEncoder, one BertClient per pool thread) against a local
+# tools.bert_stub_server.
+#
+#   python -m tools.bench_word_embedding --words 5000 --threads 1 4 8
+#
+# Needs pyzmq and bert-serving-client, not BERT weights. The server
+# returns StubEncoder vectors, so every batch size / thread count must
+# give exactly the table StubEncoder builds in process, in vocabulary
+# order. Prints wall time and request count per thread count.
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from miscc.word_embedding import BertClientEncoder, StubEncoder, encode_words
+from tools.bert_stub_server import StubBertServer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--words', type=int, default=5000)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--port', type=int, default=15555)
+    parser.add_argument('--port_out', type=int, default=15556)
+    parser.add_argument('--dim', type=int, default=768)
+    args = parser.parse_args()
+
+    words = ['word%d' % i for i in range(args.words)]
+    ref = encode_words(StubEncoder(args.dim), words, args.batch_size, threads=1)
+    server = StubBertServer(args.port, args.port_out, args.dim).start()
+    ok = True
+    print(f'{args.words} words, batch {args.batch_size}')
+    print(f'{"threads":>8} {"time s":>8} {"requests":>9} {"max |d|":>9}')
+    try:
+        for threads in args.threads:
+            encoder = BertClientEncoder(port=args.port, port_out=args.port_out, timeout=30000)
+            server.num_requests = 0
+            start = time.perf_counter()
+            emb = encode_words(encoder, words, args.batch_size, threads)
+            elapsed = time.perf_counter() - start
+            diff = float(np.abs(emb.astype(np.float32) - ref.astype(np.float32)).max())
+            ok = ok and emb.shape == ref.shape and diff == 0
+            print(f'{threads:>8} {elapsed:>8.2f} {server.num_requests:>9} {diff:>9.2e}')
+    finally:
+        server.close()
+    print('equivalent' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Equivalence check and CPU benchmark of the batched words_loss_trainer_fine
+# against the per-caption loop it replaced.
+#
+#   python -m tools.bench_words_loss --batch_sizes 8 16 32 64 128 --num_crop 16
+#
+# Inputs are random [bs, 512, sqrt(num_crop), sqrt(num_crop)] region features
+# and [bs, 512, 20] clause features with random clause counts. Reports the
+# max difference of the similarity matrix, losses and attention maps, and
+# the time per call; exits non-zero on a mismatch.
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+from miscc.config import cfg
+from miscc.losses import cosine_similarity, words_similarity, words_loss_trainer_fine
+from GlobalAttention import func_attention
+
+
+def loop_similarity(img_features, words_emb, cap_lens, batch_size):
+    # the loop body of the old words_loss_trainer_fine
+    att_maps, similarities = [], []
+    for i in range(batch_size):
+        words_num = cap_lens[i]
+        word = words_emb[i, :, :words_num].unsqueeze(0).contiguous()
+        word = word.repeat(batch_size, 1, 1)
+        weiContext, attn = func_attention(word, img_features, cfg.TRAIN.SMOOTH.GAMMA1)
+        att_maps.append(attn[i].unsqueeze(0).contiguous())
+        word = word.transpose(1, 2).contiguous().view(batch_size * words_num, -1)
+        weiContext = weiContext.transpose(1, 2).contiguous().view(batch_size * words_num, -1)
+        row_sim = cosine_similarity(word, weiContext).view(batch_size, words_num)
+        row_sim.mul_(cfg.TRAIN.SMOOTH.GAMMA2).exp_()
+        row_sim = torch.log(row_sim.sum(dim=1, keepdim=True))
+        similarities.append(row_sim)
+    return torch.cat(similarities, 1), att_maps
+
+
+def timeit(fn, iters):
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 16, 32, 64, 128])
+    parser.add_argument('--num_crop', type=int, default=16)
+    parser.add_argument('--seq_len', type=int, default=20)
+    parser.add_argument('--chunk_size', type=int, default=None)
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--tol', type=float, default=1e-3)
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    side = int(args.num_crop ** 0.5)
+
+    ok = True
+    print(f'{"bs":>4} {"loop ms":>9} {"batched ms":>11} {"speedup":>8} '
+          f'{"sim |d|":>9} {"loss |d|":>9} {"attn |d|":>9}')
+    for bs in args.batch_sizes:
+        img = torch.randn(bs, cfg.TEXT.EMBEDDING_DIM, side, side)
+        words = torch.randn(bs, cfg.TEXT.EMBEDDING_DIM, args.seq_len)
+        cap_lens = torch.randint(1, args.seq_len + 1, (bs,)).tolist()
+        labels = torch.arange(bs)
+
+        ref_sim, ref_maps = loop_similarity(img, words, cap_lens, bs)
+        new_sim, new_maps = words_similarity(img, words, cap_lens, args.chunk_size)
+        sim_d = (ref_sim - new_sim).abs().max().item()
+        attn_d = max((a - b).abs().max().item() for a, b in zip(ref_maps, new_maps))
+        ref_loss = nn.CrossEntropyLoss()(ref_sim * cfg.TRAIN.SMOOTH.GAMMA3, labels)
+        new_loss, _, _ = words_loss_trainer_fine(
+            img, words, labels, cap_lens, None, bs, args.chunk_size)
+        loss_d = (ref_loss - new_loss).abs().item()
+        ok = ok and max(sim_d, attn_d, loss_d) <= args.tol
+
+        loop_ms = timeit(lambda: loop_similarity(img, words, cap_lens, bs), args.iters)
+        new_ms = timeit(lambda: words_similarity(img, words, cap_lens, args.chunk_size), args.iters)
+        print(f'{bs:>4} {loop_ms:>9.2f} {new_ms:>11.2f} {loop_ms / new_ms:>7.2f}x '
+              f'{sim_d:>9.2e} {loss_d:>9.2e} {attn_d:>9.2e}')
+    print('equivalent' if ok else 'MISMATCH')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
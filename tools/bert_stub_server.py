@@ -0,0 +1,99 @@
+# Local stand-in for bert-serving-start, for exercising the bert_client
+# word-embedding backend (miscc.word_embedding.BertClientEncoder) without
+# BERT weights.
+#
+#   python -m tools.bert_stub_server --port 5555 --port_out 5556
+#
+# Speaks the bert-serving wire protocol the client uses: requests come in
+# on a PULL socket as [client, msg, req_id, msg_len]; replies go out on a
+# PUB socket with the client identity as topic, [client, config_json,
+# req_id] for SHOW_CONFIG and [client, array_info_json, array_bytes,
+# req_id] for a JSON list of texts. The vectors are those of
+# miscc.word_embedding.StubEncoder, so a client-side result can be
+# checked against it.
+import json
+import time
+import argparse
+import threading
+
+import zmq
+
+from miscc.word_embedding import StubEncoder
+
+
+def client_version():
+    try:
+        from bert_serving.client import __version__
+        return __version__
+    except ImportError:
+        return 'stub'
+
+
+class StubBertServer(object):
+    def __init__(self, port=5555, port_out=5556, dim=768, max_seq_len=25):
+        self.encoder = StubEncoder(dim)
+        self.config = {
+            'server_version': client_version(),
+            'max_seq_len': max_seq_len,
+            'show_tokens_to_client': False,
+            'pooling_strategy': 'stub',
+        }
+        self.context = zmq.Context()
+        self.receiver = self.context.socket(zmq.PULL)
+        self.receiver.bind('tcp://*:%d' % port)
+        self.sender = self.context.socket(zmq.PUB)
+        self.sender.bind('tcp://*:%d' % port_out)
+        self.clients = set()
+        self.num_requests = 0
+        self.running = True
+
+    def serve_forever(self):
+        poller = zmq.Poller()
+        poller.register(self.receiver, zmq.POLLIN)
+        while self.running:
+            if not poller.poll(100):
+                continue
+            client, msg, req_id, _ = self.receiver.recv_multipart()
+            if client not in self.clients:
+                # a new client's SUB socket may not have subscribed yet
+                self.clients.add(client)
+                time.sleep(0.2)
+            self.num_requests += 1
+            if msg == b'SHOW_CONFIG':
+                self.sender.send_multipart([client, json.dumps(self.config).encode(), req_id])
+                continue
+            emb = self.encoder.encode(json.loads(msg))
+            info = {'dtype': str(emb.dtype), 'shape': list(emb.shape)}
+            self.sender.send_multipart([client, json.dumps(info).encode(), emb.tobytes(), req_id])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.running = False
+        if getattr(self, 'thread', None) is not None:
+            self.thread.join()
+        self.receiver.close(linger=0)
+        self.sender.close(linger=0)
+        self.context.term()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--port_out', type=int, default=5556)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--max_seq_len', type=int, default=25)
+    args = parser.parse_args()
+    server = StubBertServer(args.port, args.port_out, args.dim, args.max_seq_len)
+    print(f'stub bert server on ports {args.port}/{args.port_out}, dim {args.dim}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# A few optimizer steps of trainer_fine.condGANTrainer.train() per
+# configuration, on a synthetic dataset, CPU or GPU.
+#
+#   python -m tools.smoke_trainer_fine --steps 3 --accu 2
+#
+# Starts from --cfg, writes a small dataset2.json / JPEG tree to a temp
+# dir (stub word embeddings), stands in a randomly initialized small CLIP
+# for clip.load (no weights download) and runs the real training loop for
+# every GRAD_ACCU_STEPS / ACCU_CONTRASTIVE / REGION_MODE / AMP combination
+# in --configs, up to the first epoch's evaluation. The default --size 64
+# keeps G and D within a few GB on CPU. Image grids are not written
+# (save_grid_images is a no-op) and the code backup of __init__ is
+# skipped. Prints the epoch's window means and step time, and exits
+# non-zero if a loss is non-finite, a regularizer did not run, or G / D
+# did not change.
+import gc
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import torch
+from PIL import Image
+
+import clip
+from clip.model import CLIP
+
+import trainer_fine
+from miscc.config import cfg, cfg_from_file
+
+WORDS = ['the', 'woman', 'man', 'has', 'blond', 'black', 'brown', 'hair', 'and',
+         'is', 'smiling', 'young', 'wears', 'lipstick', 'eyeglasses', 'a', 'beard']
+
+# accu, ACCU_CONTRASTIVE, REGION_MODE, AMP
+CONFIGS = {
+    'accu': (None, False, 'crop', ''),
+    'accu-contrast': (None, True, 'crop', ''),
+    'accu-patch': (None, False, 'patch', ''),
+    'accu-contrast-patch': (None, True, 'patch', ''),
+    'accu-bf16': (None, False, 'crop', 'bf16'),
+    'accu-contrast-patch-bf16': (None, True, 'patch', 'bf16'),
+    'single': (1, False, 'crop', ''),
+}
+
+
+class EpochDone(Exception):
+    pass
+
+
+class ScalarLog(object):
+    # SummaryWriter stand-in, keeps what Metrics reports
+    def __init__(self):
+        self.scalars = {}
+
+    def add_scalar(self, tag, value, step):
+        self.scalars[tag] = value
+
+    def flush(self):
+        pass
+
+
+def make_dataset(root, n_train, n_test, captions_per_image, size, seed):
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root, 'images'))
+    data = {}
+    for split, n in (('train', n_train), ('test', n_test)):
+        entry = {'filenames': [], 'keynames': [], 'captions': []}
+        for i in range(n):
+            name = '%s_%05d' % (split, i)
+            pixels = rng.randint(0, 256, (size, size, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(os.path.join(root, 'images', name + '.jpg'))
+            for _ in range(captions_per_image):
+                words = rng.choice(WORDS, rng.randint(4, 12))
+                caption = ' '.join(words[:len(words) // 2]) + ', ' + ' '.join(words[len(words) // 2:])
+                entry['filenames'].append(name)
+                entry['keynames'].append(name)
+                entry['captions'].append(caption + '.')
+        data[split] = entry
+    with open(os.path.join(root, 'dataset2.json'), 'w') as f:
+        json.dump(data, f)
+
+
+def small_clip(name, device='cpu', **kwargs):
+    # clip.load's return value with random weights: fp32 on CPU, fp16 on GPU
+    model = CLIP(
+        embed_dim=cfg.TEXT.EMBEDDING_DIM, image_resolution=224, vision_layers=2,
+        vision_width=64, vision_patch_size=32, context_length=77, vocab_size=49408,
+        transformer_width=64, transformer_heads=2, transformer_layers=2,
+    ).to(device)
+    if torch.device(device).type == 'cuda':
+        clip.model.convert_weights(model)
+    return model.eval(), None
+
+
+def params(model):
+    return [p.detach().float().clone() for p in model.parameters()]
+
+
+def run(name, config, args, root, device):
+    accu, contrastive, region_mode, amp = config
+    accu = accu or args.accu
+    cfg.TRAIN.GRAD_ACCU_STEPS = accu
+    cfg.TRAIN.ACCU_CONTRASTIVE = contrastive
+    cfg.TRAIN.REGION_MODE = region_mode
+    cfg.TRAIN.AMP = amp
+    # R1 every other step, path length every step
+    cfg.TRAIN.D_REG_EVERY = 2 * accu
+    cfg.TRAIN.G_REG_EVERY = accu
+    cfg.TRAIN.BATCH_SIZE = args.batch_size
+    # the loader holds steps * accu batches, one epoch is --steps steps
+    cfg.DATA_DIR = os.path.join(root, 'data_%d' % accu)
+    if not os.path.isdir(cfg.DATA_DIR):
+        make_dataset(cfg.DATA_DIR, args.steps * accu * args.batch_size, args.n_sample,
+                     cfg.TEXT.CAPTIONS_PER_IMAGE, args.size, args.seed)
+
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    out_dir = os.path.join(root, 'out_' + name)
+    train_args = SimpleNamespace(
+        cfg_file=args.cfg_file, device=device, distributed=False,
+        local_rank=0, n_sample=args.n_sample, n_val=args.batch_size, latent=cfg.GAN.W_DIM,
+        path_fid=os.path.join(out_dir, 'fid'),
+    )
+    with mock.patch.object(trainer_fine.shutil, 'copy'):
+        algo = trainer_fine.condGANTrainer(out_dir, train_args)
+    algo.writer = ScalarLog()
+    algo.save_grid_images = lambda images, filename: None
+
+    nets = {}
+    build_models = algo.build_models
+
+    def build():
+        models = build_models()
+        nets.update(G=models[0], D=models[1], G_ema=models[2])
+        nets['before'] = {key: params(nets[key]) for key in ('G', 'D', 'G_ema')}
+        timing['start'] = time.perf_counter()
+        return models
+
+    timing = {}
+
+    def eval1(netG, epoch, shard=True):
+        timing['end'] = time.perf_counter()
+        raise EpochDone()
+
+    algo.build_models = build
+    algo.eval1 = eval1
+    with mock.patch.object(clip, 'load', small_clip):
+        try:
+            algo.train()
+        except EpochDone:
+            pass
+    algo.checkpoints.close()
+
+    scalars = algo.writer.scalars
+    changed = {
+        key: max(float((a - b).abs().max()) for a, b in zip(nets['before'][key], params(nets[key])))
+        for key in ('G', 'D', 'G_ema')
+    }
+    finite = all(math.isfinite(v) for v in scalars.values())
+    ran = all(('loss/' + tag) in scalars for tag in ('R1', 'Path Length Regularization'))
+    ok = 'end' in timing and finite and ran and all(v > 0 for v in changed.values())
+    # includes save_sample and the epoch-end checkpoint and samples
+    step_time = (timing['end'] - timing['start']) / args.steps if ok else float('nan')
+    return ok, scalars, changed, step_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, default='cfg/mmceleba_trainer_fine.yml', dest='cfg_file')
+    parser.add_argument('--configs', type=str, nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--accu', type=int, default=2)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--n_mlp', type=int, default=2)
+    parser.add_argument('--n_sample', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    cfg_from_file(args.cfg_file)
+    cfg.TRAIN.FLAG = True
+    cfg.TRAIN.SNAPSHOT_INTERVAL = 1
+    cfg.TRAIN.EVAL_ASYNC = False
+    cfg.TREE.BASE_SIZE = args.size
+    cfg.GAN.N_MLP = args.n_mlp
+    cfg.IMG_DIR = 'images'
+    cfg.WORKERS = 0
+    cfg.TEXT.EMB_BACKEND = 'stub'
+    cfg.TEXT.CAPTIONS_PER_IMAGE = 2
+
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        for name in args.configs:
+            results.append((name, CONFIGS[name]) + run(name, CONFIGS[name], args, root, device))
+            # the previous trainer's models before building the next
+            gc.collect()
+
+    print(f'device {device}, {args.steps} steps, batch {args.batch_size}, size {args.size}')
+    print(f'{"config":>25} {"accu":>4} {"amp":>5} {"step s":>7} {"d":>7} {"g":>7} {"clip":>7} '
+          f'{"r1":>7} {"path":>7} {"|dG|":>8} {"|dD|":>8}  ok')
+    ok = True
+    for name, config, passed, scalars, changed, step_time in results:
+        ok = ok and passed
+        loss = {tag: scalars.get('loss/' + tag, float('nan')) for tag in (
+            'Discriminator', 'Generator', 'CLIP LOSS', 'R1', 'Path Length Regularization')}
+        print(f'{name:>25} {config[0] or args.accu:>4} {config[3] or "fp32":>5} {step_time:>7.2f} '
+              + ' '.join(f'{v:>7.3f}' for v in loss.values())
+              + f' {changed["G"]:>8.1e} {changed["D"]:>8.1e}  {"yes" if passed else "NO"}')
+    print('smoke ok' if ok else 'SMOKE FAILED')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,7 +20,6 @@ import torch.optim as optim
 from torch.autograd import Variable
 from torch.utils import data
 from torch.backends import cudnn
-from torch.cuda.amp import autocast, GradScaler
 
 import torchvision
 from torchvision import transforms, utils
@@ -39,6 +38,11 @@ from miscc.losses import words_loss_trainer_fine
 from miscc.losses import d_logistic_loss, d_r1_loss
 from miscc.losses import g_path_regularize,pixel_g_nonsaturating_loss
 from miscc.losses import CLIPLoss
+from miscc.checkpoint import CheckpointWriter
+from miscc.ema import EMA
+from miscc.evaluator import AsyncEvaluator
+from miscc.metrics import Metrics
+from miscc.train_utils import Amp, GANParams, make_adam, RandState, loss_scale, sync_context
 import re
 import torch.nn.functional as F
 from datasets_fine import TextDataset, prepare_data,EvalDataset_Final
@@ -46,12 +50,17 @@ from model_base import RNN_ENCODER, CNN_ENCODER
 from model import Generator as G_STYLE
 from model import Discriminator as D_NET
 from calculate_fid import calculate_fid_CLIP_with_TediGan_text
+from miscc.fid_reference import reference_statistics
+from miscc.clip_cache import ensure_sent_table, ensure_clause_tables
+from miscc.clip_cache import ensure_prompt_bundle
+from miscc.clip_cache import ensure_token_table, word_token_table, gather_clip_tokens
+from miscc.clip_cache import encode_clauses, empty_clause_emb
+from miscc.clip_regions import patch_regions, random_crops, crop_regions, ClipPreprocess
 sys.path.append('./code/pixel_models')
 import tools.tensor_transforms as tt
 
 from distributed import (
 	get_rank,
-	reduce_loss_dict,
 	reduce_sum,
 	get_world_size,
 	cleanup_distributed, 
@@ -88,11 +97,9 @@ class condGANTrainer(object):
 		self.max_epoch = cfg.TRAIN.MAX_EPOCH   # 800
 		self.snapshot_interval = cfg.TRAIN.SNAPSHOT_INTERVAL
 		self.img_size = cfg.TREE.BASE_SIZE
-		self.crop_size = 128
+		# half the image side, 128 at the shipped BASE_SIZE 256
+		self.crop_size = self.img_size // 2
 		print('Crop_Size:',self.crop_size)
-		self.cropper = transforms.Compose([
-			transforms.RandomCrop(self.crop_size)
-		])
 		self.data_set = TextDataset(
 			cfg.DATA_DIR, 
 			split_dir,
@@ -113,6 +120,7 @@ class condGANTrainer(object):
 
 		self.n_words = self.data_set.n_words
 		self.ixtoword = self.data_set.ixtoword  # dict for idx to word
+		self.word_tokens = None  # CLIP BPE ids per word, see get_text_input
 		self.word2id = self.data_set.wordtoix
 		self.pretrained_emb = self.data_set.pretrained_emb
 		self.num_batches = len(self.data_loader)
@@ -165,13 +173,9 @@ class condGANTrainer(object):
 		
 
 	######################################################################
-			f = np.load(cfg.MU_SIG)
-			self.mu_train, self.sigma_train = f['mu'][:], f['sigma'][:]
-			f.close()
-
-			f = np.load(cfg.MU_SIG.replace('train', 'val'))
-			self.mu_val, self.sigma_val = f['mu'][:], f['sigma'][:]
-			f.close()
+			# cached real-image statistics and compiled prompts, loaded at the first eval
+			self.fid_ref = None
+			self.prompts = None
 		
 
 	def data_sampler(self, dataset, shuffle, distributed):
@@ -190,18 +194,6 @@ class condGANTrainer(object):
 			for batch in loader:
 				yield batch
 
-	def requires_grad(self, model, flag=True):
-		for p in model.parameters():
-			p.requires_grad = flag
-
-
-	def accumulate(self, model1, model2, decay=0.999):
-		par1 = dict(model1.named_parameters())
-		par2 = dict(model2.named_parameters())
-
-		for k in par1.keys():
-			par1[k].data.mul_(decay).add_(par2[k].data, alpha=1 - decay)
-
 
 	def build_models(self):
 		def count_parameters(model):
@@ -221,6 +213,28 @@ class condGANTrainer(object):
 		self.clip_model, _ = clip.load("ViT-B/32", device=device)
 		self.clip_model.eval()
 		self.preprocess = transforms.Resize([224, 224])  # for cal loss
+		self.clip_preprocess = ClipPreprocess(224).to(device)
+		self.empty_clause = None  # encoded on first use by split_captions
+
+		if cfg.TEXT.CLIP_CACHE != '':
+			self.data_set.attach_clip_table(
+				'sent_emb', ensure_sent_table(self.data_set, self.clip_model, device)
+			)
+			self.data_set.attach_clip_table(
+				'clip_tokens', ensure_token_table(self.data_set)
+			)
+			if cfg.TRAIN.FLAG:
+				self.val_set.attach_clip_table(
+					'sent_emb', ensure_sent_table(self.val_set, self.clip_model, device)
+				)
+				self.val_set.attach_clip_table(
+					'clip_tokens', ensure_token_table(self.val_set)
+				)
+			clause_emb, clause_ids, clause_len = ensure_clause_tables(
+				self.data_set, self.clip_model, device
+			)
+			self.data_set.attach_clip_table('clause_emb', clause_emb, clause_ids)
+			self.data_set.attach_clip_table('clause_len', clause_len)
 
 		# #######################generator and discriminators############## #
 		netG = G_STYLE(self.img_size).to(device)
@@ -228,7 +242,11 @@ class condGANTrainer(object):
 
 		netG_ema = G_STYLE(self.img_size).to(device)
 		netG_ema.eval()
-		self.accumulate(netG_ema, netG, 0)
+		self.ema = EMA(
+			netG, netG_ema, every=cfg.TRAIN.EMA_EVERY, offload=cfg.TRAIN.EMA_CPU
+		)
+		self.ema.copy_()
+		self.amp = Amp(cfg.TRAIN.AMP, device)
 
 		if get_rank() == 0:
 			print('G\'s trainable parameters =', count_parameters(netG))
@@ -237,16 +255,17 @@ class condGANTrainer(object):
 		g_reg_ratio = cfg.TRAIN.G_REG_EVERY / (cfg.TRAIN.G_REG_EVERY + 1)
 		d_reg_ratio = cfg.TRAIN.D_REG_EVERY / (cfg.TRAIN.D_REG_EVERY + 1)
 		
-		optimG = optim.Adam(
+		optimG = make_adam(
 			netG.parameters(),
 			lr=cfg.TRAIN.GENERATOR_LR * g_reg_ratio,
 			betas=(0 ** g_reg_ratio, 0.99 ** g_reg_ratio)
 		)
-		optimD = optim.Adam(
+		optimD = make_adam(
 			netD.parameters(), 
 			lr=cfg.TRAIN.DISCRIMINATOR_LR * d_reg_ratio,
 			betas=(0 ** d_reg_ratio, 0.99 ** d_reg_ratio)
 		)
+		self.gan_params = GANParams(netG, netD, optimG, optimD)
 
 		epoch = 0
 		if cfg.TRAIN.NET_G != '':
@@ -261,10 +280,12 @@ class condGANTrainer(object):
 			)
 
 			netG.load_state_dict(ckpt["g"])
-			netG_ema.load_state_dict(ckpt["g_ema"])
+			self.ema.load_state_dict(ckpt["g_ema"])
 			netD.load_state_dict(ckpt["d"])
 			optimG.load_state_dict(ckpt["g_optim"])
 			optimD.load_state_dict(ckpt["d_optim"])
+			if "amp" in ckpt:
+				self.amp.load_state_dict(ckpt["amp"])
 			
 			if get_rank() == 0:
 				print("load model:", Gname)
@@ -301,16 +322,19 @@ class condGANTrainer(object):
 
 		return real_labels, fake_labels, match_labels
 
-	def save_model(self, g_module, d_module, g_ema, g_optim, d_optim, s_name):
-		torch.save(
+	def save_model(self, g_module, d_module, g_ema, g_optim, d_optim, s_name, hold=False):
+		# snapshot now, serialized by the writer thread
+		self.checkpoints.save(
 			{
 				"g": g_module.state_dict(),
 				"d": d_module.state_dict(),
-				"g_ema": g_ema.state_dict(),
+				"g_ema": self.ema.state_dict(),
 				"g_optim": g_optim.state_dict(),
 				"d_optim": d_optim.state_dict(),
+				"amp": self.amp.state_dict(),
 			}, 
 			s_name,
+			hold=hold,
 		)
 
 
@@ -370,11 +394,10 @@ class condGANTrainer(object):
 		dataset = self.data_set if split == 'train' else self.val_set
 		
 		samples = dataset.get_grid_data(n_sample)
-		imgs, caps, cap_ori,caplens, _, _ = prepare_data(samples) 
+		imgs, caps, cap_ori,caplens, _, _, extras = prepare_data(samples) 
 		
 		word = None
-		texts = self.get_text_input(caps)
-		sent = self.clip_model.encode_text(texts).float()
+		sent = self.get_sent_emb(caps, extras)
 		sent = sent.detach()
 
 		self.save_grid_images(imgs, f'real_{split}.png')
@@ -382,65 +405,178 @@ class condGANTrainer(object):
 		return word, sent
 
 
+	def get_sent_emb(self, caps, extras):
+		# rows of the precomputed CLIP table if attached, else encode_text
+		if 'sent_emb' in extras:
+			return extras['sent_emb'].float()
+		texts = self.get_clip_tokens(caps, extras)
+		return self.clip_model.encode_text(texts).float()
+
+
+	def get_clip_tokens(self, caps, extras):
+		# rows of the pre-tokenized table if attached, else get_text_input
+		if 'clip_tokens' in extras:
+			return extras['clip_tokens']
+		return self.get_text_input(caps)
+
+
 	def get_text_input(self, caps):
-		device = self.args.device
-		texts = []
-		for cap in caps:
-			text = ' '.join([self.ixtoword[idx.item()] for idx in cap])
-			text = text.replace('END', '').strip()
-			texts.append(text)
-		texts = clip.tokenize(texts).to(device)
-		return texts
+		# same ids as clip.tokenize on the caption strings, gathered on device
+		if self.word_tokens is None:
+			device = self.args.device
+			word_tokens, word_lens = word_token_table(self.ixtoword)
+			self.word_tokens = word_tokens.to(device)
+			self.word_token_lens = word_lens.to(device)
+		caps = caps.view(-1, caps.size(-1))
+		return gather_clip_tokens(caps, self.word_tokens, self.word_token_lens)
 	
 	def get_text(self, caps):
 		texts = []
-		for cap in caps:
-			text = ' '.join([self.ixtoword[idx.item()] for idx in cap])
+		for cap in caps.tolist():
+			text = ' '.join([self.ixtoword[idx] for idx in cap])
 			text = text.replace('END', '').strip()
 			texts.append(text)
 		return texts
 	
 	def split_captions(self,cap_ori,device):
-		captions = [re.split('[,.]',i.replace('and',''))[:-1] for i in cap_ori]
-		res = []
-		split_cap_len = []
-		for cap in captions:
-			if len(cap)<20:
-				split_cap_len.append(len(cap))
-			while len(cap)<20:
-				cap.append('')	
-			res.append(self.clip_model.encode_text(clip.tokenize(cap).to(device)).unsqueeze(0).float())
+		if self.empty_clause is None:
+			self.empty_clause = empty_clause_emb(self.clip_model, device)
+		feats, split_cap_len = encode_clauses(
+			self.clip_model, cap_ori, device, self.empty_clause
+		)
 		# bs*20*dim ---> bs*dim*20
-		return torch.cat(res,dim=0).permute(0,2,1),split_cap_len
+		return feats.permute(0,2,1),split_cap_len
 	def crop_imgs(self,number,imgs,device):
-		cropper = self.cropper
-		img_proc =[]
-		for n in range(number):
-			target_crop = cropper(imgs)
-			img_proc.append(target_crop)
-		# img_proc:(bs*number)*128*128
-		img_proc = torch.cat(img_proc,dim=0)
+		# number independent random crops per sample, one gather
+		# img_proc:(bs*number)*3*128*128
+		img_proc = random_crops(imgs, number, self.crop_size)
 		# region_img_feat:(bs*number*512)
 		region_img_feat = self.clip_model.encode_image(self.clip_normalize(img_proc,device).float())
-
 		# return bs*512*√number*√number
-		# bs*512*4*4
-		# [64,512]
-		region_img_feat_reshape = region_img_feat[:self.batch_size].unsqueeze(1)
-		# [16, 1, 512]
-		for i in range(number-1):
-			region_img_feat_reshape = torch.cat((region_img_feat_reshape,region_img_feat[(i+1)*self.batch_size:(i+2)*self.batch_size].unsqueeze(1)),dim=1)
-		# [16 , 4, 512]
-		# [16,512,2,2]
-		return region_img_feat_reshape.reshape(self.batch_size,-1,int(pow(self.num_crop,0.5)),cfg.TEXT.EMBEDDING_DIM).permute(0,3,1,2)
+		return crop_regions(region_img_feat, number)
 	def clip_normalize(self,image,device):
-		image = F.interpolate(image,size=224,mode='bicubic')
-		mean=torch.tensor([0.48145466, 0.4578275, 0.40821073]).to(device)
-		std=torch.tensor([0.26862954, 0.26130258, 0.27577711]).to(device)
-		mean = mean.view(1,-1,1,1)
-		std = std.view(1,-1,1,1)
-		image = (image-mean)/std
-		return image
+		return self.clip_preprocess(image)
+	def prepare_micro_batch(self, data, device):
+		real_img, caps, cap_ori,cap_lens, class_ids, keys, extras = prepare_data(data)
+		texts = self.get_clip_tokens(caps, extras)
+
+		if 'clause_emb' in extras:
+			# bs*20*dim ---> bs*dim*20, as split_captions
+			split_caps_feat = extras['clause_emb'].permute(0, 2, 1)
+			split_cap_len = extras['clause_len'].tolist()
+		else:
+			split_caps_feat,split_cap_len = self.split_captions(cap_ori,device)
+		split_caps_feat = split_caps_feat.detach()
+
+		if 'sent_emb' in extras:
+			states = extras['sent_emb'].float()
+		else:
+			states = self.clip_model.encode_text(texts).float()
+		states = states.detach()
+		return real_img, texts, states, split_caps_feat, split_cap_len
+
+	def encode_fake(self, fake_img, device):
+		# CLIP image embedding and bs*dim*√num_crop*√num_crop region features
+		# as CLIPLoss would encode it, the same in both modes
+		image_feat = self.clip_model.encode_image(self.clip_loss.preprocess(fake_img))
+		if cfg.TRAIN.REGION_MODE == 'patch':
+			# one CLIP image forward for all regions
+			_, region_feat = patch_regions(
+				self.clip_model, self.clip_normalize(fake_img,device), self.num_crop
+			)
+			return image_feat, region_feat
+		return image_feat, self.crop_imgs(self.num_crop,fake_img,device)
+
+	def contrastive_loss(self, image_feat, region_feat, states, split_caps_feat, split_cap_len):
+		batch_size = image_feat.size(0)
+		match_labels = torch.arange(batch_size, device=image_feat.device)
+		loss_clip = self.clip_loss(
+			None, None, match_labels,
+			image_features=image_feat, text_features=states
+		)
+		w_loss0, w_loss1, _ = words_loss_trainer_fine(
+			region_feat, split_caps_feat,
+			match_labels, split_cap_len, None, batch_size,
+			chunk_size=cfg.TRAIN.WORDS_LOSS_CHUNK or None
+		)
+		return loss_clip, w_loss0, w_loss1
+
+	def g_step(self, netG, d_module, micro_batches, real_labels, scale, device):
+		# G losses of each micro-batch accumulated into .grad, the contrastive
+		# negatives are the other samples of the same micro-batch
+		amp = self.amp
+		accu_steps = len(micro_batches)
+		losses = dict.fromkeys(["g", "clip", "loss_word0", "loss_word1"], 0)
+		for k, (real_img, texts, states, split_caps_feat, split_cap_len) in enumerate(micro_batches):
+			with sync_context(netG, k, accu_steps):
+				with amp.autocast():
+					fake_img, mu, logvar, _ = netG(states)
+					loss_g = pixel_g_nonsaturating_loss(
+						d_module,real_img, fake_img, states, real_labels,
+					)
+					image_feat, region_feat = self.encode_fake(fake_img, device)
+					loss_clip, w_loss0, w_loss1 = self.contrastive_loss(
+						image_feat, region_feat, states, split_caps_feat, split_cap_len
+					)
+					loss_total = loss_g  + loss_clip + (w_loss0 + w_loss1).mean()/20
+				amp.backward(amp.scaler_g, loss_total * scale)
+			for key, value in zip(losses, (loss_g, loss_clip, w_loss0, w_loss1)):
+				losses[key] += value.detach() / accu_steps
+		return losses, fake_img
+
+	def g_step_cached(self, netG, g_module, d_module, micro_batches, real_labels, scale, device):
+		# As g_step, but CLIPLoss and the words loss see every micro-batch as
+		# negatives. The CLIP features of all fakes are computed without a
+		# graph, the contrastive loss is backpropagated to them once, then each
+		# micro-batch is replayed (same noise and crops) and backpropagates
+		# loss_g plus feat * d(loss)/d(feat).
+		amp = self.amp
+		accu_steps = len(micro_batches)
+		rand_states, image_feats, region_feats = [], [], []
+		with torch.no_grad():
+			for real_img, texts, states, _, _ in micro_batches:
+				rand_states.append(RandState(device))
+				with amp.autocast():
+					fake_img = g_module(states)[0]
+					image_feat, region_feat = self.encode_fake(fake_img, device)
+				image_feats.append(image_feat.float())
+				region_feats.append(region_feat.float())
+
+		image_feat = torch.cat(image_feats).requires_grad_()
+		region_feat = torch.cat(region_feats).requires_grad_()
+		states = torch.cat([mb[2] for mb in micro_batches])
+		split_caps_feat = torch.cat([mb[3] for mb in micro_batches])
+		split_cap_len = sum([list(mb[4]) for mb in micro_batches], [])
+		with amp.autocast():
+			loss_clip, w_loss0, w_loss1 = self.contrastive_loss(
+				image_feat, region_feat, states, split_caps_feat, split_cap_len
+			)
+			loss_contrast = loss_clip + (w_loss0 + w_loss1).mean()/20
+		# one full-batch term stands for accu_steps micro-batch terms
+		grad_image, grad_region = torch.autograd.grad(
+			amp.scaler_g.scale(loss_contrast * scale * accu_steps), [image_feat, region_feat]
+		)
+
+		losses = {"clip": loss_clip.detach(), "loss_word0": w_loss0.detach(),
+			"loss_word1": w_loss1.detach(), "g": 0}
+		offset = 0
+		for k, (real_img, texts, states, _, _) in enumerate(micro_batches):
+			n = states.size(0)
+			with sync_context(netG, k, accu_steps), rand_states[k].replay():
+				with amp.autocast():
+					fake_img, mu, logvar, _ = netG(states)
+					loss_g = pixel_g_nonsaturating_loss(
+						d_module,real_img, fake_img, states, real_labels,
+					)
+					image_feat, region_feat = self.encode_fake(fake_img, device)
+				# grad_* already carry the scaler's scale
+				surrogate = (image_feat.float() * grad_image[offset:offset + n]).sum() + \
+					(region_feat.float() * grad_region[offset:offset + n]).sum()
+				(amp.scaler_g.scale(loss_g * scale) + surrogate).backward()
+			losses["g"] += loss_g.detach() / accu_steps
+			offset += n
+		return losses, fake_img
+
 	def train(self):
 		device = self.args.device
 		batch_size = self.batch_size
@@ -455,14 +591,14 @@ class condGANTrainer(object):
 		self.clip_loss = CLIPLoss(self.clip_model)
 
 		mean_path_length = 0
-		mean_path_length_avg = 0
 
-		d_loss_val = 0
-		g_loss_val = 0
 		r1_loss = torch.tensor(0.0, device=device)
 		path_loss = torch.tensor(0.0, device=device)
 		path_lengths = torch.tensor(0.0, device=device)
 		loss_dict = {}
+		metrics = Metrics(device, self.writer)
+		amp = self.amp
+		gan_params = self.gan_params
 
 		if self.args.distributed:
 			g_module = netG.module
@@ -473,13 +609,37 @@ class condGANTrainer(object):
 		g_ema = netG_ema
 
 		accum = 0.5 ** (32 / (10 * 1000))
-
+		# G and D step once per accu_steps micro-batches; the DDP wrappers
+		# (netG, netD) run the forwards whose gradients must be all-reduced
+		accu_steps = max(1, cfg.TRAIN.GRAD_ACCU_STEPS)
+		scale = loss_scale(accu_steps)
+		# D_REG_EVERY / G_REG_EVERY count micro-batches, so regularization
+		# runs as often per epoch whatever accu_steps is; the lazy weights
+		# are the interval in steps times a step's gradient weight
+		d_reg_every = max(1, cfg.TRAIN.D_REG_EVERY // accu_steps)
+		g_reg_every = max(1, cfg.TRAIN.G_REG_EVERY // accu_steps)
+		d_reg_weight = d_reg_every * accu_steps * scale
+		g_reg_weight = g_reg_every * accu_steps * scale
+
+		self.evaluator = None
+		if cfg.TRAIN.EVAL_ASYNC:
+			# built by all ranks now, the evaluator thread runs no collectives
+			self.prepare_eval()
 		if get_rank() == 0:
 			train_words, train_sent = self.save_sample('train')
 			val_words, val_sent = self.save_sample('val')
+			self.checkpoints = CheckpointWriter(
+				self.model_dir, keep_last=cfg.TRAIN.CKPT_KEEP_LAST
+			)
+			if cfg.TRAIN.EVAL_ASYNC:
+				self.evaluator = AsyncEvaluator(
+					G_STYLE(self.img_size).to(device),
+					lambda netG, epoch: self.eval1(netG, epoch, shard=False),
+					self.report_fid, self.drop_fid, depth=cfg.TRAIN.EVAL_QUEUE
+				)
 
 		gen_iters = 0
-		best_fid, best_ep = None, None
+		self.best_fid, self.best_ep = None, None
 		self.epoch=start_epoch
 		self.num_crop = 4
 		print("This is trainer_fine")
@@ -491,208 +651,156 @@ class condGANTrainer(object):
 			start_t = time.time()
 			elapsed = 0
 			step = 0
-			while step < 0:
+			while step < self.num_batches:
 				start_step = start_t = time.time()
 				######################################################
 				# (1) Prepare training data and Compute text embeddings
 				######################################################
-				data = next(train_loader)
-				#data_pair = next(train_loader_pair)
-				real_img, caps, cap_ori,cap_lens, class_ids, keys = prepare_data(data)
-				texts = self.get_text_input(caps)
-
-				split_caps_feat,split_cap_len = self.split_captions(cap_ori,device)
-				split_caps_feat = split_caps_feat.type(torch.half)
-				split_caps_feat = split_caps_feat.detach()
-
-				states = self.clip_model.encode_text(texts).float()
-				states = states.detach()
+				# accu_steps micro-batches of batch_size per optimizer step
+				micro_batches = [
+					self.prepare_micro_batch(next(train_loader), device)
+					for _ in range(accu_steps)
+				]
 
 				#######################################################
 				# (2) Update D network
 				######################################################
-				self.requires_grad(g_module, False)
-				self.requires_grad(d_module, True)
-				fake_img, mu, logvar, _ = g_module(states)
-				loss_d, real_pred, fake_pred = d_logistic_loss(
-					d_module, real_img, fake_img, states, real_labels, fake_labels
-				)
-				
-				loss_dict["d"] = loss_d
-				loss_dict["real_score"] = real_pred.mean()
-				loss_dict["fake_score"] = fake_pred.mean()
-				
-				# backward and update parameters
-				d_module.zero_grad()
-				loss_d.backward()
-				optimD.step()
+				gan_params.train_d()
+				loss_d_sum = real_score = fake_score = 0
+				for k, (real_img, texts, states, _, _) in enumerate(micro_batches):
+					with sync_context(netD, k, accu_steps):
+						with amp.autocast():
+							fake_img, mu, logvar, _ = g_module(states)
+							loss_d, real_pred, fake_pred = d_logistic_loss(
+								netD, real_img, fake_img, states, real_labels, fake_labels
+							)
+						amp.backward(amp.scaler_d, loss_d * scale)
+					loss_d_sum += loss_d.detach() / accu_steps
+					real_score += real_pred.detach().mean() / accu_steps
+					fake_score += fake_pred.detach().mean() / accu_steps
+				amp.step(amp.scaler_d, optimD)
+
+				loss_dict["d"] = loss_d_sum
+				loss_dict["real_score"] = real_score
+				loss_dict["fake_score"] = fake_score
 
-				d_reg_every = cfg.TRAIN.D_REG_EVERY
 				r1 = cfg.TRAIN.R1
 				d_regularize = gen_iters % d_reg_every == 0
 				
 				if d_regularize:
+					# lazy regularization on the last micro-batch
 					real_img.requires_grad = True
-					r1_loss, real_pred = d_r1_loss(d_module, real_img, states)
-
-					d_module.zero_grad()
-					(r1 / 2 * r1_loss * d_reg_every + 0 * real_pred[0]).backward()
+					with amp.autocast():
+						r1_loss, real_pred = d_r1_loss(
+							netD, real_img, states, scaler=amp.scaler_d
+						)
+						loss_r1 = r1 / 2 * r1_loss * d_reg_weight + 0 * real_pred[0]
 
-					optimD.step()
+					optimD.zero_grad(set_to_none=True)
+					amp.backward_step(amp.scaler_d, loss_r1, optimD)
 				
 				loss_dict["r1"] = r1_loss
 
 				#######################################################
 				# (3) Update G network: maximize log(D(G(z)))
 				######################################################
-				self.requires_grad(g_module, True)
-				self.requires_grad(d_module, False)
-				fake_img, mu, logvar, _ = g_module(states)
-				
-				loss_g = pixel_g_nonsaturating_loss(
-					d_module,real_img, fake_img, states, real_labels,
-				)
-				loss_dict["g"] = loss_g
-
-				region_feat = self.crop_imgs(self.num_crop,fake_img,device)
-				region_feat = region_feat.type(torch.half)
-
-				loss_clip = self.clip_loss(fake_img, texts, match_labels)
-
-				w_loss0, w_loss1, _ = words_loss_trainer_fine(
-				region_feat, split_caps_feat,
-				match_labels, split_cap_len, None, batch_size
-				)
+				gan_params.train_g()
+				if cfg.TRAIN.ACCU_CONTRASTIVE and accu_steps > 1:
+					g_losses, fake_img = self.g_step_cached(
+						netG, g_module, d_module, micro_batches, real_labels, scale, device
+					)
+				else:
+					g_losses, fake_img = self.g_step(
+						netG, d_module, micro_batches, real_labels, scale, device
+					)
+				amp.step(amp.scaler_g, optimG)
 				###############################
 				# tiaocan 1 line 2022.8.29
 				###############################
 				#loss_clip *= 5.0
-				loss_dict["clip"] = loss_clip
-				loss_dict["loss_word0"] = w_loss0
-				loss_dict["loss_word1"] = w_loss1
-				loss_total = loss_g  + loss_clip + (w_loss0 + w_loss1).mean()/20
-				# backward and update parameters
-				g_module.zero_grad()
-				loss_total.backward()
-				optimG.step()
+				loss_dict.update(g_losses)
 
 
-				g_reg_every = cfg.TRAIN.G_REG_EVERY
 				path_regularzie = cfg.TRAIN.PATH_REGULARIZE
 				g_regularize = gen_iters % g_reg_every == 0
 				
 				if g_regularize:
 					pl_data = next(path_loader)
-					_, pl_caps,pl_cap_ori, pl_cap_lens, _, _ = prepare_data(pl_data)
+					_, pl_caps,pl_cap_ori, pl_cap_lens, _, _, pl_extras = prepare_data(pl_data)
 					
 					path_batch = self.path_batch
 					pl_caps = pl_caps[:path_batch]
 					pl_cap_lens = pl_cap_lens[:path_batch]
+					pl_extras = {k: v[:path_batch] for k, v in pl_extras.items()}
 
-					pl_texts = self.get_text_input(pl_caps)
-					pl_states = self.clip_model.encode_text(pl_texts).float()
+					pl_states = self.get_sent_emb(pl_caps, pl_extras)
 					pl_states = pl_states.detach()
 
-					pl_fake_img, _, _, pl_dlatents = \
-						g_module(pl_states, return_latents=True)
+					with amp.autocast():
+						pl_fake_img, _, _, pl_dlatents = \
+							netG(pl_states, return_latents=True)
 
 					path_loss, mean_path_length, path_lengths = g_path_regularize(
-						pl_fake_img, pl_dlatents, mean_path_length
+						pl_fake_img, pl_dlatents, mean_path_length, scaler=amp.scaler_g
 					)
 
-					g_module.zero_grad()
-					weighted_path_loss = path_regularzie * g_reg_every * path_loss
+					optimG.zero_grad(set_to_none=True)
+					weighted_path_loss = path_regularzie * g_reg_weight * path_loss
 
 					if self.path_batch_shrink: 
 						weighted_path_loss += 0 * pl_fake_img[0, 0, 0, 0]   # ??
 
-					weighted_path_loss.backward()
-					optimG.step()
+					amp.backward_step(amp.scaler_g, weighted_path_loss, optimG)
 
 
-					mean_path_length_avg = (
-						reduce_sum(mean_path_length).item() / get_world_size()
-					)
+					loss_dict["mean_path"] = mean_path_length
 
 				loss_dict["path"] = path_loss
 				loss_dict["path_length"] = path_lengths.mean()
 
-				self.accumulate(g_ema, g_module, accum)
-
-				loss_reduced = reduce_loss_dict(loss_dict)
-
-				d_loss_val = loss_reduced["d"].mean().item()
-				g_loss_val = loss_reduced["g"].mean().item()
-				###################################################
-				clip_loss_val = loss_reduced["clip"].mean().item()
-				clip_loss_pair_val = loss_reduced["loss_word0"].mean().item()
-				clip_loss_unpair_val = loss_reduced["loss_word1"].mean().item()
-				r1_val = loss_reduced["r1"].mean().item()
-				path_loss_val = loss_reduced["path"].mean().item()
-				real_score_val = loss_reduced["real_score"].mean().item()
-				fake_score_val = loss_reduced["fake_score"].mean().item()
-				path_length_val = loss_reduced["path_length"].mean().item()
+				self.ema.update(accum)
 
+				loss_dict["fake_min"] = fake_img.detach().min()
+				loss_dict["fake_max"] = fake_img.detach().max()
+				metrics.add(loss_dict)
 
 				elapsed += (time.time() - start_step)
 				display_gap = 100
-				if get_rank() == 0:
-					if gen_iters % display_gap == 0:  # 100
-						print(
-							f'Epoch [{epoch}/{self.max_epoch}] '
-							f'Step [{step}/{self.num_batches}] '
-							f'Time [{elapsed/display_gap:.2f}s]'
-						)
-						elapsed = 0
-
-						print(
-							f"d: {d_loss_val:.4f}; "
-							f"clip: {clip_loss_val:.4f};"
-							f"word0: {clip_loss_pair_val:.4f};"
-							f"word1: {clip_loss_unpair_val:.4f};"
-							f"g: {g_loss_val:.4f}; "
-							f"r1: {r1_val:.4f}; "
-							f"path: {path_loss_val:.4f}; "
-							f"mean path: {mean_path_length_avg:.4f}; "
-						)
-						print('[%.4f, %.4f]' %(fake_img.min(), fake_img.max()))
-						print('-' * 40)
-					
-					log_info = {
-						"Generator": g_loss_val,
-						"Discriminator": d_loss_val,
-						"R1": r1_val,
-						"Path Length Regularization": path_loss_val,
-						"Mean Path Length": mean_path_length,
-						"Real Score": real_score_val,
-						"Fake Score": fake_score_val,
-						"Path Length": path_length_val,
-						"CLIP LOSS": clip_loss_val,
-						"CLIP word0_LOSS": clip_loss_pair_val,
-						"CLIP word1_LOSS": clip_loss_unpair_val
-					}
-					for key, value in log_info.items():
-						self.writer.add_scalar(f'loss/{key}', float(value), gen_iters)
+				if gen_iters % display_gap == 0:  # 100
+					# window means, reduced across ranks and logged off-thread
+					metrics.flush(gen_iters, header=(
+						f'Epoch [{epoch}/{self.max_epoch}] '
+						f'Step [{step}/{self.num_batches}] '
+						f'Time [{elapsed/display_gap:.2f}s]'
+					))
+					elapsed = 0
 						
 
-				step += 1
+				step += accu_steps
 				gen_iters += 1
 	
 			end_t = time.time()
 			if epoch%10 !=0:
 				continue
+			# every rank reduces the epoch's last window, rank 0 waits for it
+			metrics.flush(gen_iters, header=f'Epoch [{epoch}/{self.max_epoch}] end')
+			metrics.wait()
 			if get_rank() == 0:
 				print("start calculate fid")
 				print(cfg.CONFIG_NAME)
 				print('''[%d/%d] Loss_D: %.4f Loss_G: %.4f Time: %.2fs''' % (
-					epoch, self.max_epoch, d_loss_val, g_loss_val, end_t - start_t))
-				if epoch % self.snapshot_interval == 0 or epoch == self.max_epoch:
+					epoch, self.max_epoch, metrics.last.get("d", 0), metrics.last.get("g", 0),
+					end_t - start_t))
+				ckpt_path = f"{self.model_dir}/ckpt_{str(epoch).zfill(4)}.pth"
+				saved = epoch % self.snapshot_interval == 0 or epoch == self.max_epoch
+				# the async evaluator can only link the best once training has moved on
+				if saved or self.evaluator is not None:
 					print('Saving models...')
 					self.save_model(
-						g_module, d_module, g_ema, optimG, optimD, 
-						f"{self.model_dir}/ckpt_{str(epoch).zfill(4)}.pth"
+						g_module, d_module, g_ema, optimG, optimD, ckpt_path,
+						hold=self.evaluator is not None
 					)
-				with torch.no_grad():
+				with torch.no_grad(), self.ema.on_device():
 					print(train_sent.shape)
 					g_ema.eval()
 					train_sample, _, _, _ = g_ema(train_sent)
@@ -707,43 +815,96 @@ class condGANTrainer(object):
 						val_sample, 
 						f"fake_{str(epoch).zfill(4)}_val.png"
 					)
-					
-					# validation
-					fid1, fid2 = self.eval1(g_ema)
-					print(fid1,"   ",fid2)
-					if best_fid is None or fid2 < best_fid:
-						best_fid, best_ep = fid2, epoch
-						self.save_model(
-							g_module, d_module, g_ema, optimG, optimD, 
-							f"{self.model_dir}/ckpt_best.pth"
-						)
 
-					self.writer.add_scalar(f'fid_train', float(fid1), epoch)
-					self.writer.add_scalar(f'fid_val', float(fid2), epoch)
-					print(
-						f"FID(train/val): {fid1:.4f} / {fid2:.4f}, "
-						f"best FID: {best_fid:.4f} at ep{best_ep}"
-					)
+			if cfg.TRAIN.EVAL_ASYNC:
+				# rank 0's evaluator thread takes it from here
+				if get_rank() == 0:
+					self.evaluator.submit(epoch, self.ema.state_dict(), (ckpt_path, saved))
+				continue
 
-					metric_file = os.path.join(self.out_dir, f'fid10k.txt')
-					with open(metric_file, 'a') as f:
-						f.write(
-							f'epoch-{str(epoch).zfill(4)}\t\t'
-							f'fid3k2 {fid1:.4f} / {fid2:.4f}\n'
+			# validation, every rank generates its shard of the prompts
+			with torch.no_grad(), self.ema.on_device():
+				g_ema.eval()
+				fid1, fid2 = self.eval1(g_ema, epoch)
+			if get_rank() == 0:
+				if self.record_fid(epoch, fid1, fid2):
+					if not saved:
+						self.save_model(
+							g_module, d_module, g_ema, optimG, optimD, ckpt_path,
+							hold=True
 						)
-				
-				print('-' * 89)
+					# link to the epoch checkpoint, no second serialization
+					self.checkpoints.link_best(ckpt_path)
+					if not saved:
+						# like the baseline, only ckpt_best.pth keeps a best-only epoch
+						self.checkpoints.release(ckpt_path, keep=False)
+		# the window since the last display_gap flush
+		metrics.close(gen_iters)
+
+	def record_fid(self, epoch, fid1, fid2):
+		# rank 0: log one evaluation, True if it is the best so far
+		print(fid1,"   ",fid2)
+		best = self.best_fid is None or fid2 < self.best_fid
+		if best:
+			self.best_fid, self.best_ep = fid2, epoch
+
+		self.writer.add_scalar(f'fid_train', float(fid1), epoch)
+		self.writer.add_scalar(f'fid_val', float(fid2), epoch)
+		print(
+			f"FID(train/val): {fid1:.4f} / {fid2:.4f}, "
+			f"best FID: {self.best_fid:.4f} at ep{self.best_ep}"
+		)
+
+		metric_file = os.path.join(self.out_dir, f'fid10k.txt')
+		with open(metric_file, 'a') as f:
+			f.write(
+				f'epoch-{str(epoch).zfill(4)}\t\t'
+				f'fid3k2 {fid1:.4f} / {fid2:.4f}\n'
+			)
+		
+		print('-' * 89)
+		return best
+
+	def report_fid(self, epoch, fids, ckpt):
+		# evaluator thread; the epoch checkpoint was saved held
+		ckpt_path, saved = ckpt
+		best = self.record_fid(epoch, *fids)
+		if best:
+			self.checkpoints.link_best(ckpt_path)
+		# a best-only epoch lives on as ckpt_best.pth alone
+		self.checkpoints.release(ckpt_path, keep=saved)
+
+	def drop_fid(self, epoch, ckpt):
+		ckpt_path, saved = ckpt
+		self.checkpoints.release(ckpt_path, keep=saved)
+
+	def prepare_eval(self):
+		# reference statistics and prompt table, on every rank
+		if self.fid_ref is None:
+			self.fid_ref = [
+				reference_statistics(self.eval_data_set, self.batch_size),
+				reference_statistics(self.eval_val_set, self.batch_size),
+			]
+		if self.prompts is None:
+			self.prompts = ensure_prompt_bundle(
+				cfg.TEXT.EVAL_PROMPTS, self.word2id, self.ixtoword,
+				self.clip_model, self.args.device
+			)
 
-	def eval1(self, netG):
+	def eval1(self, netG, epoch, shard=True):
 		batch_size = self.batch_size
 		n_batch = self.args.n_val // batch_size
 		act = []
 		data_iter = iter(self.eval_val_loader)
-		self.fid_save_path = os.path.join(self.args.path_fid, 'fid_epoch'+str(self.epoch))
+		fid_save_path = os.path.join(self.args.path_fid, 'fid_epoch'+str(epoch))
+		self.prepare_eval()
 		fid_train,fid_val = calculate_fid_CLIP_with_TediGan_text(netG, val_dataset=self.eval_val_set,train_dataset = self.eval_data_set, bs=self.batch_size, textEnc = self.clip_model,
 														num_batches=self.args.n_val // batch_size, latent_size=self.args.latent,get_text_input=self.get_text_input,
-														save_dir=self.fid_save_path, data_iter=data_iter,prepare_data =prepare_data,val_loader=self.eval_val_loader,
-														get_text = self.get_text,word2id = self.word2id)
+														save_dir=fid_save_path, data_iter=data_iter,prepare_data =prepare_data,val_loader=self.eval_val_loader,
+														get_text = self.get_text,word2id = self.word2id,
+														dump_samples=cfg.TRAIN.FID_DUMP_SAMPLES,
+														train_stats=self.fid_ref[0], val_stats=self.fid_ref[1],
+														prompts=self.prompts, shard=shard)
 		return fid_train['frechet_inception_distance'], fid_val['frechet_inception_distance']
 
 	def sampling(self):
@@ -793,12 +954,11 @@ class condGANTrainer(object):
 			flag = True 
 			while flag:
 				data = next(data_loader)
-				real_img, caps,cap_ori, cap_lens, _, keys = prepare_data(data)
+				real_img, caps,cap_ori, cap_lens, _, keys, extras = prepare_data(data)
 				##########################################
 				# clip 3 lines
 				###########################################
-				texts = self.get_text_input(caps)
-				states = self.clip_model.encode_text(texts).float()
+				states = self.get_sent_emb(caps, extras)
 				states = states.detach()
 				#########################################
 